@@ -59,6 +59,15 @@ def create_app(config_class="app.config.Config", test_config=False):
         # Disable Postgres pooling when SQLite is used
         app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
 
+        # Tests call the background tasks directly
+        app.config["BACKGROUND_TASKS_ENABLED"] = False
+
+        # Tests don't look up DNS records
+        app.config["MLS_PRESCREEN_ENABLED"] = False
+
+        # Tests don't share the worker statistics with other processes
+        app.config["MLS_BALANCER_STATE_BACKEND"] = "local"
+
     # Initialize the Flask extensions for the app instance
     mail.init_app(app)
     db.init_app(app)
@@ -78,11 +87,31 @@ def create_app(config_class="app.config.Config", test_config=False):
     try:
         with app.app_context():
             # Import the table models
-            from app.models import Users, Tiers, BatchJobs, APIKeys
+            from app.models import (
+                Users,
+                Tiers,
+                BatchJobs,
+                APIKeys,
+                CachedValidationResults,
+                CreditLeases,
+                CreditLedger,
+                WebhookEndpoints,
+                WebhookDeliveries,
+                WebhookDeliveryAttempts,
+                StripeEvents,
+                StripeCharges,
+                StripeChargeHistories,
+            )
 
             # Create the database tables if they don't exist
             db.create_all()
 
+            # Add the columns and indexes that are new to existing tables
+            from app.utilities.schema import upgrade_schema
+
+            for name in upgrade_schema(db.engine, db.metadata):
+                print(f" * Added {name} to the database.")
+
             # If there are no tiers in the database, create the default tiers
             if Tiers.query.count() == 0:
                 default_tier = Tiers(name="free", label="Free")
@@ -95,6 +124,52 @@ def create_app(config_class="app.config.Config", test_config=False):
         print(e)
         sys.exit()
 
+    # Configure the in-process caches and start their background tasks
+    from app.utilities.background import start_periodic_task
+    from app.utilities.api_keys import (
+        verified_api_keys,
+        last_used_buffer,
+        deactivate_expired_keys,
+    )
+
+    from app.utilities.worker_balancer import worker_balancer
+    from app.utilities.result_cache import result_cache
+    from app.utilities.prescreen import prescreen
+    from app.utilities.domain_cache import domain_cache
+    from app.utilities.admission import admission
+    from app.utilities.credit_leases import credit_leases
+    from app.utilities.credit_ledger import credit_ledger
+    from app.utilities.webhooks import dispatch_job_webhooks
+    from app.utilities.stripe_events import process_due_stripe_events
+
+    verified_api_keys.init_app(app)
+    worker_balancer.init_app(app)
+    result_cache.init_app(app)
+    prescreen.init_app(app)
+    domain_cache.init_app(app)
+    admission.init_app(app)
+    credit_leases.init_app(app)
+    credit_ledger.init_app(app)
+    last_used_buffer.init_app(app)
+    start_periodic_task(
+        app,
+        "api-key-expiry-sweep",
+        app.config["API_KEY_EXPIRY_SWEEP_INTERVAL"],
+        deactivate_expired_keys,
+    )
+    start_periodic_task(
+        app,
+        "batch-job-webhooks",
+        app.config["MLS_WEBHOOK_DISPATCH_INTERVAL"],
+        dispatch_job_webhooks,
+    )
+    start_periodic_task(
+        app,
+        "stripe-events",
+        app.config["MLS_STRIPE_EVENTS_INTERVAL"],
+        process_due_stripe_events,
+    )
+
     # Import the Blueprints
     from app.views import public_bp
     from app.views_private import private_bp
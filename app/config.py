@@ -9,6 +9,7 @@ import pytz
 import boto3
 
 import os
+import tempfile
 
 
 # Timezone used in this app
@@ -25,6 +26,38 @@ s3 = boto3.resource(
 )
 
 
+def parse_ttl_by_status(value):
+    """Parse the time to live of each validation status from a setting.
+
+    Args:
+        value: Comma separated status:seconds pairs, e.g. "valid:3600,unknown:120".
+
+    Returns:
+        dict: The number of seconds by status.
+    """
+    ttl_by_status = {}
+    for pair in Csv()(value):
+        status, seconds = pair.split(":")
+        ttl_by_status[status.strip()] = int(seconds)
+    return ttl_by_status
+
+
+def parse_lane_weights(value):
+    """Parse the weight of each admission lane from a setting.
+
+    Args:
+        value: Comma separated lane:weight pairs, e.g. "paid:6,free:3,demo:1".
+
+    Returns:
+        dict: The weight by lane.
+    """
+    weights = {}
+    for pair in Csv()(value):
+        lane, weight = pair.split(":")
+        weights[lane.strip()] = int(weight)
+    return weights
+
+
 # Flask app configuration
 class Config:
     """Configuration class for the Flask application.
@@ -104,5 +137,193 @@ class Config:
         "MLS_FREE_CREDITS_FOR_NEW_ACCOUNTS", cast=int
     )
 
-    # Worker to be used for the next validation
-    NEXT_WORKER = 0
+    # Load balancing across the workers
+    # Weight of the latest response in the latency and error rate averages
+    MLS_BALANCER_EWMA_ALPHA = config("MLS_BALANCER_EWMA_ALPHA", default=0.2, cast=float)
+    # Consecutive failures that eject a worker, and seconds before it is probed again
+    MLS_BALANCER_FAILURE_THRESHOLD = config(
+        "MLS_BALANCER_FAILURE_THRESHOLD", default=3, cast=int
+    )
+    MLS_BALANCER_OPEN_SECONDS = config(
+        "MLS_BALANCER_OPEN_SECONDS", default=30, cast=int
+    )
+    # Where the worker health statistics are kept: "sqlite" to share them
+    # between the app processes of the host through the MLS_BALANCER_STATE_PATH
+    # file, or "local" for each process to keep its own
+    MLS_BALANCER_STATE_BACKEND = config("MLS_BALANCER_STATE_BACKEND", default="sqlite")
+    MLS_BALANCER_STATE_PATH = config(
+        "MLS_BALANCER_STATE_PATH",
+        default=os.path.join(tempfile.gettempdir(), "mls-worker-state.sqlite3"),
+    )
+
+    # Hedged validation asks the next worker if the previous one doesn't give a
+    # definitive answer within MLS_HEDGE_DELAY seconds, instead of waiting for it
+    MLS_HEDGED_VALIDATION = config("MLS_HEDGED_VALIDATION", default=False, cast=bool)
+    MLS_HEDGE_DELAY = config("MLS_HEDGE_DELAY", default=2.0, cast=float)
+    # Threads (greenlets with gevent) sending concurrent requests to the workers
+    MLS_VALIDATION_THREADS = config("MLS_VALIDATION_THREADS", default=32, cast=int)
+
+    # Seconds to wait for a worker to accept the connection and to answer
+    MLS_WORKER_CONNECT_TIMEOUT = config(
+        "MLS_WORKER_CONNECT_TIMEOUT", default=3.0, cast=float
+    )
+    MLS_WORKER_READ_TIMEOUT = config(
+        "MLS_WORKER_READ_TIMEOUT", default=30.0, cast=float
+    )
+    # Seconds a validation may take in total, across all the workers it tries
+    MLS_VALIDATION_DEADLINE = config(
+        "MLS_VALIDATION_DEADLINE", default=45.0, cast=float
+    )
+
+    # Keep-alive connections to each worker, shared by the requests of a process
+    MLS_WORKER_POOL_SIZE = config("MLS_WORKER_POOL_SIZE", default=20, cast=int)
+    # Seconds after which an idle worker connection pool is replaced
+    MLS_WORKER_KEEPALIVE = config("MLS_WORKER_KEEPALIVE", default=60, cast=int)
+
+    # Maximum addresses in a batch validation job submitted as a JSON list
+    MLS_API_JOB_MAX_EMAILS = config("MLS_API_JOB_MAX_EMAILS", default=100000, cast=int)
+
+    # Completion webhooks of batch jobs
+    # Seconds between the runs of the dispatcher, and notifications per run
+    MLS_WEBHOOK_DISPATCH_INTERVAL = config(
+        "MLS_WEBHOOK_DISPATCH_INTERVAL", default=10, cast=int
+    )
+    MLS_WEBHOOK_BATCH_SIZE = config("MLS_WEBHOOK_BATCH_SIZE", default=50, cast=int)
+    # Seconds to wait for the receiver, and attempts before giving up
+    MLS_WEBHOOK_TIMEOUT = config("MLS_WEBHOOK_TIMEOUT", default=10, cast=int)
+    MLS_WEBHOOK_MAX_ATTEMPTS = config("MLS_WEBHOOK_MAX_ATTEMPTS", default=8, cast=int)
+    # Seconds before the first retry, doubled after each failure up to the maximum
+    MLS_WEBHOOK_BACKOFF = config("MLS_WEBHOOK_BACKOFF", default=30, cast=int)
+    MLS_WEBHOOK_MAX_BACKOFF = config(
+        "MLS_WEBHOOK_MAX_BACKOFF", default=6 * 3600, cast=int
+    )
+    # Seconds the results download link in the notifications stays valid
+    MLS_WEBHOOK_LINK_EXPIRATION = config(
+        "MLS_WEBHOOK_LINK_EXPIRATION", default=24 * 3600, cast=int
+    )
+
+    # Processing of the Stripe webhook events in the background
+    # Seconds between the runs of the processor, and events per run
+    MLS_STRIPE_EVENTS_INTERVAL = config(
+        "MLS_STRIPE_EVENTS_INTERVAL", default=5, cast=int
+    )
+    MLS_STRIPE_EVENTS_BATCH_SIZE = config(
+        "MLS_STRIPE_EVENTS_BATCH_SIZE", default=50, cast=int
+    )
+    # Attempts before giving up on an event, and seconds before the first
+    # retry, doubled after each failure up to the maximum
+    MLS_STRIPE_EVENTS_MAX_ATTEMPTS = config(
+        "MLS_STRIPE_EVENTS_MAX_ATTEMPTS", default=8, cast=int
+    )
+    MLS_STRIPE_EVENTS_BACKOFF = config(
+        "MLS_STRIPE_EVENTS_BACKOFF", default=30, cast=int
+    )
+    MLS_STRIPE_EVENTS_MAX_BACKOFF = config(
+        "MLS_STRIPE_EVENTS_MAX_BACKOFF", default=3600, cast=int
+    )
+
+    # Seconds after which the cached charge history of a customer is
+    # refreshed from Stripe in the background when the billing page is viewed
+    MLS_STRIPE_CHARGES_TTL = config("MLS_STRIPE_CHARGES_TTL", default=3600, cast=int)
+
+    # Syntax and MX record checks before asking the workers
+    MLS_PRESCREEN_ENABLED = config("MLS_PRESCREEN_ENABLED", default=True, cast=bool)
+    MLS_PRESCREEN_DNS_TIMEOUT = config(
+        "MLS_PRESCREEN_DNS_TIMEOUT", default=2.0, cast=float
+    )
+    # Number of domains whose MX records and classification are cached in each
+    # process, and for how many seconds
+    MLS_DOMAIN_CACHE_SIZE = config("MLS_DOMAIN_CACHE_SIZE", default=10000, cast=int)
+    MLS_DOMAIN_CACHE_TTL = config("MLS_DOMAIN_CACHE_TTL", default=3600, cast=int)
+    MLS_DOMAIN_CACHE_NEGATIVE_TTL = config(
+        "MLS_DOMAIN_CACHE_NEGATIVE_TTL", default=300, cast=int
+    )
+
+    # Bulk validation API: maximum addresses per request, validated concurrently
+    MLS_BULK_MAX_EMAILS = config("MLS_BULK_MAX_EMAILS", default=500, cast=int)
+    MLS_BULK_CONCURRENCY = config("MLS_BULK_CONCURRENCY", default=16, cast=int)
+
+    # Admission control of the validations waiting on the workers in each
+    # process: concurrent validations of all the lanes, and the part of them
+    # reserved for users on a paid tier
+    MLS_ADMISSION_CONCURRENCY = config(
+        "MLS_ADMISSION_CONCURRENCY", default=64, cast=int
+    )
+    MLS_ADMISSION_PAID_RESERVED = config(
+        "MLS_ADMISSION_PAID_RESERVED", default=16, cast=int
+    )
+    # Share of the freed slots each lane gets when several lanes are waiting
+    MLS_ADMISSION_WEIGHTS = config(
+        "MLS_ADMISSION_WEIGHTS",
+        default="paid:6,free:3,demo:1",
+        cast=parse_lane_weights,
+    )
+    # Concurrent validations of the anonymous demo form
+    MLS_ADMISSION_DEMO_CONCURRENCY = config(
+        "MLS_ADMISSION_DEMO_CONCURRENCY", default=8, cast=int
+    )
+    # Queued validations of each of the paid and free lanes, and of the demo lane
+    MLS_ADMISSION_API_QUEUE = config("MLS_ADMISSION_API_QUEUE", default=128, cast=int)
+    MLS_ADMISSION_DEMO_QUEUE = config("MLS_ADMISSION_DEMO_QUEUE", default=16, cast=int)
+    # Seconds a validation may wait in the queue, and the Retry-After of rejections
+    MLS_ADMISSION_QUEUE_TIMEOUT = config(
+        "MLS_ADMISSION_QUEUE_TIMEOUT", default=5.0, cast=float
+    )
+    MLS_ADMISSION_RETRY_AFTER = config("MLS_ADMISSION_RETRY_AFTER", default=5, cast=int)
+
+    # Recent validation results, by normalized email address
+    # Backend: "memory" for each process, "database" shared by all, or "none"
+    MLS_RESULT_CACHE_BACKEND = config("MLS_RESULT_CACHE_BACKEND", default="memory")
+    MLS_RESULT_CACHE_SIZE = config("MLS_RESULT_CACHE_SIZE", default=50000, cast=int)
+    # Seconds each status is cached, other statuses use the default, 0 disables
+    MLS_RESULT_CACHE_TTL_BY_STATUS = config(
+        "MLS_RESULT_CACHE_TTL_BY_STATUS",
+        default="valid:3600,invalid:3600,unknown:120",
+        cast=parse_ttl_by_status,
+    )
+    MLS_RESULT_CACHE_DEFAULT_TTL = config(
+        "MLS_RESULT_CACHE_DEFAULT_TTL", default=600, cast=int
+    )
+    # Seconds between the deletions of expired results by the database backend
+    MLS_RESULT_CACHE_PURGE_INTERVAL = config(
+        "MLS_RESULT_CACHE_PURGE_INTERVAL", default=3600, cast=int
+    )
+
+    # Credits of busy API users reserved by each process at a time, seconds a
+    # lease lasts after its last reservation, and seconds between the
+    # releases of the expired leases
+    MLS_CREDIT_LEASE_SIZE = config("MLS_CREDIT_LEASE_SIZE", default=100, cast=int)
+    MLS_CREDIT_LEASE_TTL = config("MLS_CREDIT_LEASE_TTL", default=60, cast=int)
+    MLS_CREDIT_LEASE_SYNC_INTERVAL = config(
+        "MLS_CREDIT_LEASE_SYNC_INTERVAL", default=5, cast=int
+    )
+
+    # Seconds between the compactions of the credit ledger into the cached
+    # balances, and the most entries compacted at a time
+    MLS_CREDIT_LEDGER_COMPACTION_INTERVAL = config(
+        "MLS_CREDIT_LEDGER_COMPACTION_INTERVAL", default=300, cast=int
+    )
+    MLS_CREDIT_LEDGER_COMPACTION_BATCH = config(
+        "MLS_CREDIT_LEDGER_COMPACTION_BATCH", default=5000, cast=int
+    )
+
+    # API key authentication
+    # Secret mixed into the HMAC of API keys, changing it invalidates all keys
+    API_KEY_PEPPER = config("API_KEY_PEPPER", default=SECRET_KEY)
+    # Recently verified keys are cached in each process to skip the hash check
+    API_KEY_CACHE_SIZE = config("API_KEY_CACHE_SIZE", default=10000, cast=int)
+    API_KEY_CACHE_TTL = config("API_KEY_CACHE_TTL", default=60, cast=int)
+    # Last used timestamps of API keys are written in batches every few seconds
+    API_KEY_LAST_USED_FLUSH_INTERVAL = config(
+        "API_KEY_LAST_USED_FLUSH_INTERVAL", default=5, cast=int
+    )
+
+    # Seconds between the bulk deactivations of expired API keys
+    API_KEY_EXPIRY_SWEEP_INTERVAL = config(
+        "API_KEY_EXPIRY_SWEEP_INTERVAL", default=600, cast=int
+    )
+
+    # Run the periodic maintenance tasks in background threads of each process
+    BACKGROUND_TASKS_ENABLED = config(
+        "BACKGROUND_TASKS_ENABLED", default=True, cast=bool
+    )
@@ -1,12 +1,14 @@
 """Database models for the Mail List Shield application.
 
 This module defines the SQLAlchemy ORM models for the application's database,
-including user accounts, API keys, batch validation jobs, and subscription tiers.
+including user accounts, API keys, batch validation jobs, their completion
+webhooks, and subscription tiers.
 """
 
 from datetime import datetime, timezone, timedelta
 from email.policy import default
 from hashlib import md5
+import hmac
 import pyotp
 import uuid
 
@@ -17,7 +19,15 @@ from app import db, bc
 from app.config import s3, appTimezone
 from app.utilities.object_storage import generate_download_link, user_folder_size
 from app.utilities.qr import qrcode_img_src
-from app.utilities.helpers import readable_file_size
+from app.utilities.helpers import (
+    readable_file_size,
+    api_key_prefix,
+    hash_api_key,
+    naive_app_now,
+    generate_webhook_secret,
+    API_KEY_HASH_BCRYPT,
+    API_KEY_HASH_HMAC,
+)
 
 
 class APIKeys(db.Model):
@@ -29,7 +39,11 @@ class APIKeys(db.Model):
     Attributes:
         id: Primary key.
         user_id: Foreign key to the Users table.
-        key_hash: Bcrypt hash of the API key.
+        key_prefix: Public, unique prefix of the API key used for lookups.
+            Keys issued before prefixes existed get theirs on first use.
+        key_hash: Hash of the API key, computed with the hash_scheme.
+        hash_scheme: 'hmac-sha256' for peppered HMAC hashes, or 'bcrypt' for
+            keys issued before; those are rehashed on their first use.
         label: Optional user-provided label for the key.
         created_at: Timestamp when the key was created.
         expires_at: Optional expiration timestamp.
@@ -38,40 +52,135 @@ class APIKeys(db.Model):
     """
 
     __tablename__ = "APIKeys"
+    __table_args__ = (
+        # Supports the lookups and the sweeps of the usable keys
+        db.Index("ix_APIKeys_is_active_expires_at", "is_active", "expires_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("Users.id"), nullable=False)
+    key_prefix = db.Column(db.String(16), unique=True, index=True)
     key_hash = db.Column(db.String(64), nullable=False)
+    hash_scheme = db.Column(
+        db.String(20),
+        nullable=False,
+        default=API_KEY_HASH_BCRYPT,
+        server_default=API_KEY_HASH_BCRYPT,
+    )
     label = db.Column(db.String())
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime)
     last_used = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
 
-    def __init__(self, user, key_hash, label=None, expires_at=None):
+    def __init__(
+        self,
+        user,
+        key_hash,
+        key_prefix=None,
+        label=None,
+        expires_at=None,
+        hash_scheme=API_KEY_HASH_HMAC,
+    ):
         """Initialize a new API key.
 
         Args:
             user: The user object this key belongs to.
-            key_hash: The bcrypt hash of the API key.
+            key_hash: The hash of the API key.
+            key_prefix: The public prefix of the API key.
             label: Optional label for identifying the key.
             expires_at: Optional expiration datetime.
+            hash_scheme: The scheme the key_hash is computed with.
         """
         self.user_id = user.id
         self.key_hash = key_hash
+        self.key_prefix = key_prefix
+        self.hash_scheme = hash_scheme
         self.label = label
         self.expires_at = expires_at
 
     def check_key(self, key_plain):
         """Verify if a plaintext key matches this key's hash.
 
+        Keys still hashed with bcrypt are rehashed with HMAC once they match,
+        so that their next checks are fast.
+
         Args:
             key_plain: The plaintext API key to verify.
 
         Returns:
             bool: True if the key matches, False otherwise.
         """
-        return bc.check_password_hash(self.key_hash, key_plain)
+        if self.hash_scheme == API_KEY_HASH_HMAC:
+            return hmac.compare_digest(self.key_hash, hash_api_key(key_plain))
+
+        if not bc.check_password_hash(self.key_hash, key_plain):
+            return False
+
+        # Migrate the key to the fast scheme
+        self.key_hash = hash_api_key(key_plain)
+        self.hash_scheme = API_KEY_HASH_HMAC
+        self.save()
+        return True
+
+    @classmethod
+    def usable_conditions(cls):
+        """Get the filter conditions of the keys that are active and not expired.
+
+        Returns:
+            tuple: The SQL conditions, to use in queries joining the keys.
+        """
+        return (
+            cls.is_active == True,
+            db.or_(cls.expires_at == None, cls.expires_at > naive_app_now()),
+        )
+
+    @classmethod
+    def usable(cls):
+        """Query the keys that are active and not expired.
+
+        Returns:
+            Query: A query of the usable API keys.
+        """
+        return cls.query.filter(*cls.usable_conditions())
+
+    @classmethod
+    def find_by_key(cls, key_plain):
+        """Find the active API key matching a plaintext key.
+
+        The key is looked up by its public prefix, so only one hash is checked.
+        Keys issued before prefixes existed are matched by checking the
+        remaining keys without a prefix, and their prefix is recorded on the
+        first match so that they use the indexed lookup from then on.
+
+        Args:
+            key_plain: The plaintext API key presented by the client.
+
+        Returns:
+            APIKeys: The matching usable API key, or None if there is no match.
+        """
+        key_prefix, is_legacy_key = api_key_prefix(key_plain)
+        if key_prefix is None:
+            return None
+
+        # Indexed lookup by the public prefix
+        key = cls.usable().filter_by(key_prefix=key_prefix).first()
+        if key:
+            return key if key.check_key(key_plain) else None
+
+        # Only keys in the old format, 64 hex characters, can match a key
+        # without a prefix
+        if not is_legacy_key:
+            return None
+
+        for key in cls.usable().filter_by(key_prefix=None).all():
+            if key.check_key(key_plain):
+                # Record the prefix so the next lookup is indexed
+                key.key_prefix = key_prefix
+                key.save()
+                return key
+
+        return None
 
     def delete_key(self):
         """Delete this API key from the database.
@@ -83,11 +192,6 @@ class APIKeys(db.Model):
         db.session.commit()
         return True
 
-    def update_last_used(self):
-        """Update the last_used timestamp to the current time."""
-        self.last_used = datetime.now(timezone.utc).astimezone(appTimezone)
-        self.save()
-
     def save(self):
         """Save the current state of this API key to the database.
 
@@ -164,6 +268,17 @@ class BatchJobs(db.Model):
     finished = db.Column(db.DateTime(), nullable=True)
     result = db.Column(db.String(), nullable=True)
 
+    @classmethod
+    def finished_condition(cls):
+        """Get the filter condition of the jobs that reached their final status.
+
+        A job ends completed, or failed with a status starting with 'error'.
+
+        Returns:
+            The SQL condition.
+        """
+        return db.or_(cls.status == "file_completed", cls.status.startswith("error"))
+
     def __init__(self, *args, **kwargs):
         """Initialize a new batch job and generate a unique ID."""
         super().__init__(*args, **kwargs)
@@ -181,9 +296,12 @@ class BatchJobs(db.Model):
                 self.uid = new_uid
                 break
 
-    def generate_results_download_link(self):
+    def generate_results_download_link(self, expiration_in_seconds=60):
         """Generate a pre-signed download URL for the results file.
 
+        Args:
+            expiration_in_seconds: URL expiration time in seconds.
+
         Returns:
             str: A pre-signed URL for downloading the results file,
                 or None if no results file exists.
@@ -193,10 +311,44 @@ class BatchJobs(db.Model):
                 bucket_name=current_app.config["S3_BUCKET_NAME"],
                 key=self.results_file,
                 s3=s3,
+                expiration_in_seconds=expiration_in_seconds,
             )
         else:
             return None
 
+    def to_api_dict(self, download_link_expiration=60):
+        """Get the status and progress of the job as returned by the API.
+
+        Args:
+            download_link_expiration: Expiration of the results download link
+                in seconds, included once the job is completed.
+
+        Returns:
+            dict: The job uid, status and progress.
+        """
+        job = {
+            "uid": self.uid,
+            "status": self.status,
+            "source": self.source,
+            "row_count": self.row_count,
+            "last_pick_row": self.last_pick_row,
+            "progress": (
+                round(min(self.last_pick_row / self.row_count, 1) * 100, 1)
+                if self.row_count
+                else None
+            ),
+            "uploaded": self.uploaded.isoformat() if self.uploaded else None,
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+        }
+
+        if self.status == "file_completed" and self.results_file:
+            job["results_download_link"] = self.generate_results_download_link(
+                download_link_expiration
+            )
+
+        return job
+
     def __repr__(self):
         """Return a string representation of the batch job.
 
@@ -206,6 +358,315 @@ class BatchJobs(db.Model):
         return self.uid
 
 
+class WebhookEndpoints(db.Model):
+    """Table for the account-level webhook settings of users.
+
+    Attributes:
+        id: Primary key.
+        user_id: Foreign key to the Users table, one row per user.
+        url: URL notified when any batch job of the user completes, or None
+            to only notify the callback URLs given with each job.
+        secret: Secret used to sign the notifications of the user.
+        first_job_id: Jobs with a greater ID are notified at the account URL,
+            so that registering doesn't notify the jobs completed before.
+        created_at: When the settings were created.
+    """
+
+    __tablename__ = "WebhookEndpoints"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("Users.id"), unique=True)
+    user = db.relationship("Users", backref=db.backref("webhook", uselist=False))
+    url = db.Column(db.String(2048), nullable=True)
+    secret = db.Column(db.String(64), nullable=False)
+    first_job_id = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(), nullable=False, default=naive_app_now)
+
+    @classmethod
+    def for_user(cls, user):
+        """Get the webhook settings of a user, creating them with a new secret.
+
+        Args:
+            user: The Users object.
+
+        Returns:
+            tuple: The WebhookEndpoints object, and whether it was just created.
+        """
+        endpoint = cls.query.filter_by(user_id=user.id).first()
+        if endpoint:
+            return endpoint, False
+
+        endpoint = cls(user=user, secret=generate_webhook_secret())
+        db.session.add(endpoint)
+        return endpoint, True
+
+
+class WebhookDeliveries(db.Model):
+    """Table for the completion notifications of batch jobs and their delivery log.
+
+    Attributes:
+        id: Primary key.
+        job_id: Foreign key to the BatchJobs table, one notification per job.
+        user_id: Foreign key to the Users table.
+        url: URL the notification is sent to.
+        status: 'scheduled' until the job completes, then 'pending' until it is
+            'delivered', or 'failed' after the last attempt.
+        attempts: Number of delivery attempts so far.
+        next_attempt_at: When the next attempt is due.
+        last_status_code: HTTP status code of the last attempt, if any.
+        last_error: Error of the last failed attempt. Every attempt is logged
+            in WebhookDeliveryAttempts.
+        created_at: When the notification was created.
+        delivered_at: When the notification was delivered.
+    """
+
+    __tablename__ = "WebhookDeliveries"
+    __table_args__ = (
+        db.Index(
+            "ix_WebhookDeliveries_status_next_attempt_at", "status", "next_attempt_at"
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey("BatchJobs.id"), unique=True)
+    job = db.relationship(
+        "BatchJobs", backref=db.backref("webhook_delivery", uselist=False)
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("Users.id"))
+    url = db.Column(db.String(2048), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="scheduled")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(), nullable=True)
+    last_status_code = db.Column(db.Integer, nullable=True)
+    last_error = db.Column(db.String(), nullable=True)
+    created_at = db.Column(db.DateTime(), nullable=False, default=naive_app_now)
+    delivered_at = db.Column(db.DateTime(), nullable=True)
+
+    def to_api_dict(self):
+        """Get the delivery status as returned by the API.
+
+        Returns:
+            dict: The URL, status and attempts of the notification.
+        """
+        return {
+            "url": self.url,
+            "status": self.status,
+            "attempts": self.attempts,
+            "last_status_code": self.last_status_code,
+            "delivered_at": (
+                self.delivered_at.isoformat() if self.delivered_at else None
+            ),
+        }
+
+
+class WebhookDeliveryAttempts(db.Model):
+    """Table for the log of the delivery attempts of the notifications.
+
+    Attributes:
+        id: Primary key.
+        delivery_id: Foreign key to the WebhookDeliveries table.
+        attempted_at: When the attempt was made.
+        status_code: HTTP status code of the response, if any.
+        error: Why the attempt failed, None if it was delivered.
+    """
+
+    __tablename__ = "WebhookDeliveryAttempts"
+
+    id = db.Column(db.Integer, primary_key=True)
+    delivery_id = db.Column(
+        db.Integer, db.ForeignKey("WebhookDeliveries.id"), nullable=False, index=True
+    )
+    delivery = db.relationship(
+        "WebhookDeliveries",
+        backref=db.backref(
+            "attempt_log",
+            order_by="WebhookDeliveryAttempts.id",
+            lazy="dynamic",
+            cascade="all, delete-orphan",
+        ),
+    )
+    attempted_at = db.Column(db.DateTime(), nullable=False, default=naive_app_now)
+    status_code = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.String(), nullable=True)
+
+
+class StripeEvents(db.Model):
+    """Table for the verified Stripe webhook events and their processing.
+
+    Events are stored when Stripe delivers them, and processed in the
+    background. The Stripe event ID is the primary key, so redeliveries of
+    an event are not stored or processed again.
+
+    Attributes:
+        id: The Stripe event ID.
+        type: The Stripe event type, e.g. 'checkout.session.completed'.
+        payload: The event as delivered by Stripe, in JSON.
+        status: 'pending' until it is 'processed', or 'failed' after the last
+            attempt.
+        attempts: Number of processing attempts so far.
+        next_attempt_at: When the next attempt is due.
+        last_error: Error of the last failed attempt.
+        created_at: When the event was received.
+        processed_at: When the event was processed.
+    """
+
+    __tablename__ = "StripeEvents"
+    __table_args__ = (
+        db.Index("ix_StripeEvents_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    id = db.Column(db.String(255), primary_key=True)
+    type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(), nullable=True)
+    last_error = db.Column(db.String(), nullable=True)
+    created_at = db.Column(db.DateTime(), nullable=False, default=naive_app_now)
+    processed_at = db.Column(db.DateTime(), nullable=True)
+
+
+class StripeCharges(db.Model):
+    """Table for the cached charge history of the Stripe customers.
+
+    The billing page reads the charges from here instead of the Stripe API.
+    Charges are saved from the charge webhook events, and the history of a
+    customer is refreshed from the Stripe API in the background.
+
+    Attributes:
+        id: The Stripe charge ID.
+        customer_id: The Stripe customer ID.
+        amount: The amount in the smallest currency unit.
+        currency: The three-letter currency code.
+        description: The description of the charge.
+        status: The status of the charge, e.g. 'succeeded'.
+        receipt_url: URL of the receipt of the charge.
+        created: Unix time when the charge was created.
+    """
+
+    __tablename__ = "StripeCharges"
+
+    id = db.Column(db.String(255), primary_key=True)
+    customer_id = db.Column(db.String(50), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(10), nullable=False)
+    description = db.Column(db.String(), nullable=True)
+    status = db.Column(db.String(20), nullable=False)
+    receipt_url = db.Column(db.String(2048), nullable=True)
+    created = db.Column(db.Integer, nullable=False)
+
+
+class StripeChargeHistories(db.Model):
+    """Table for the freshness of the cached charge history of each customer.
+
+    Attributes:
+        customer_id: The Stripe customer ID.
+        refreshed_at: When the history was last read from the Stripe API,
+            None if it needs to be read again.
+    """
+
+    __tablename__ = "StripeChargeHistories"
+
+    customer_id = db.Column(db.String(50), primary_key=True)
+    refreshed_at = db.Column(db.DateTime(), nullable=True)
+
+
+class CreditLeases(db.Model):
+    """Table for the blocks of credits reserved by the app processes.
+
+    Each app process reserves a block of credits of a busy API user at a
+    time and spends it in memory, instead of locking the user's row for
+    every validation. A lease doesn't change the balance, the spent credits
+    are CreditLedger entries referencing it, so its unspent credits are its
+    credits plus the amounts of its entries.
+
+    Attributes:
+        id: Primary key.
+        token: Unique random token of the lease, referenced by its ledger
+            entries. Unlike the ID, it is never reused after the lease is
+            deleted.
+        user_id: Foreign key to the Users table.
+        holder: The host and process ID of the app process holding the lease.
+        credits: Credits reserved by the lease.
+        expires_at: When the lease may be deleted by other processes if the
+            holder doesn't renew it.
+        created_at: When the lease was created.
+    """
+
+    __tablename__ = "CreditLeases"
+    __table_args__ = (db.UniqueConstraint("user_id", "holder"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(
+        db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4())
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("Users.id"), index=True)
+    holder = db.Column(db.String(255), nullable=False)
+    credits = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime(), nullable=False, index=True)
+    created_at = db.Column(db.DateTime(), nullable=False, default=naive_app_now)
+
+
+class CreditLedger(db.Model):
+    """Table for the changes of the credits of the users.
+
+    Every purchase and spend of credits is appended here instead of updating
+    the user's row. The entries are periodically compacted: their amounts
+    are added to Users.credits, the cached balance, and they are marked as
+    compacted. The balance of a user is Users.credits plus the amounts of
+    the entries not compacted yet.
+
+    Attributes:
+        id: Primary key.
+        user_id: Foreign key to the Users table.
+        amount: The number of credits, negative when they are spent.
+        source: Where the change comes from, e.g. "api", "web" or "purchase".
+        reference: The API key, job UID or payment of the change.
+        lease_token: Foreign key to the token of the CreditLeases row the
+            credits were spent from, cleared when the lease is deleted.
+        compacted: Whether the amount is included in Users.credits.
+        created_at: When the change was made.
+    """
+
+    __tablename__ = "CreditLedger"
+    __table_args__ = (
+        db.Index("ix_CreditLedger_user_id_compacted", "user_id", "compacted"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("Users.id"), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(20), nullable=False)
+    reference = db.Column(db.String(255))
+    lease_token = db.Column(
+        db.String(36),
+        db.ForeignKey("CreditLeases.token", ondelete="SET NULL"),
+        index=True,
+    )
+    compacted = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    created_at = db.Column(db.DateTime(), nullable=False, default=naive_app_now)
+
+
+class CachedValidationResults(db.Model):
+    """Table for recent validation results shared by all app processes.
+
+    Used by the database backend of the validation result cache.
+
+    Attributes:
+        id: Primary key.
+        email: Normalized email address the result is for.
+        result: The validation result returned by the worker.
+        expires_at: UTC time after which the result is not served anymore.
+    """
+
+    __tablename__ = "CachedValidationResults"
+
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(320), unique=True, nullable=False)
+    result = db.Column(db.JSON, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
 class Tiers(db.Model):
     """Table for subscription tiers.
 
@@ -475,20 +936,31 @@ class Users(db.Model, UserMixin):
         """
         return int(user_folder_size(self) / (500 * 1024 * 1024) * 100)
 
-    def add_credits(self, amount):
-        """Add validation credits to the user's account.
+    @property
+    def credit_balance(self):
+        """Get the exact credit balance of the user.
 
-        Args:
-            amount: The number of credits to add.
+        Returns:
+            int: The cached balance plus the credit changes not compacted yet.
         """
-        self.credits += amount
-        self.save()
+        from app.utilities.credit_ledger import credit_ledger
+
+        return credit_ledger.balance(self.id)
+
+    def add_credits(self, amount, source="purchase", reference=None):
+        """Add validation credits to the user's account.
 
-    def deduct_credits(self, amount):
-        """Deduct validation credits from the user's account.
+        The credits are appended to the credit ledger.
 
         Args:
-            amount: The number of credits to deduct.
+            amount: The number of credits to add.
+            source: Where the credits come from.
+            reference: The payment of the credits, if any.
+
+        Returns:
+            int: The new balance.
         """
-        self.credits -= amount
-        self.save()
+        from app.utilities.credit_ledger import credit_ledger
+
+        credit_ledger.record(self.id, amount, source, reference)
+        return credit_ledger.balance(self.id)
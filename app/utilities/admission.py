@@ -0,0 +1,357 @@
+"""Admission control for the Mail List Shield application.
+
+This module limits how many validations wait on the workers at once in each
+app process. Requests beyond the limit wait in a short, bounded queue, and
+are turned away right away when the queue is full, instead of piling up
+until the gunicorn timeout.
+
+Requests are sorted into priority lanes by the caller's tier: paid
+customers, free accounts, and the anonymous demo form. The lanes share the
+worker capacity of the process, and part of it is reserved for paid
+customers. When requests of several lanes are waiting, freed slots go to
+the lanes in proportion to their weights, so that a burst of demo traffic
+can't crowd out paying customers.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+
+# Lanes of the validation requests
+PAID_LANE = "paid"  # Users on a paid tier
+FREE_LANE = "free"  # Users on the free tier
+DEMO_LANE = "demo"  # Anonymous users of the demo form
+
+# Name of the tier whose users are not paying customers
+FREE_TIER = "free"
+
+
+def lane_for_user(user):
+    """Get the admission lane of a caller from their tier.
+
+    Args:
+        user: The Users object of the caller, or None if anonymous.
+
+    Returns:
+        str: The name of the lane.
+    """
+    if user is None or not user.is_authenticated:
+        return DEMO_LANE
+    if user.tier is None or user.tier.name == FREE_TIER:
+        return FREE_LANE
+    return PAID_LANE
+
+
+class ValidationOverloaded(Exception):
+    """Raised when a validation is turned away because its lane is full.
+
+    Attributes:
+        retry_after: Seconds after which the client may retry.
+    """
+
+    def __init__(self, message, retry_after):
+        """Initialize the exception.
+
+        Args:
+            message: The error message.
+            retry_after: Seconds after which the client may retry.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionLane:
+    """The wait queue and the counters of one priority lane.
+
+    Attributes:
+        name: The name of the lane.
+        weight: Share of the freed slots the lane gets when others wait too.
+        concurrency: Maximum number of admitted requests of the lane at a time.
+        queue_size: Maximum number of requests waiting to be admitted.
+        in_flight: Number of admitted requests.
+        waiting: The tickets of the waiting requests, oldest first.
+        max_queued: Highest number of waiting requests seen.
+        admitted: Total number of admitted requests.
+        rejected: Total number of requests turned away.
+    """
+
+    def __init__(self, name, weight, concurrency, queue_size):
+        """Initialize an empty lane.
+
+        Args:
+            name: The name of the lane.
+            weight: Share of the freed slots the lane gets when others wait too.
+            concurrency: Maximum number of admitted requests of the lane.
+            queue_size: Maximum number of requests waiting to be admitted.
+        """
+        self.name = name
+        self.weight = weight
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.waiting = deque()
+        self.max_queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        # Smooth weighted round robin state
+        self.current_weight = 0
+
+    def stats(self):
+        """Get the load and the counters of the lane.
+
+        Returns:
+            dict: The settings, the current load, and the counters.
+        """
+        return {
+            "weight": self.weight,
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queued": len(self.waiting),
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class _Ticket:
+    """A request waiting in a lane, marked once it gets a slot."""
+
+    __slots__ = ("admitted",)
+
+    def __init__(self):
+        self.admitted = False
+
+
+class AdmissionController:
+    """Weighted priority scheduling of the validations of this process.
+
+    Attributes:
+        capacity: Maximum number of admitted requests of all lanes at a time.
+        paid_reserved: Slots of the capacity only the paid lane may use.
+        queue_timeout: Seconds a request may wait in its lane's queue.
+        retry_after: Seconds the clients turned away are asked to wait.
+        lanes: The AdmissionLane objects by name.
+    """
+
+    def __init__(self):
+        """Initialize the lanes with the default settings."""
+        self._condition = Condition()
+        self.configure(
+            capacity=64,
+            paid_reserved=16,
+            weights={PAID_LANE: 6, FREE_LANE: 3, DEMO_LANE: 1},
+            demo_concurrency=8,
+            api_queue_size=128,
+            demo_queue_size=16,
+            queue_timeout=5.0,
+            retry_after=5,
+        )
+
+    def init_app(self, app):
+        """Size the lanes from the application configuration.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.configure(
+            capacity=app.config["MLS_ADMISSION_CONCURRENCY"],
+            paid_reserved=app.config["MLS_ADMISSION_PAID_RESERVED"],
+            weights=app.config["MLS_ADMISSION_WEIGHTS"],
+            demo_concurrency=app.config["MLS_ADMISSION_DEMO_CONCURRENCY"],
+            api_queue_size=app.config["MLS_ADMISSION_API_QUEUE"],
+            demo_queue_size=app.config["MLS_ADMISSION_DEMO_QUEUE"],
+            queue_timeout=app.config["MLS_ADMISSION_QUEUE_TIMEOUT"],
+            retry_after=app.config["MLS_ADMISSION_RETRY_AFTER"],
+        )
+
+    def configure(
+        self,
+        capacity,
+        paid_reserved,
+        weights,
+        demo_concurrency,
+        api_queue_size,
+        demo_queue_size,
+        queue_timeout,
+        retry_after,
+    ):
+        """Replace the lanes with empty ones sized from the settings.
+
+        Args:
+            capacity: Maximum number of admitted requests of all lanes.
+            paid_reserved: Slots of the capacity only the paid lane may use.
+            weights: The weight of each lane by name, lanes left out get 1.
+            demo_concurrency: Maximum number of admitted demo requests.
+            api_queue_size: Queue size of the paid and the free lanes.
+            demo_queue_size: Queue size of the demo lane.
+            queue_timeout: Seconds a request may wait in its lane's queue.
+            retry_after: Seconds the clients turned away are asked to wait.
+        """
+        with self._condition:
+            self.capacity = capacity
+            self.paid_reserved = min(paid_reserved, capacity)
+            self.queue_timeout = queue_timeout
+            self.retry_after = retry_after
+            self.lanes = {
+                PAID_LANE: AdmissionLane(
+                    PAID_LANE, weights.get(PAID_LANE, 1), capacity, api_queue_size
+                ),
+                FREE_LANE: AdmissionLane(
+                    FREE_LANE, weights.get(FREE_LANE, 1), capacity, api_queue_size
+                ),
+                DEMO_LANE: AdmissionLane(
+                    DEMO_LANE,
+                    weights.get(DEMO_LANE, 1),
+                    demo_concurrency,
+                    demo_queue_size,
+                ),
+            }
+
+    def acquire(self, lane, timeout):
+        """Wait for a slot for a request of a lane.
+
+        Args:
+            lane: The name of the lane.
+            timeout: Seconds to wait in the queue.
+
+        Returns:
+            bool: True if admitted, False if the queue is full or the wait
+                timed out.
+        """
+        with self._condition:
+            admission_lane = self.lanes[lane]
+
+            if len(admission_lane.waiting) >= admission_lane.queue_size and (
+                admission_lane.waiting or not self._has_room(admission_lane)
+            ):
+                admission_lane.rejected += 1
+                return False
+
+            ticket = _Ticket()
+            admission_lane.waiting.append(ticket)
+            admission_lane.max_queued = max(
+                admission_lane.max_queued, len(admission_lane.waiting)
+            )
+            self._dispatch()
+
+            if not ticket.admitted and timeout > 0:
+                self._condition.wait_for(lambda: ticket.admitted, timeout)
+
+            if not ticket.admitted:
+                admission_lane.waiting.remove(ticket)
+                admission_lane.rejected += 1
+                return False
+
+            return True
+
+    def release(self, lane):
+        """Free the slot of an admitted request and hand it to a waiting one.
+
+        Args:
+            lane: The name of the lane of the admitted request.
+        """
+        with self._condition:
+            admission_lane = self.lanes[lane]
+            admission_lane.in_flight = max(0, admission_lane.in_flight - 1)
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, lane, timeout=None):
+        """Hold a slot of a lane while the block runs.
+
+        Args:
+            lane: The name of the lane.
+            timeout: Seconds to wait in the queue at most. The wait is also
+                capped at MLS_ADMISSION_QUEUE_TIMEOUT.
+
+        Raises:
+            ValidationOverloaded: If the lane is full.
+        """
+        timeout = (
+            self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        )
+
+        if not self.acquire(lane, timeout):
+            raise ValidationOverloaded(
+                f"The {lane} validation lane is full.", self.retry_after
+            )
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self):
+        """Get the load of the process and the counters of each lane.
+
+        Returns:
+            dict: The capacity, the reserved slots, the admitted requests of
+                all lanes, and the statistics of each lane by name.
+        """
+        with self._condition:
+            return {
+                "capacity": self.capacity,
+                "paid_reserved": self.paid_reserved,
+                "in_flight": sum(lane.in_flight for lane in self.lanes.values()),
+                "lanes": {name: lane.stats() for name, lane in self.lanes.items()},
+            }
+
+    def _has_room(self, lane):
+        """Check whether a request of a lane could be admitted now.
+
+        Must be called with the lock held.
+
+        Args:
+            lane: The AdmissionLane of the request.
+
+        Returns:
+            bool: True if there is a slot the lane may use.
+        """
+        if lane.in_flight >= lane.concurrency:
+            return False
+
+        in_flight = sum(other.in_flight for other in self.lanes.values())
+        if lane.name != PAID_LANE:
+            # The reserved slots are left for the paid lane
+            return (
+                in_flight - self.lanes[PAID_LANE].in_flight
+                < self.capacity - self.paid_reserved
+                and in_flight < self.capacity
+            )
+        return in_flight < self.capacity
+
+    def _dispatch(self):
+        """Hand the free slots to the waiting requests.
+
+        The lane is picked with smooth weighted round robin among the lanes
+        with waiting requests that may use a slot, and the oldest request of
+        the lane is admitted. Must be called with the lock held.
+        """
+        granted = False
+
+        while True:
+            ready = [
+                lane
+                for lane in self.lanes.values()
+                if lane.waiting and self._has_room(lane)
+            ]
+            if not ready:
+                break
+
+            total_weight = sum(lane.weight for lane in ready)
+            for lane in ready:
+                lane.current_weight += lane.weight
+            chosen = max(ready, key=lambda lane: lane.current_weight)
+            chosen.current_weight -= total_weight
+
+            chosen.waiting.popleft().admitted = True
+            chosen.in_flight += 1
+            chosen.admitted += 1
+            granted = True
+
+        if granted:
+            self._condition.notify_all()
+
+
+# Shared by all requests handled by this process
+admission = AdmissionController()
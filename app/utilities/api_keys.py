@@ -0,0 +1,220 @@
+"""API key authentication utilities for the Mail List Shield application.
+
+This module keeps recently verified API keys in memory, so that repeated
+requests with the same key skip the slow hash check, and buffers the
+last used timestamps of keys so that authentication doesn't write to
+the database. Expired keys are deactivated in bulk in the background.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timezone
+from hashlib import sha256
+from threading import Lock
+
+from sqlalchemy import update
+
+from app import db
+from app.config import appTimezone
+from app.utilities.cache import TTLCache
+from app.utilities.background import start_periodic_task, run_at_exit
+from app.utilities.helpers import naive_app_now
+
+# What we remember about a verified key, instead of the ORM object
+VerifiedKey = namedtuple("VerifiedKey", ["id", "user_id", "expires_at"])
+
+
+def api_key_digest(api_key):
+    """Get a fast digest of a plaintext API key to use as a cache key.
+
+    The plaintext key is never kept in memory after the request.
+
+    Args:
+        api_key: The plaintext API key.
+
+    Returns:
+        str: The hex SHA-256 digest of the key.
+    """
+    return sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class VerifiedKeyCache:
+    """Bounded LRU cache of API keys that recently passed the hash check.
+
+    Entries expire after a short time to live, or earlier if the key itself
+    expires. The cache only saves the hash check: the key is still checked to
+    be active on every request, so a key revoked by another process is
+    rejected right away.
+    """
+
+    def __init__(self):
+        """Initialize the cache with the default size and time to live."""
+        self.cache = TTLCache(maxsize=10000, ttl=60)
+
+    def init_app(self, app):
+        """Size the cache from the application configuration.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.cache.configure(
+            maxsize=app.config["API_KEY_CACHE_SIZE"],
+            ttl=app.config["API_KEY_CACHE_TTL"],
+        )
+
+    def get(self, api_key):
+        """Get the verified key matching a plaintext API key.
+
+        Args:
+            api_key: The plaintext API key presented by the client.
+
+        Returns:
+            VerifiedKey: The cached key, or None if it is not cached or expired.
+        """
+        digest = api_key_digest(api_key)
+        verified_key = self.cache.get(digest)
+
+        if verified_key and verified_key.expires_at:
+            if verified_key.expires_at <= naive_app_now():
+                self.cache.delete(digest)
+                return None
+
+        return verified_key
+
+    def add(self, api_key, key):
+        """Remember that a plaintext API key matched an active key.
+
+        Args:
+            api_key: The plaintext API key presented by the client.
+            key: The APIKeys object it matched.
+
+        Returns:
+            VerifiedKey: The cached key.
+        """
+        verified_key = VerifiedKey(key.id, key.user_id, key.expires_at)
+
+        # Do not keep the key in the cache past its expiration
+        ttl = self.cache.ttl
+        if key.expires_at:
+            until_expiry = key.expires_at - naive_app_now()
+            ttl = min(ttl, until_expiry.total_seconds())
+
+        self.cache.set(api_key_digest(api_key), verified_key, ttl=ttl)
+        return verified_key
+
+    def forget(self, key_id):
+        """Remove the cached entries of a key, e.g. when it is revoked.
+
+        Args:
+            key_id: The ID of the APIKeys row.
+        """
+        self.cache.delete_where(lambda _, verified_key: verified_key.id == key_id)
+
+    def stats(self):
+        """Get the size and the hit/miss counters of the cache.
+
+        Returns:
+            dict: The cache statistics.
+        """
+        return self.cache.stats()
+
+
+class LastUsedBuffer:
+    """Write-behind buffer for the last_used timestamps of API keys.
+
+    Requests only record the time in memory. The latest time of each key is
+    written in one bulk UPDATE every few seconds and when the process exits.
+    """
+
+    def __init__(self):
+        """Initialize an empty buffer."""
+        self._pending = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Start flushing the buffer periodically and at shutdown.
+
+        Args:
+            app: The Flask application instance.
+        """
+        start_periodic_task(
+            app,
+            "api-key-last-used-flush",
+            app.config["API_KEY_LAST_USED_FLUSH_INTERVAL"],
+            self.flush,
+        )
+        run_at_exit(app, "api-key-last-used-flush", self.flush)
+
+    def touch(self, key_id):
+        """Record that an API key is used now.
+
+        Args:
+            key_id: The ID of the APIKeys row.
+        """
+        now = datetime.now(timezone.utc).astimezone(appTimezone)
+        with self._lock:
+            self._pending[key_id] = now
+
+    def flush(self):
+        """Write the buffered timestamps to the database in one bulk UPDATE.
+
+        Returns:
+            int: The number of keys updated.
+        """
+        from app.models import APIKeys
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        try:
+            db.session.execute(
+                update(APIKeys),
+                [{"id": key_id, "last_used": t} for key_id, t in pending.items()],
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+            # Put the timestamps back unless the key was used again since
+            with self._lock:
+                for key_id, t in pending.items():
+                    self._pending.setdefault(key_id, t)
+            raise
+
+        return len(pending)
+
+
+def deactivate_expired_keys():
+    """Deactivate the active API keys that are past their expiration date.
+
+    This keeps the set of active keys small. Expired keys are rejected by the
+    lookup query even before they are deactivated.
+
+    Returns:
+        int: The number of keys deactivated.
+    """
+    from app.models import APIKeys
+
+    result = db.session.execute(
+        update(APIKeys)
+        .where(APIKeys.is_active == True, APIKeys.expires_at <= naive_app_now())
+        .values(is_active=False)
+        .returning(APIKeys.id)
+    )
+    key_ids = result.scalars().all()
+    db.session.commit()
+
+    for key_id in key_ids:
+        verified_api_keys.forget(key_id)
+
+    if key_ids:
+        print(f"Deactivated {len(key_ids)} expired API keys.")
+
+    return len(key_ids)
+
+
+# Shared by all requests handled by this process
+verified_api_keys = VerifiedKeyCache()
+last_used_buffer = LastUsedBuffer()
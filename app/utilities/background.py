@@ -0,0 +1,90 @@
+"""Background task utilities for the Mail List Shield application.
+
+This module runs periodic maintenance functions in daemon threads of the
+app process and at process shutdown. With the gevent worker class, the
+threads are cooperative greenlets.
+"""
+
+import atexit
+import time
+from threading import Thread
+
+# Periodic tasks started in this process, by name
+_periodic_tasks = {}
+
+
+def start_periodic_task(app, name, interval, func):
+    """Call a function every few seconds in a background thread.
+
+    The function runs inside an application context. Exceptions are printed
+    and do not stop the task. Each task name is started once per process.
+
+    Args:
+        app: The Flask application instance.
+        name: A unique name for the task.
+        interval: Number of seconds to wait between two calls.
+        func: The function to call without arguments.
+    """
+    if not app.config["BACKGROUND_TASKS_ENABLED"] or name in _periodic_tasks:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    func()
+                except Exception as e:
+                    print(f"Error in the background task {name}: {e}")
+
+    thread = Thread(target=run, name=name, daemon=True)
+    _periodic_tasks[name] = thread
+    thread.start()
+
+
+def run_at_exit(app, name, func):
+    """Call a function inside an application context when the process exits.
+
+    Args:
+        app: The Flask application instance.
+        name: A name for the function used in error messages.
+        func: The function to call without arguments.
+    """
+    if not app.config["BACKGROUND_TASKS_ENABLED"]:
+        return
+
+    def run():
+        with app.app_context():
+            try:
+                func()
+            except Exception as e:
+                print(f"Error in the shutdown task {name}: {e}")
+
+    atexit.register(run)
+
+
+def run_in_background(app, name, func):
+    """Call a function once in a background thread.
+
+    The function runs inside an application context. Exceptions are printed.
+
+    Args:
+        app: The Flask application instance.
+        name: A name for the function used in error messages.
+        func: The function to call without arguments.
+
+    Returns:
+        bool: Whether the function was started.
+    """
+    if not app.config["BACKGROUND_TASKS_ENABLED"]:
+        return False
+
+    def run():
+        with app.app_context():
+            try:
+                func()
+            except Exception as e:
+                print(f"Error in the background task {name}: {e}")
+
+    Thread(target=run, name=name, daemon=True).start()
+    return True
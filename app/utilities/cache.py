@@ -0,0 +1,167 @@
+"""In-process caching utilities for the Mail List Shield application.
+
+This module provides a bounded, thread-safe LRU cache with per-entry
+expiration that is shared by the greenlets or threads of a process.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TTLCache:
+    """A bounded least-recently-used cache whose entries expire.
+
+    Entries are evicted when they expire or, when the cache is full, in
+    least-recently-used order. Hits and misses are counted for metrics.
+
+    Attributes:
+        maxsize: Maximum number of entries kept in the cache.
+        ttl: Default time to live of an entry in seconds.
+        hits: Number of lookups that found a live entry.
+        misses: Number of lookups that did not find a live entry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        """Initialize an empty cache.
+
+        Args:
+            maxsize: Maximum number of entries kept in the cache.
+            ttl: Default time to live of an entry in seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, maxsize=None, ttl=None):
+        """Change the size limit or the default time to live of the cache.
+
+        Args:
+            maxsize: New maximum number of entries, if given.
+            ttl: New default time to live in seconds, if given.
+        """
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict_overflow()
+
+    def get(self, key, default=None):
+        """Get a live entry from the cache.
+
+        Args:
+            key: The key of the entry.
+            default: The value to return if there is no live entry.
+
+        Returns:
+            The cached value, or the default if the entry is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Get a live entry without counting the lookup or refreshing its recency.
+
+        Args:
+            key: The key of the entry.
+            default: The value to return if there is no live entry.
+
+        Returns:
+            The cached value, or the default if the entry is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Add or replace an entry in the cache.
+
+        Args:
+            key: The key of the entry.
+            value: The value to cache.
+            ttl: Time to live of this entry in seconds. Defaults to the cache's ttl.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            self._evict_overflow()
+
+    def delete(self, key):
+        """Remove an entry from the cache if it exists.
+
+        Args:
+            key: The key of the entry.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Remove every entry for which the predicate returns True.
+
+        Args:
+            predicate: A function that receives (key, value) and returns a bool.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock:
+            keys = [k for k, (_, v) in self._entries.items() if predicate(k, v)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get the size and the hit/miss counters of the cache.
+
+        Returns:
+            dict: The current size, size limit, hits, misses, and hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def __len__(self):
+        """Return the number of entries, including expired ones not yet evicted."""
+        return len(self._entries)
+
+    def _evict_overflow(self):
+        """Evict the least recently used entries until the cache fits its size.
+
+        Must be called with the lock held.
+        """
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
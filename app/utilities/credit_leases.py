@@ -0,0 +1,394 @@
+"""Credit leases for the Mail List Shield application.
+
+Checking the balance of a user for every validation takes a lock on the
+user's row, which becomes a hotspot for busy API users. Instead, each app
+process reserves a block of the user's credits at a time in a CreditLeases
+row, and spends it in memory, appending the spent credits to the credit
+ledger. Only the reservations lock the user's row.
+
+A lease is an allowance, it doesn't change the balance: the credits leave
+the balance when they are spent, as ledger entries referencing the lease.
+The unspent credits of a lease are its reserved credits plus its entries,
+and reservations only get credits that are not leased already, so spending
+from the leases can't overdraw an account. A reservation takes at most a
+share of the credits that are not leased, so the other processes of a
+user whose balance runs low still get some. When a lease expires or the
+process exits, its row is deleted and its unspent credits are free to be
+reserved again. If a process dies, another process deletes its leases once
+they are past their expiry by one more lease period.
+
+The leases are written on connections of their own rather than the session
+of the request, so reserving credits never commits or rolls back the
+request's changes.
+"""
+
+from datetime import timedelta
+from threading import Lock
+import os
+import socket
+import time
+import uuid
+
+from sqlalchemy import delete, func, insert, update
+
+from app import db
+from app.utilities.admission import ValidationOverloaded
+from app.utilities.background import start_periodic_task, run_at_exit
+from app.utilities.credit_ledger import credit_ledger
+from app.utilities.helpers import naive_app_now
+
+# A reservation takes at most 1/LEASE_SHARE of the credits that are not leased
+LEASE_SHARE = 2
+
+
+class CreditsLeased(ValidationOverloaded):
+    """Raised when a user has enough credits, but other processes lease them.
+
+    The credits are freed when the leases are spent or released, so the
+    client may retry after the lease period.
+    """
+
+
+def lock_available_credits(connection, user_id):
+    """Lock the row of a user and get the credits that are not leased.
+
+    The lock is held until the end of the transaction, so the reservations
+    of a user are made one at a time.
+
+    Args:
+        connection: The connection of the transaction.
+        user_id: The ID of the user.
+
+    Returns:
+        tuple: The balance of the user, and the balance minus the unspent
+            credits of their leases.
+    """
+    from app.models import Users, CreditLeases, CreditLedger
+
+    connection.execute(
+        update(Users)
+        .where(Users.id == user_id)
+        .values(credits=Users.credits)
+        .execution_options(synchronize_session=False)
+    )
+
+    spent = (
+        db.select(func.coalesce(func.sum(CreditLedger.amount), 0))
+        .where(CreditLedger.lease_token == CreditLeases.token)
+        .scalar_subquery()
+    )
+    leased = connection.execute(
+        db.select(func.coalesce(func.sum(CreditLeases.credits + spent), 0)).where(
+            CreditLeases.user_id == user_id
+        )
+    ).scalar_one()
+
+    balance = credit_ledger.balance(user_id, connection)
+    return balance, balance - leased
+
+
+class _Lease:
+    """The in-memory state of a lease held by this process.
+
+    Attributes:
+        user_id: The ID of the user.
+        token: The token of the CreditLeases row, None until it is created.
+        remaining: Unspent credits of the lease.
+        expires_at: Monotonic time when the lease expires.
+        pending: Spends whose ledger entries are being written.
+        retired: Whether the lease was dropped, its row is deleted once
+            there are no pending spends.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.token = None
+        self.remaining = 0
+        self.expires_at = 0.0
+        self.pending = 0
+        self.retired = False
+
+
+class CreditLeasePool:
+    """The credit leases held by this process, one per active user.
+
+    Attributes:
+        block_size: Credits reserved at a time.
+        ttl: Seconds a lease lasts after its last reservation.
+        holder: The name of this process in the CreditLeases rows, its host
+            name and process ID.
+    """
+
+    def __init__(self):
+        """Initialize the pool with the default settings and no leases."""
+        self.block_size = 100
+        self.ttl = 60
+        self._leases = {}
+        self._user_locks = {}
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self.holder = f"{socket.gethostname()}:{self._pid}"
+
+    def init_app(self, app):
+        """Read the settings, and start releasing the expired leases.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.block_size = app.config["MLS_CREDIT_LEASE_SIZE"]
+        self.ttl = app.config["MLS_CREDIT_LEASE_TTL"]
+
+        start_periodic_task(
+            app,
+            "credit-lease-sync",
+            app.config["MLS_CREDIT_LEASE_SYNC_INTERVAL"],
+            self.sync,
+        )
+        run_at_exit(app, "credit-lease-release", self.release_all)
+
+    def consume(self, user, amount, source, reference=None):
+        """Spend credits of a user from the lease of this process.
+
+        The lease is topped up when it runs short, by a block of credits or
+        by a share of the credits that are not leased if that is smaller,
+        but at least by the missing credits. The spend is then appended to
+        the credit ledger.
+
+        Args:
+            user: The Users object.
+            amount: The number of credits to spend.
+            source: Where the spend comes from, e.g. "api" or "web".
+            reference: The API key or job UID of the spend.
+
+        Returns:
+            bool: Whether the credits were spent, False if the balance of the
+                user is too low.
+
+        Raises:
+            CreditsLeased: If the balance is high enough, but the credits are
+                leased by other processes.
+        """
+        with self._user_lock(user.id):
+            lease = self._leases.get(user.id)
+            if lease is not None and lease.expires_at <= time.monotonic():
+                self._retire(lease)
+                lease = None
+            if lease is None:
+                lease = _Lease(user.id)
+
+            balance = None
+            if lease.remaining < amount:
+                balance = self._top_up(lease, amount - lease.remaining)
+
+            if lease.token is not None:
+                with self._lock:
+                    self._leases[user.id] = lease
+
+            if lease.remaining < amount:
+                if balance < amount:
+                    return False
+                raise CreditsLeased(
+                    "The credits of the user are leased by other processes.",
+                    self.ttl,
+                )
+
+            lease.remaining -= amount
+            lease.pending += 1
+
+        try:
+            credit_ledger.record(user.id, -amount, source, reference, lease.token)
+        except Exception:
+            with self._user_lock(user.id):
+                lease.remaining += amount
+            raise
+        finally:
+            with self._user_lock(user.id):
+                lease.pending -= 1
+                if lease.retired and lease.pending == 0:
+                    self._delete(lease)
+
+        return True
+
+    def sync(self):
+        """Release the expired leases of this process and the abandoned ones.
+
+        This runs periodically in the background of each app process.
+
+        Returns:
+            int: The number of leases released.
+        """
+        with self._lock:
+            leases = list(self._leases.values())
+
+        released = 0
+        for lease in leases:
+            with self._user_lock(lease.user_id):
+                if not lease.retired and lease.expires_at <= time.monotonic():
+                    self._retire(lease)
+                    released += 1
+
+        return released + self.release_abandoned()
+
+    def release_abandoned(self):
+        """Delete the leases of processes that stopped renewing them.
+
+        Returns:
+            int: The number of leases deleted.
+        """
+        from app.models import CreditLeases
+
+        cutoff = naive_app_now() - timedelta(seconds=self.ttl)
+        with db.engine.begin() as connection:
+            return connection.execute(
+                delete(CreditLeases).where(
+                    CreditLeases.expires_at < cutoff,
+                    CreditLeases.holder != self.holder,
+                )
+            ).rowcount
+
+    def release_all(self):
+        """Release all the leases of this process.
+
+        Called when the process exits.
+
+        Returns:
+            int: The number of leases released.
+        """
+        with self._lock:
+            leases = list(self._leases.values())
+
+        for lease in leases:
+            with self._user_lock(lease.user_id):
+                self._retire(lease)
+
+        return len(leases)
+
+    def stats(self):
+        """Get the leases held by this process.
+
+        Returns:
+            dict: The number of leases and their unspent credits.
+        """
+        with self._lock:
+            return {
+                "leases": len(self._leases),
+                "credits": sum(lease.remaining for lease in self._leases.values()),
+            }
+
+    def _top_up(self, lease, needed):
+        """Reserve more credits of the user in a lease, and renew it.
+
+        A block of credits is reserved, or a share of the available credits
+        if that is smaller, but at least the needed credits.
+
+        Args:
+            lease: The _Lease, locked by the caller.
+            needed: The number of credits the lease is short of.
+
+        Returns:
+            int: The balance of the user. The lease is unchanged if fewer
+                credits than needed are available.
+        """
+        from app.models import CreditLeases
+
+        expires_at = naive_app_now() + timedelta(seconds=self.ttl)
+        with db.engine.begin() as connection:
+            balance, available = lock_available_credits(connection, lease.user_id)
+
+            # The unspent credits of a lease released as abandoned are gone
+            renewed = lease.token is not None and (
+                connection.execute(
+                    db.select(CreditLeases.id).where(CreditLeases.token == lease.token)
+                ).first()
+                is not None
+            )
+            if not renewed:
+                needed += lease.remaining
+
+            if available < needed:
+                return balance
+
+            amount = max(needed, min(self.block_size, available // LEASE_SHARE))
+            if renewed:
+                connection.execute(
+                    update(CreditLeases)
+                    .where(CreditLeases.token == lease.token)
+                    .values(
+                        credits=CreditLeases.credits + amount, expires_at=expires_at
+                    )
+                )
+            else:
+                # A new lease, or one that was released as abandoned
+                token = str(uuid.uuid4())
+                connection.execute(
+                    insert(CreditLeases).values(
+                        token=token,
+                        user_id=lease.user_id,
+                        holder=self.holder,
+                        credits=amount,
+                        expires_at=expires_at,
+                    )
+                )
+
+        if not renewed:
+            lease.remaining = 0
+            lease.token = token
+
+        lease.remaining += amount
+        lease.expires_at = time.monotonic() + self.ttl
+        return balance
+
+    def _retire(self, lease):
+        """Drop a lease, and delete its row unless spends are being written.
+
+        Args:
+            lease: The _Lease, locked by the caller.
+        """
+        lease.retired = True
+        with self._lock:
+            if self._leases.get(lease.user_id) is lease:
+                del self._leases[lease.user_id]
+
+        if lease.pending == 0:
+            self._delete(lease)
+
+    def _delete(self, lease):
+        """Delete the row of a lease, which frees its unspent credits.
+
+        Args:
+            lease: The _Lease, locked by the caller.
+        """
+        from app.models import CreditLeases
+
+        if lease.token is None:
+            return
+
+        with db.engine.begin() as connection:
+            connection.execute(
+                delete(CreditLeases).where(CreditLeases.token == lease.token)
+            )
+        lease.token = None
+
+    def _user_lock(self, user_id):
+        """Get the lock serializing the changes to the lease of a user.
+
+        Leases copied from the parent process after a fork are dropped
+        first, since the parent releases them.
+
+        Args:
+            user_id: The ID of the user.
+
+        Returns:
+            Lock: The lock of the user.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._leases = {}
+                self._user_locks = {}
+                self._pid = os.getpid()
+                self.holder = f"{socket.gethostname()}:{self._pid}"
+            return self._user_locks.setdefault(user_id, Lock())
+
+
+# Shared by all requests handled by this process
+credit_leases = CreditLeasePool()
@@ -0,0 +1,249 @@
+"""Credit ledger for the Mail List Shield application.
+
+Every change of a user's credits is appended to the CreditLedger table with
+its source and reference, instead of updating the user's row. Users.credits
+is a cached balance: a background compaction folds the ledger entries into
+it periodically. The exact balance is the cached balance plus the
+entries not compacted yet, read in one query.
+
+Concurrent requests append their entries through a group commit: the
+entries that arrive while a batch is being written are inserted together
+in the next batch, in one statement. Each request still waits until its
+entries are committed, so balances are never behind.
+"""
+
+from threading import Condition
+
+from sqlalchemy import func, insert, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.utilities.background import start_periodic_task
+
+# Sources of the ledger entries
+API_SOURCE = "api"  # Validations through the API
+WEB_SOURCE = "web"  # Validations through the web app
+PURCHASE_SOURCE = "purchase"  # Credits bought with Stripe
+
+
+class _Batch:
+    """Ledger entries written together in one insert."""
+
+    def __init__(self):
+        self.entries = []
+        self.done = False
+        self.error = None
+
+
+class CreditLedgerManager:
+    """Group commit writer, balance reader and compaction of the ledger."""
+
+    def __init__(self):
+        """Initialize the writer with no pending entries."""
+        self.compaction_batch_size = 5000
+        self.batches = 0
+        self.entries = 0
+        self._open = _Batch()
+        self._flushing = False
+        self._condition = Condition()
+
+    def init_app(self, app):
+        """Start compacting the ledger periodically.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.compaction_batch_size = app.config["MLS_CREDIT_LEDGER_COMPACTION_BATCH"]
+        start_periodic_task(
+            app,
+            "credit-ledger-compaction",
+            app.config["MLS_CREDIT_LEDGER_COMPACTION_INTERVAL"],
+            self.compact,
+        )
+
+    def record(self, user_id, amount, source, reference=None, lease_token=None):
+        """Append a credit change to the ledger and wait until it is committed.
+
+        Args:
+            user_id: The ID of the user.
+            amount: The number of credits, negative when they are spent.
+            source: Where the change comes from, e.g. "api" or "purchase".
+            reference: The API key, job UID or payment of the change.
+            lease_token: The token of the CreditLeases row the credits are
+                spent from, if any.
+
+        Raises:
+            Exception: If the batch of the entry couldn't be written.
+        """
+        entry = {
+            "user_id": user_id,
+            "amount": amount,
+            "source": source,
+            "reference": reference,
+            "lease_token": lease_token,
+        }
+
+        with self._condition:
+            batch = self._open
+            batch.entries.append(entry)
+
+            while not batch.done:
+                if self._flushing:
+                    self._condition.wait()
+                    continue
+
+                # Write the open batch, which holds every entry that arrived
+                # while the previous batch was being written
+                self._flushing = True
+                flushing, self._open = self._open, _Batch()
+                self._condition.release()
+                try:
+                    self._write(flushing)
+                finally:
+                    self._condition.acquire()
+                    flushing.done = True
+                    self._flushing = False
+                    self._condition.notify_all()
+
+        if batch.error is not None:
+            raise batch.error
+
+    def balance(self, user_id, connection=None):
+        """Get the exact balance of a user.
+
+        Args:
+            user_id: The ID of the user.
+            connection: The connection or session to read with, defaults to
+                the session of the request.
+
+        Returns:
+            int: The cached balance plus the entries not compacted yet.
+        """
+        from app.models import Users, CreditLedger
+
+        return (
+            (connection or db.session)
+            .execute(
+                db.select(
+                    Users.credits
+                    + db.select(func.coalesce(func.sum(CreditLedger.amount), 0))
+                    .where(
+                        CreditLedger.user_id == user_id,
+                        CreditLedger.compacted.is_(False),
+                    )
+                    .scalar_subquery()
+                ).where(Users.id == user_id)
+            )
+            .scalar_one()
+        )
+
+    def compact(self):
+        """Fold the oldest entries that are not compacted into the cached balances.
+
+        This runs periodically in the background of each app process. The
+        entries are marked conditionally, so two processes can't fold the
+        same entries.
+
+        Returns:
+            int: The number of entries compacted.
+        """
+        from app.models import Users, CreditLedger
+
+        try:
+            entries = db.session.execute(
+                db.select(CreditLedger.id, CreditLedger.user_id, CreditLedger.amount)
+                .where(CreditLedger.compacted.is_(False))
+                .order_by(CreditLedger.id)
+                .limit(self.compaction_batch_size)
+            ).all()
+            if not entries:
+                return 0
+
+            totals = {}
+            for _, user_id, amount in entries:
+                totals[user_id] = totals.get(user_id, 0) + amount
+
+            marked = db.session.execute(
+                update(CreditLedger)
+                .where(
+                    CreditLedger.id.in_([entry_id for entry_id, _, _ in entries]),
+                    CreditLedger.compacted.is_(False),
+                )
+                .values(compacted=True)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if marked != len(entries):
+                # Another process is compacting the same entries
+                db.session.rollback()
+                return 0
+
+            for user_id in sorted(totals):
+                db.session.execute(
+                    update(Users)
+                    .where(Users.id == user_id)
+                    .values(credits=Users.credits + totals[user_id])
+                    .execution_options(synchronize_session=False)
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return len(entries)
+
+    def stats(self):
+        """Get the counters of the group commit.
+
+        Returns:
+            dict: The number of batches and entries written by this process.
+        """
+        with self._condition:
+            return {"batches": self.batches, "entries": self.entries}
+
+    def _write(self, batch):
+        """Insert the entries of a batch in one statement on a connection of its own.
+
+        Args:
+            batch: The _Batch to write, marked with its error on failure.
+        """
+        from app.models import CreditLeases, CreditLedger
+
+        try:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(insert(CreditLedger), batch.entries)
+            except IntegrityError:
+                # A lease was deleted as abandoned while its spends were
+                # written, they are recorded as plain spends instead
+                tokens = {e["lease_token"] for e in batch.entries} - {None}
+                with db.engine.begin() as connection:
+                    live = set(
+                        connection.execute(
+                            db.select(CreditLeases.token).where(
+                                CreditLeases.token.in_(tokens)
+                            )
+                        ).scalars()
+                    )
+                    connection.execute(
+                        insert(CreditLedger),
+                        [
+                            {
+                                **e,
+                                "lease_token": (
+                                    e["lease_token"]
+                                    if e["lease_token"] in live
+                                    else None
+                                ),
+                            }
+                            for e in batch.entries
+                        ],
+                    )
+            self.batches += 1
+            self.entries += len(batch.entries)
+        except Exception as e:
+            print(f"Writing {len(batch.entries)} credit ledger entries failed: {e}")
+            batch.error = e
+
+
+# Shared by all requests handled by this process
+credit_ledger = CreditLedgerManager()
@@ -0,0 +1,164 @@
+"""Per-domain caching for the Mail List Shield application.
+
+This module remembers what validations learn about each email domain: its
+MX records from local DNS lookups, and the provider, catch-all and
+disposable classification from worker results. Later validations of
+addresses on the same domain skip the DNS lookup and pass the known
+classification to the workers as hints.
+"""
+
+from app.utilities.cache import TTLCache
+
+# Fields of a worker result that describe the domain rather than the address
+DOMAIN_FIELDS = (
+    "domain_age",
+    "email_provider",
+    "email_security_gateway",
+    "has_catch_all",
+    "has_mx_records",
+    "is_disposable",
+    "is_free_provider",
+    "smtp_provider_host",
+    "smtp_provider_host_domain",
+    "smtp_provider_host_tld",
+    "smtp_provider_ip",
+    "smtp_provider_ip_ptr",
+)
+
+# Domain fields sent to the workers so they can skip probing them again
+HINT_FIELDS = ("has_catch_all", "has_mx_records", "is_disposable")
+
+
+def domain_of(email):
+    """Get the domain of an email address as used for the cache keys.
+
+    Args:
+        email: The email address.
+
+    Returns:
+        str: The lowercased domain, or None if there is no @ in the address.
+    """
+    if "@" not in email:
+        return None
+    return email.strip().rsplit("@", 1)[1].lower()
+
+
+class DomainCache:
+    """Bounded LRU cache of what is known about each email domain.
+
+    Entries expire after a time to live, so that changes of DNS records or
+    catch-all configuration are picked up. Entries saying a domain has no MX
+    records expire sooner, since a DNS failure would otherwise reject every
+    address of the domain until the entry expires.
+    """
+
+    def __init__(self):
+        """Initialize the cache with the default size and times to live."""
+        self.cache = TTLCache(maxsize=10000, ttl=3600)
+        self.negative_ttl = 300
+
+    def init_app(self, app):
+        """Size the cache from the application configuration.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.cache.configure(
+            maxsize=app.config["MLS_DOMAIN_CACHE_SIZE"],
+            ttl=app.config["MLS_DOMAIN_CACHE_TTL"],
+        )
+        self.negative_ttl = app.config["MLS_DOMAIN_CACHE_NEGATIVE_TTL"]
+
+    def get(self, domain):
+        """Get what is known about a domain.
+
+        Args:
+            domain: The lowercased domain name.
+
+        Returns:
+            dict: The known domain fields, or None if the domain is not cached.
+        """
+        if not domain:
+            return None
+        return self.cache.get(domain)
+
+    def peek(self, domain):
+        """Get what is known about a domain without counting the lookup.
+
+        Args:
+            domain: The lowercased domain name.
+
+        Returns:
+            dict: The known domain fields, empty if nothing is known.
+        """
+        if not domain:
+            return {}
+        return self.cache.peek(domain, {})
+
+    def hints(self, domain):
+        """Get the known classification of a domain to pass to a worker.
+
+        Args:
+            domain: The lowercased domain name.
+
+        Returns:
+            dict: The known hint fields, empty if nothing is known.
+        """
+        return {k: v for k, v in self.peek(domain).items() if k in HINT_FIELDS}
+
+    def learn(self, domain, fields):
+        """Merge newly learned fields into the entry of a domain.
+
+        The entry's time to live starts over, with the shorter negative time
+        to live if the domain is known to have no MX records.
+
+        Args:
+            domain: The lowercased domain name.
+            fields: Domain fields, other keys and None values are ignored.
+        """
+        if not domain:
+            return
+
+        learned = {
+            k: v for k, v in fields.items() if k in DOMAIN_FIELDS and v is not None
+        }
+        if not learned:
+            return
+
+        entry = {**self.peek(domain), **learned}
+        ttl = self.negative_ttl if entry.get("has_mx_records") is False else None
+        self.cache.set(domain, entry, ttl=ttl)
+
+    def learn_from_result(self, email, result):
+        """Remember the domain fields of a worker result.
+
+        A single worker reporting no MX records isn't trusted for the whole
+        domain, that is only learned from our own DNS lookup.
+
+        Args:
+            email: The validated email address.
+            result: The validation result returned by a worker.
+        """
+        if result and result.get("status"):
+            fields = {
+                k: v
+                for k, v in result.items()
+                if not (k == "has_mx_records" and v is False)
+            }
+            self.learn(result.get("fqdn") or domain_of(email), fields)
+
+    def clear(self):
+        """Forget all domains and reset the counters."""
+        self.cache.clear()
+
+    def stats(self):
+        """Get the size and the hit/miss counters of the cache.
+
+        Returns:
+            dict: The cache statistics.
+        """
+        return self.cache.stats()
+
+
+# Shared by all requests handled by this process
+domain_cache = DomainCache()
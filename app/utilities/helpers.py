@@ -1,13 +1,21 @@
 """Helper utility functions for the Mail List Shield application.
 
 This module provides general-purpose helper functions including file size
-formatting, code generation, and API key generation.
+formatting, code generation, API key generation and hashing, and webhook
+secret generation.
 """
 
+from datetime import datetime
+from hashlib import sha256
 from random import randrange
+import hmac
+import re
+import secrets
 import uuid
 
-from app import bc
+from flask import current_app
+
+from app.config import appTimezone
 
 
 def readable_file_size(size_in_bytes, significant_digits=0):
@@ -43,6 +51,18 @@ def readable_file_size(size_in_bytes, significant_digits=0):
     return result
 
 
+def naive_app_now():
+    """Get the current time in the app timezone without timezone info.
+
+    Naive datetime columns that users set, like APIKeys.expires_at,
+    are compared against this.
+
+    Returns:
+        datetime: The current local time of the app.
+    """
+    return datetime.now(appTimezone).replace(tzinfo=None)
+
+
 def generate_n_digit_code(n):
     """Generate a random n-digit numeric code.
 
@@ -60,21 +80,89 @@ def generate_n_digit_code(n):
     return code
 
 
+# Marker at the start of API keys that carry a public lookup prefix
+API_KEY_TAG = "mls"
+
+# Length of the public lookup prefix stored in APIKeys.key_prefix
+API_KEY_PREFIX_LENGTH = 12
+
+# Keys issued before the prefixed format: two UUID4s in hex
+LEGACY_API_KEY_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Hashing schemes of API keys stored in APIKeys.hash_scheme
+API_KEY_HASH_BCRYPT = "bcrypt"
+API_KEY_HASH_HMAC = "hmac-sha256"
+
+
+def hash_api_key(api_key):
+    """Hash an API key with HMAC-SHA256 and the server-side pepper.
+
+    API keys are long random strings, so unlike passwords they don't need a
+    slow hash to resist guessing. The pepper keeps a leaked database from
+    being enough to check keys offline.
+
+    Args:
+        api_key: The plaintext API key.
+
+    Returns:
+        str: The 64 characters hex digest of the key.
+    """
+    pepper = current_app.config["API_KEY_PEPPER"].encode("utf-8")
+    return hmac.new(pepper, api_key.encode("utf-8"), sha256).hexdigest()
+
+
 def generate_api_key_and_hash():
-    """Generate a new API key and its bcrypt hash.
+    """Generate a new API key, its public prefix, and its HMAC hash.
 
-    Creates a 64-character random API key and hashes it for secure storage.
+    Keys are formatted as ``mls_<prefix>_<secret>``. The prefix is not secret,
+    it is stored in plain text so that the key can be found with an indexed
+    lookup instead of checking the hash of every active key.
 
     Returns:
-        tuple: A tuple containing (plaintext_key, hashed_key).
+        tuple: A tuple containing (plaintext_key, key_prefix, hashed_key).
             The plaintext key should be shown to the user once,
-            while the hash is stored in the database.
+            while the prefix and the hash are stored in the database.
     """
     # Generate a new random key
-    new_key = uuid.uuid4().hex + uuid.uuid4().hex  # 64 characters
+    key_prefix = uuid.uuid4().hex[:API_KEY_PREFIX_LENGTH]
+    secret = secrets.token_hex(24)  # 48 characters
+    new_key = f"{API_KEY_TAG}_{key_prefix}_{secret}"
 
     # Hash the key to be stored in the database
-    key_hash = bc.generate_password_hash(new_key).decode("utf8")
+    key_hash = hash_api_key(new_key)
 
     # Return the new plain key to be shown to the user once
-    return new_key, key_hash
+    return new_key, key_prefix, key_hash
+
+
+def api_key_prefix(api_key):
+    """Extract the public lookup prefix from a plaintext API key.
+
+    Keys issued before the prefixed format are 64 hex characters. For those,
+    the first characters of the key are used as the prefix, which is what
+    gets recorded for them once they are verified for the first time.
+
+    Args:
+        api_key: The plaintext API key.
+
+    Returns:
+        tuple: A tuple containing (prefix, is_legacy_key). The prefix is None
+            if the key is in neither format.
+    """
+    parts = api_key.split("_")
+    if len(parts) == 3 and parts[0] == API_KEY_TAG:
+        return parts[1], False
+
+    if LEGACY_API_KEY_PATTERN.fullmatch(api_key):
+        return api_key[:API_KEY_PREFIX_LENGTH], True
+
+    return None, False
+
+
+def generate_webhook_secret():
+    """Generate a secret for signing the webhook notifications of a user.
+
+    Returns:
+        str: The secret, with a prefix telling what it is.
+    """
+    return f"whsec_{secrets.token_hex(24)}"
@@ -4,7 +4,10 @@ This module provides functions for interacting with S3-compatible object storage
 including file uploads, downloads, deletions, and pre-signed URL generation.
 """
 
+import csv
+import io
 import json
+import uuid
 from botocore.exceptions import ClientError
 from datetime import datetime
 
@@ -288,6 +291,68 @@ def generate_upload_link_validation_file(user, file_type, file):
     )
 
 
+def api_validation_file_prefix(user):
+    """Get the key prefix of the validation files a user submits via the API.
+
+    The user ID in the key lets us check that a submitted file belongs to
+    the user who uploaded it.
+
+    Args:
+        user: The user object.
+
+    Returns:
+        str: The key prefix without the timestamp and file name.
+    """
+    return f"validation/uploaded/api-user-{user.id}/"
+
+
+def generate_upload_link_api_validation_file(user, file_type, file):
+    """Generate a pre-signed upload URL for a batch validation file sent via the API.
+
+    Args:
+        user: The user object.
+        file_type: The MIME type of the file being uploaded.
+        file: The original filename.
+
+    Returns:
+        str: JSON string containing upload data and preview URL.
+    """
+    return generate_upload_link(
+        current_app.config["S3_BUCKET_NAME"],
+        f"{api_validation_file_prefix(user)}{timestamp()}-{file}",
+        file_type,
+        s3,
+        600,  # Longer expiration to allow for slower uploads of large csv files
+    )
+
+
+def upload_api_validation_list(user, emails):
+    """Write a list of email addresses sent via the API as a batch validation file.
+
+    Args:
+        user: The user object.
+        emails: The email addresses, one per row under an "email" header.
+
+    Returns:
+        str: The key of the file in object storage.
+    """
+    content = io.StringIO()
+    writer = csv.writer(content)
+    writer.writerow(["email"])
+    writer.writerows([email] for email in emails)
+
+    file_name = f"{timestamp()}-{uuid.uuid4().hex[:8]}-api-list.csv"
+    folder_path = api_validation_file_prefix(user).rstrip("/")
+    generate_remote_file(
+        current_app.config["S3_BUCKET_NAME"],
+        folder_path,
+        file_name,
+        s3,
+        content.getvalue(),
+    )
+    return f"{folder_path}/{file_name}"
+
+
 def generate_user_folder(user):
     """Create a user's personal folder in object storage.
 
@@ -0,0 +1,265 @@
+"""Local pre-screening of email addresses for the Mail List Shield application.
+
+This module rejects addresses with an invalid syntax, and addresses whose
+domain can't receive emails, before any validation worker is asked. Whether
+a domain has MX records is kept in the domain cache. Rejections are returned
+in the same schema as the worker results.
+"""
+
+from threading import Lock
+import time
+
+import dns.exception
+import dns.name
+import dns.resolver
+import email_validator
+
+from app.utilities.domain_cache import domain_cache
+
+# Keys of a worker result, so that pre-screened results have the same schema
+WORKER_RESULT_FIELDS = (
+    "account",
+    "account_alias_stripped",
+    "domain",
+    "domain_age",
+    "email",
+    "email_alias_stripped",
+    "email_provider",
+    "email_security_gateway",
+    "fqdn",
+    "has_catch_all",
+    "has_mx_records",
+    "is_alias",
+    "is_disposable",
+    "is_free_provider",
+    "is_likely_spam_trap",
+    "is_mailbox_full",
+    "is_role",
+    "is_valid_syntax",
+    "smtp_provider_host",
+    "smtp_provider_host_domain",
+    "smtp_provider_host_tld",
+    "smtp_provider_ip",
+    "smtp_provider_ip_ptr",
+    "status",
+    "status_detail",
+    "subdomain",
+    "tld",
+)
+
+
+def invalid_result(email, status_detail, **fields):
+    """Build an invalid result in the worker result schema.
+
+    Fields that are not checked locally are None.
+
+    Args:
+        email: The email address as given.
+        status_detail: Why the address is invalid.
+        **fields: The fields known from the local checks.
+
+    Returns:
+        dict: The validation result.
+    """
+    result = dict.fromkeys(WORKER_RESULT_FIELDS)
+    result.update(fields)
+    result.update(email=email, status="invalid", status_detail=status_detail)
+    return result
+
+
+def domain_fields(fqdn):
+    """Split a domain name into the domain fields of a worker result.
+
+    Only the last label is treated as the top level domain.
+
+    Args:
+        fqdn: The domain part of an email address.
+
+    Returns:
+        dict: The fqdn, subdomain, domain and tld fields.
+    """
+    labels = fqdn.split(".")
+    return {
+        "fqdn": fqdn,
+        "subdomain": ".".join(labels[:-2]),
+        "domain": labels[-2] if len(labels) > 1 else labels[0],
+        "tld": labels[-1] if len(labels) > 1 else "",
+    }
+
+
+class Prescreen:
+    """Syntax and MX record checks run before asking the workers.
+
+    Attributes:
+        enabled: Whether addresses are pre-screened.
+        timeout: Seconds to wait for a DNS answer.
+    """
+
+    def __init__(self):
+        """Initialize the checks with the default settings."""
+        self.enabled = True
+        self.timeout = 2.0
+        self._lock = Lock()
+        self._reset_counters()
+
+    def init_app(self, app):
+        """Read the pre-screen settings from the application configuration.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.enabled = app.config["MLS_PRESCREEN_ENABLED"]
+        self.timeout = app.config["MLS_PRESCREEN_DNS_TIMEOUT"]
+
+    def check(self, email):
+        """Check an email address locally.
+
+        Args:
+            email: The email address to check.
+
+        Returns:
+            dict: An invalid result if the address fails a check, or None if
+                it has to be validated by a worker.
+        """
+        if not self.enabled:
+            return None
+
+        started = time.monotonic()
+        result = None
+        try:
+            result = self._check(email)
+            return result
+        finally:
+            self._record(time.monotonic() - started, result)
+
+    def has_mx_records(self, domain):
+        """Check whether a domain has MX records, using the domain cache.
+
+        The domain cache also learns it from worker results.
+
+        Args:
+            domain: The ASCII domain name.
+
+        Returns:
+            bool: Whether the domain has MX records, or None if DNS didn't
+                give a definitive answer.
+        """
+        known = domain_cache.get(domain) or {}
+        if known.get("has_mx_records") is not None:
+            return known["has_mx_records"]
+
+        has_mx = self.lookup_mx(domain)
+        domain_cache.learn(domain, {"has_mx_records": has_mx})
+        return has_mx
+
+    def lookup_mx(self, domain):
+        """Look up the MX records of a domain.
+
+        A null MX record (RFC 7505) counts as no MX records.
+
+        Args:
+            domain: The ASCII domain name.
+
+        Returns:
+            bool: Whether the domain has MX records, or None if DNS didn't
+                give a definitive answer.
+        """
+        try:
+            answer = dns.resolver.resolve(domain, "MX", lifetime=self.timeout)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return False
+        except dns.exception.DNSException as e:
+            print(f"MX lookup of {domain} failed: {e}")
+            return None
+
+        return any(record.exchange != dns.name.root for record in answer)
+
+    def stats(self):
+        """Get the counters and the latency of the pre-screen stage.
+
+        Returns:
+            dict: The number of checks, rejections by reason, and latencies.
+        """
+        with self._lock:
+            return {
+                "checks": self.checks,
+                "rejected_syntax": self.rejected_syntax,
+                "rejected_mx": self.rejected_mx,
+                "avg_latency_ms": (
+                    round(self.total_latency / self.checks * 1000, 2)
+                    if self.checks
+                    else None
+                ),
+                "max_latency_ms": round(self.max_latency * 1000, 2),
+            }
+
+    def reset(self):
+        """Reset the counters."""
+        with self._lock:
+            self._reset_counters()
+
+    def _check(self, email):
+        """Run the checks without recording metrics.
+
+        Args:
+            email: The email address to check.
+
+        Returns:
+            dict: An invalid result, or None if the address passes the checks.
+        """
+        try:
+            parsed = email_validator.validate_email(
+                email.strip(), check_deliverability=False
+            )
+        except email_validator.EmailNotValidError as e:
+            return invalid_result(
+                email,
+                f"invalid syntax: {e}",
+                is_valid_syntax=False,
+                has_mx_records=False,
+            )
+
+        if self.has_mx_records(parsed.ascii_domain) is False:
+            # Include what the domain cache knows about the domain
+            return invalid_result(
+                email,
+                "domain is not configured to receive emails",
+                **{
+                    **domain_cache.peek(parsed.ascii_domain),
+                    **domain_fields(parsed.ascii_domain),
+                    "account": parsed.local_part,
+                    "is_valid_syntax": True,
+                    "has_mx_records": False,
+                },
+            )
+
+        return None
+
+    def _record(self, latency, result):
+        """Update the counters after a check.
+
+        Args:
+            latency: Seconds the check took.
+            result: The result of the check.
+        """
+        with self._lock:
+            self.checks += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if result is not None:
+                if result["is_valid_syntax"]:
+                    self.rejected_mx += 1
+                else:
+                    self.rejected_syntax += 1
+
+    def _reset_counters(self):
+        """Set the counters to zero."""
+        self.checks = 0
+        self.rejected_syntax = 0
+        self.rejected_mx = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+
+# Shared by all requests handled by this process
+prescreen = Prescreen()
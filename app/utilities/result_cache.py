@@ -0,0 +1,275 @@
+"""Validation result caching for the Mail List Shield application.
+
+This module caches recent validation results by normalized email address,
+so that repeated validations of the same address within minutes don't send
+another SMTP probe to a worker. How long a result is kept depends on its
+status. Results are kept either in the memory of each process or in a
+database table shared by all processes.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from app import db
+from app.utilities.cache import TTLCache
+from app.utilities.background import start_periodic_task
+
+
+def normalize_email(email):
+    """Normalize an email address to use it as a cache key.
+
+    Args:
+        email: The email address as entered.
+
+    Returns:
+        str: The address without surrounding whitespace, in lowercase.
+    """
+    return email.strip().lower()
+
+
+class MemoryResultBackend:
+    """Keeps the results in a bounded LRU cache in the memory of this process."""
+
+    def __init__(self, maxsize):
+        """Initialize an empty cache.
+
+        Args:
+            maxsize: Maximum number of results kept.
+        """
+        self.cache = TTLCache(maxsize=maxsize)
+
+    def get(self, email):
+        """Get the live cached result of an email address.
+
+        Args:
+            email: The normalized email address.
+
+        Returns:
+            dict: The cached result, or None.
+        """
+        return self.cache.get(email)
+
+    def set(self, email, result, ttl):
+        """Cache the result of an email address.
+
+        Args:
+            email: The normalized email address.
+            result: The validation result.
+            ttl: Seconds to keep the result.
+        """
+        self.cache.set(email, result, ttl=ttl)
+
+    def clear(self):
+        """Remove all the cached results."""
+        self.cache.clear()
+
+    def stats(self):
+        """Get the size and the hit/miss counters of the cache.
+
+        Returns:
+            dict: The cache statistics.
+        """
+        return self.cache.stats()
+
+
+class DatabaseResultBackend:
+    """Keeps the results in the CachedValidationResults table.
+
+    The table is shared by all app processes. In production it is in Postgres
+    like the rest of the app data; in development and tests SQLite stands in
+    for it. Hit and miss counters are kept per process.
+    """
+
+    def __init__(self):
+        """Initialize the counters."""
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email):
+        """Get the live cached result of an email address.
+
+        Args:
+            email: The normalized email address.
+
+        Returns:
+            dict: The cached result, or None.
+        """
+        from app.models import CachedValidationResults
+
+        row = CachedValidationResults.query.filter(
+            CachedValidationResults.email == email,
+            CachedValidationResults.expires_at > utc_now(),
+        ).first()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row.result
+
+    def set(self, email, result, ttl):
+        """Cache the result of an email address.
+
+        Args:
+            email: The normalized email address.
+            result: The validation result.
+            ttl: Seconds to keep the result.
+        """
+        from app.models import CachedValidationResults
+
+        expires_at = utc_now() + timedelta(seconds=ttl)
+
+        try:
+            row = CachedValidationResults.query.filter_by(email=email).first()
+            if row is None:
+                row = CachedValidationResults(email=email)
+                db.session.add(row)
+            row.result = result
+            row.expires_at = expires_at
+            db.session.commit()
+        except Exception as e:
+            # Another process cached the same address at the same time
+            db.session.rollback()
+            print(f"Could not cache the validation result: {e}")
+
+    def clear(self):
+        """Remove all the cached results and reset the counters."""
+        from app.models import CachedValidationResults
+
+        CachedValidationResults.query.delete()
+        db.session.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def purge_expired(self):
+        """Delete the expired results from the table.
+
+        Returns:
+            int: The number of rows deleted.
+        """
+        from app.models import CachedValidationResults
+
+        deleted = CachedValidationResults.query.filter(
+            CachedValidationResults.expires_at <= utc_now()
+        ).delete()
+        db.session.commit()
+        return deleted
+
+    def stats(self):
+        """Get the hit/miss counters of this process.
+
+        Returns:
+            dict: The cache statistics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class ResultCache:
+    """Cache of validation results with a time to live per result status.
+
+    The backend is chosen with MLS_RESULT_CACHE_BACKEND: 'memory', 'database',
+    or 'none' to disable caching.
+    """
+
+    def __init__(self):
+        """Initialize the cache without a backend until init_app is called."""
+        self.backend = None
+        self.ttl_by_status = {}
+        self.default_ttl = 0
+
+    def init_app(self, app):
+        """Set up the backend and the time to live from the configuration.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.ttl_by_status = app.config["MLS_RESULT_CACHE_TTL_BY_STATUS"]
+        self.default_ttl = app.config["MLS_RESULT_CACHE_DEFAULT_TTL"]
+
+        match app.config["MLS_RESULT_CACHE_BACKEND"]:
+            case "memory":
+                self.backend = MemoryResultBackend(
+                    maxsize=app.config["MLS_RESULT_CACHE_SIZE"]
+                )
+            case "database":
+                self.backend = DatabaseResultBackend()
+                start_periodic_task(
+                    app,
+                    "validation-result-cache-purge",
+                    app.config["MLS_RESULT_CACHE_PURGE_INTERVAL"],
+                    self.purge_expired,
+                )
+            case "none":
+                self.backend = None
+            case backend:
+                raise ValueError(f"Unknown validation result cache backend {backend}.")
+
+    def get(self, email):
+        """Get the cached result of an email address.
+
+        Args:
+            email: The email address.
+
+        Returns:
+            dict: A copy of the cached result, or None if it is not cached.
+        """
+        if self.backend is None:
+            return None
+
+        result = self.backend.get(normalize_email(email))
+        return dict(result) if result is not None else None
+
+    def set(self, email, result):
+        """Cache the result of an email address for the time its status allows.
+
+        Args:
+            email: The email address.
+            result: The validation result returned by a worker.
+        """
+        if self.backend is None or not result:
+            return
+
+        ttl = self.ttl_by_status.get(result.get("status"), self.default_ttl)
+        if ttl > 0:
+            self.backend.set(normalize_email(email), result, ttl)
+
+    def clear(self):
+        """Remove all the cached results."""
+        if self.backend is not None:
+            self.backend.clear()
+
+    def purge_expired(self):
+        """Delete the expired results if the backend keeps them around.
+
+        Returns:
+            int: The number of results deleted.
+        """
+        if isinstance(self.backend, DatabaseResultBackend):
+            return self.backend.purge_expired()
+        return 0
+
+    def stats(self):
+        """Get the hit/miss counters of the cache.
+
+        Returns:
+            dict: The cache statistics, empty if caching is disabled.
+        """
+        return self.backend.stats() if self.backend is not None else {}
+
+
+def utc_now():
+    """Get the current UTC time without timezone info, as stored in the table.
+
+    Returns:
+        datetime: The current UTC time.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# Shared by all requests handled by this process
+result_cache = ResultCache()
@@ -0,0 +1,61 @@
+"""Database schema upgrades for the Mail List Shield application.
+
+db.create_all() creates the missing tables but leaves the existing ones
+alone, so the columns and indexes added to existing models would be missing
+from databases created by an older version. This module adds them when the
+app starts.
+"""
+
+from sqlalchemy import inspect, text
+
+
+def upgrade_schema(engine, metadata):
+    """Add the missing columns and indexes of the existing tables.
+
+    New columns are added as nullable, with their server default if they
+    have one, so that the existing rows get a value. Foreign keys of new
+    columns are not added to existing tables.
+
+    Args:
+        engine: The SQLAlchemy engine of the database.
+        metadata: The MetaData of the models.
+
+    Returns:
+        list: The names of the columns and indexes added.
+    """
+    inspector = inspect(engine)
+    added = []
+
+    with engine.begin() as connection:
+        preparer = connection.dialect.identifier_preparer
+
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+
+                ddl = (
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} "
+                    f"{column.type.compile(dialect=connection.dialect)}"
+                )
+                if column.server_default is not None and isinstance(
+                    column.server_default.arg, str
+                ):
+                    default = column.server_default.arg.replace("'", "''")
+                    ddl += f" DEFAULT '{default}'"
+
+                connection.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    added.append(index.name)
+
+    return added
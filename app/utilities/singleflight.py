@@ -0,0 +1,114 @@
+"""Request coalescing utilities for the Mail List Shield application.
+
+This module lets concurrent callers asking for the same thing share a single
+call: the first caller runs it, and the others wait for its outcome.
+"""
+
+from threading import Event, Lock
+
+
+class _Flight:
+    """A call in progress and its outcome once it finishes."""
+
+    def __init__(self):
+        """Initialize a call without an outcome yet."""
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def _copy_error(error):
+    """Copy an exception for another caller to raise.
+
+    The copy is made without calling the exception's __init__, whose
+    arguments may differ from its args, e.g. ValidationOverloaded.
+
+    Args:
+        error: The exception raised by the call.
+
+    Returns:
+        Exception: A new exception of the same type with the same args and
+            attributes, without a traceback.
+    """
+    copied = type(error).__new__(type(error), *error.args)
+    copied.__dict__.update(error.__dict__)
+    return copied
+
+
+class FlightTimeout(Exception):
+    """Raised when a caller stops waiting for a call run by another caller."""
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one call.
+
+    Attributes:
+        calls: Number of calls that were run.
+        coalesced: Number of callers that shared a call run by another caller.
+    """
+
+    def __init__(self):
+        """Initialize without any call in progress."""
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = Lock()
+
+    def do(self, key, func, timeout=None):
+        """Call a function, unless a call with the same key is in progress.
+
+        If a call with the same key is in progress, wait for it and return
+        its result, or raise a copy of its exception, instead of calling the
+        function. Each waiting caller raises its own copy so that concurrent
+        raises don't mix up the traceback and context of a shared exception.
+
+        Args:
+            key: The key identifying the call.
+            func: The function to call without arguments.
+            timeout: Seconds to wait for a call run by another caller.
+
+        Returns:
+            The return value of the call.
+
+        Raises:
+            FlightTimeout: If the call of another caller didn't finish in time.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise FlightTimeout(f"The call for {key} did not finish in time.")
+            if flight.error is not None:
+                raise _copy_error(flight.error) from flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        """Get the call counters.
+
+        Returns:
+            dict: The number of calls run, callers coalesced, and calls in progress.
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._flights),
+            }
@@ -0,0 +1,172 @@
+"""Cached Stripe charge history for the Mail List Shield application.
+
+The billing page shows the charges of the customer from the StripeCharges
+table instead of calling the Stripe API on every view. Charges are saved
+from the charge webhook events, and a completed checkout marks the history
+of its customer as stale. Stale or old histories are read again from the
+Stripe API in the background, the page renders from the cache meanwhile.
+A customer without any history yet is read once while the page waits.
+"""
+
+from datetime import timedelta
+from threading import Lock
+
+import stripe
+from flask import current_app
+
+from app import db
+from app.utilities.background import run_in_background
+from app.utilities.helpers import naive_app_now
+
+# Charges shown on the billing page
+HISTORY_LIMIT = 100
+
+# Customers whose history is being refreshed by this process
+_refreshing = set()
+_refreshing_lock = Lock()
+
+
+def save_charge(charge, commit=True):
+    """Save a Stripe charge to the cache, replacing its previous state.
+
+    Args:
+        charge: The Stripe charge object.
+        commit: Whether to commit the session, False when the caller saves
+            several charges and commits them together.
+
+    Returns:
+        bool: Whether the charge was saved, False if it has no customer.
+    """
+    from app.models import StripeCharges
+
+    if not charge.get("customer"):
+        return False
+
+    db.session.merge(
+        StripeCharges(
+            id=charge["id"],
+            customer_id=charge["customer"],
+            amount=charge["amount"],
+            currency=charge["currency"],
+            description=charge.get("description"),
+            status=charge["status"],
+            receipt_url=charge.get("receipt_url"),
+            created=charge["created"],
+        )
+    )
+    if commit:
+        db.session.commit()
+    return True
+
+
+def invalidate_charge_history(customer_id):
+    """Mark the cached charge history of a customer as stale.
+
+    Args:
+        customer_id: The Stripe customer ID.
+    """
+    from app.models import StripeChargeHistories
+
+    db.session.merge(StripeChargeHistories(customer_id=customer_id, refreshed_at=None))
+    db.session.commit()
+
+
+def refresh_charge_history(customer_id):
+    """Read the charges of a customer from the Stripe API into the cache.
+
+    The charges and the refresh time are committed together.
+
+    Args:
+        customer_id: The Stripe customer ID.
+
+    Returns:
+        int: The number of charges read.
+    """
+    from app.models import StripeChargeHistories
+
+    refreshed_at = naive_app_now()
+    charges = stripe.Charge.list(
+        customer=customer_id, status="succeeded", limit=HISTORY_LIMIT
+    )
+    try:
+        for charge in charges.data:
+            save_charge(charge, commit=False)
+
+        db.session.merge(
+            StripeChargeHistories(customer_id=customer_id, refreshed_at=refreshed_at)
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return len(charges.data)
+
+
+def charge_history(customer_id):
+    """Get the cached successful charges of a customer, newest first.
+
+    The history of a customer is read from Stripe right away the first time.
+    After that, a refresh is started in the background if the history is
+    stale, or older than MLS_STRIPE_CHARGES_TTL seconds.
+
+    Args:
+        customer_id: The Stripe customer ID.
+
+    Returns:
+        list: The StripeCharges objects.
+    """
+    from app.models import StripeCharges, StripeChargeHistories
+
+    history = db.session.get(StripeChargeHistories, customer_id)
+    max_age = timedelta(seconds=current_app.config["MLS_STRIPE_CHARGES_TTL"])
+    if history is None:
+        try:
+            refresh_charge_history(customer_id)
+        except Exception as e:
+            # Show what the webhooks saved, and retry in the background later
+            print(f"Reading the charges of {customer_id} failed: {e}")
+            invalidate_charge_history(customer_id)
+    elif (
+        history.refreshed_at is None or history.refreshed_at < naive_app_now() - max_age
+    ):
+        refresh_in_background(customer_id)
+
+    return (
+        StripeCharges.query.filter_by(customer_id=customer_id, status="succeeded")
+        .order_by(StripeCharges.created.desc())
+        .limit(HISTORY_LIMIT)
+        .all()
+    )
+
+
+def refresh_in_background(customer_id):
+    """Refresh the charge history of a customer in a background thread.
+
+    A customer is refreshed by one thread of this process at a time.
+
+    Args:
+        customer_id: The Stripe customer ID.
+
+    Returns:
+        bool: Whether a refresh was started.
+    """
+    with _refreshing_lock:
+        if customer_id in _refreshing:
+            return False
+        _refreshing.add(customer_id)
+
+    def refresh():
+        try:
+            refresh_charge_history(customer_id)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(customer_id)
+
+    app = current_app._get_current_object()
+    if not run_in_background(app, "stripe-charge-refresh", refresh):
+        with _refreshing_lock:
+            _refreshing.discard(customer_id)
+        return False
+
+    return True
@@ -7,7 +7,9 @@ management and credit purchases.
 import datetime
 
 from app.config import appTimezone
-from app.models import Users, Tiers
+from app.models import Users, Tiers, CreditLedger
+from app.utilities.credit_ledger import PURCHASE_SOURCE
+from app.utilities.stripe_charges import save_charge, invalidate_charge_history
 from app.emails import (
     send_email_about_subscription_confirmation,
     send_email_about_subscription_cancellation,
@@ -39,6 +41,19 @@ def is_checkout_completed_event(event):
     return event.type == "checkout.session.completed"
 
 
+def is_charge_event(event):
+    """Check if a Stripe event is about a charge.
+
+    Args:
+        event: The Stripe event object.
+
+    Returns:
+        bool: True if the event type starts with 'charge.' and its object is
+            a charge, unlike the dispute events.
+    """
+    return event.type[:7] == "charge." and event.data.object["object"] == "charge"
+
+
 def user_from_stripe_customer_id(customer_id):
     """Look up a user by their Stripe customer ID.
 
@@ -82,21 +97,34 @@ def tier_from_stripe_price_id(price_id):
 def handle_stripe_event(event):
     """Process a Stripe webhook event.
 
-    Handles checkout completions (credit purchases) and subscription
-    events (creation, updates, cancellation, deletion).
+    Handles checkout completions (credit purchases), charges, and
+    subscription events (creation, updates, cancellation, deletion).
 
     Args:
         event: The Stripe event object to process.
     """
+    # Keep the cached charge history of the billing page up to date
+    if is_charge_event(event):
+        save_charge(event.data.object)
+
     # If it is a credit purchase event, try to parse user and update credits
     if is_checkout_completed_event(event):
         # Get the Stripe customer and find the matching user
         customer_id = event.data.object["customer"]
         user_matched = user_from_stripe_customer_id(customer_id)
 
-        # Update the user's credits
-        quantity = event.data.object.metadata.quantity
-        user_matched.add_credits(int(quantity))
+        # The checkout charged the customer
+        invalidate_charge_history(customer_id)
+
+        # Update the user's credits, unless a retry of the event did already
+        # Subscription checkouts have no quantity of credits
+        session_id = event.data.object["id"]
+        credited = CreditLedger.query.filter_by(
+            source=PURCHASE_SOURCE, reference=session_id
+        ).first()
+        if credited is None and "quantity" in event.data.object.metadata:
+            quantity = event.data.object.metadata.quantity
+            user_matched.add_credits(int(quantity), PURCHASE_SOURCE, session_id)
 
     # If it is a subscription event, try to parse user and tier
     if is_subscription_event(event):
@@ -0,0 +1,159 @@
+"""Stripe webhook event queue for the Mail List Shield application.
+
+The Stripe webhook endpoint only verifies and stores the events, and
+acknowledges them right away. A background processor applies the stored
+events with retries and exponential backoff, so slow database writes or
+emails don't hold up Stripe, and a failed event is retried instead of
+lost.
+
+Events are stored by their Stripe event ID, so the redeliveries of an
+event are acknowledged without being stored or processed again.
+"""
+
+from datetime import timedelta
+import json
+
+import stripe
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.utilities.helpers import naive_app_now
+from app.utilities.stripe_event_handler import handle_stripe_event
+
+# Seconds a claimed event is left to its processor before others retry it
+CLAIM_SECONDS = 300
+
+
+def store_stripe_event(event, payload):
+    """Store a verified Stripe event to be processed in the background.
+
+    Args:
+        event: The Stripe event object.
+        payload: The body of the webhook request, the event in JSON.
+
+    Returns:
+        bool: Whether the event was stored, False if it was stored before.
+    """
+    from app.models import StripeEvents
+
+    db.session.add(
+        StripeEvents(
+            id=event.id,
+            type=event.type,
+            payload=payload,
+            next_attempt_at=naive_app_now(),
+        )
+    )
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A redelivery of an event we already have
+        db.session.rollback()
+        return False
+
+    return True
+
+
+def claim_stripe_event(stripe_event):
+    """Claim a due event so that no other process handles it meanwhile.
+
+    Only the process whose update matches the attempt time it read gets the
+    event.
+
+    Args:
+        stripe_event: The StripeEvents object as read.
+
+    Returns:
+        bool: Whether this process claimed the event.
+    """
+    from app.models import StripeEvents
+
+    claimed = db.session.execute(
+        update(StripeEvents)
+        .where(
+            StripeEvents.id == stripe_event.id,
+            StripeEvents.status == "pending",
+            StripeEvents.next_attempt_at == stripe_event.next_attempt_at,
+        )
+        .values(next_attempt_at=naive_app_now() + timedelta(seconds=CLAIM_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def process_stripe_event(stripe_event):
+    """Handle one attempt of a claimed event and record its outcome.
+
+    Args:
+        stripe_event: The claimed StripeEvents object.
+
+    Returns:
+        bool: Whether the event was processed.
+    """
+    from app.models import StripeEvents
+
+    config = current_app.config
+    event_id = stripe_event.id
+
+    try:
+        event = stripe.Event.construct_from(json.loads(stripe_event.payload), None)
+        handle_stripe_event(event)
+        error = None
+    except Exception as e:
+        db.session.rollback()
+        error = str(e)[:500]
+
+    # Changes of the failed handler were rolled back, the row is read again
+    stripe_event = db.session.get(StripeEvents, event_id)
+    stripe_event.attempts += 1
+    stripe_event.last_error = error
+
+    if error is None:
+        stripe_event.status = "processed"
+        stripe_event.processed_at = naive_app_now()
+    elif stripe_event.attempts >= config["MLS_STRIPE_EVENTS_MAX_ATTEMPTS"]:
+        stripe_event.status = "failed"
+        print(
+            f"Stripe event {event_id} failed after {stripe_event.attempts} attempts: {error}"
+        )
+    else:
+        # Exponential backoff, capped at MLS_STRIPE_EVENTS_MAX_BACKOFF seconds
+        backoff = min(
+            config["MLS_STRIPE_EVENTS_BACKOFF"] * 2 ** (stripe_event.attempts - 1),
+            config["MLS_STRIPE_EVENTS_MAX_BACKOFF"],
+        )
+        stripe_event.next_attempt_at = naive_app_now() + timedelta(seconds=backoff)
+
+    db.session.commit()
+    return error is None
+
+
+def process_due_stripe_events():
+    """Process the stored events whose next attempt is due, oldest first.
+
+    This runs periodically in the background of each app process.
+
+    Returns:
+        int: The number of events processed.
+    """
+    from app.models import StripeEvents
+
+    due = (
+        StripeEvents.query.filter(
+            StripeEvents.status == "pending",
+            StripeEvents.next_attempt_at <= naive_app_now(),
+        )
+        .order_by(StripeEvents.created_at)
+        .limit(current_app.config["MLS_STRIPE_EVENTS_BATCH_SIZE"])
+        .all()
+    )
+
+    processed = 0
+    for stripe_event in due:
+        if claim_stripe_event(stripe_event):
+            processed += process_stripe_event(stripe_event)
+
+    return processed
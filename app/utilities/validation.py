@@ -1,46 +1,305 @@
 """Email validation utilities for the Mail List Shield application.
 
-This module handles email validation by distributing requests across
-multiple worker servers using a round-robin strategy.
+This module handles email validation by pre-screening addresses locally
+and distributing the remaining requests across
+multiple worker servers, ordered by the load balancer, either one worker
+after another or hedged across workers concurrently, within a time budget.
+Connections to the workers are kept alive and reused across requests,
+recent results are served from the result cache, and concurrent validations
+of the same address are coalesced into one worker request. Worker requests
+go through the admission lanes, which turn validations away when the
+process is overloaded.
 """
 
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+    FIRST_COMPLETED,
+)
+from threading import Event, Lock
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from flask import current_app
 
+from app.utilities.worker_balancer import worker_balancer
+from app.utilities.result_cache import result_cache, normalize_email
+from app.utilities.singleflight import SingleFlight, FlightTimeout
+from app.utilities.prescreen import prescreen
+from app.utilities.domain_cache import domain_cache, domain_of
+from app.utilities.admission import admission, FREE_LANE
+
+
+class WorkerSessions:
+    """Pool of persistent HTTP sessions, one per worker server.
+
+    Each session keeps up to MLS_WORKER_POOL_SIZE keep-alive connections to its
+    worker, so validations reuse connections instead of opening a new TCP and
+    TLS connection every time. The sessions are shared by all the requests of
+    this process. A session idle for longer than MLS_WORKER_KEEPALIVE seconds
+    is replaced, since the worker has likely closed its connections by then.
+    """
+
+    def __init__(self):
+        """Initialize an empty pool."""
+        self._sessions = {}
+        self._lock = Lock()
+
+    def get(self, worker):
+        """Get the session for a worker, creating it if needed.
+
+        Args:
+            worker: The URL of the worker server.
+
+        Returns:
+            requests.Session: The session to send the worker's requests with.
+        """
+        now = time.monotonic()
+        keepalive = current_app.config["MLS_WORKER_KEEPALIVE"]
+
+        with self._lock:
+            session, last_used = self._sessions.get(worker, (None, None))
+
+            if session is not None and now - last_used > keepalive:
+                session.close()
+                session = None
+
+            if session is None:
+                session = self._new_session()
+
+            self._sessions[worker] = (session, now)
+            return session
+
+    def close(self):
+        """Close all the sessions and their connections."""
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def _new_session(self):
+        """Create a session with a connection pool sized from the configuration.
+
+        Returns:
+            requests.Session: The new session.
+        """
+        pool_size = current_app.config["MLS_WORKER_POOL_SIZE"]
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+# Shared by all requests handled by this process
+worker_sessions = WorkerSessions()
+validation_flights = SingleFlight()
+
+
+class ValidationDeadlineExceeded(Exception):
+    """Raised when a validation runs out of time before any worker answers."""
+
+
+class Deadline:
+    """Time budget of a validation, shared by all its worker requests.
+
+    Attributes:
+        expires_at: Monotonic time when the budget runs out.
+    """
+
+    def __init__(self, seconds):
+        """Start a new time budget.
+
+        Args:
+            seconds: Length of the budget in seconds.
+        """
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """Get the time left in the budget.
+
+        Returns:
+            float: Seconds left, 0 if the deadline has passed.
+        """
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """Check whether the deadline has passed.
+
+        Returns:
+            bool: True if there is no time left.
+        """
+        return self.remaining() <= 0
+
+
+def validate_email(email, deadline=None, use_cache=True, lane=FREE_LANE):
+    """Validate an email address, reusing a recent result if there is one.
+
+    Addresses with an invalid syntax or a domain without MX records are
+    rejected locally. Concurrent validations of the same address in the same
+    admission lane share one worker request: the first caller asks the
+    workers and the others wait for its result. Only the worker request
+    takes a slot of the admission lane, so results answered locally are never
+    turned away, and a paid request never waits on a free one.
+
+    Args:
+        email: The email address to validate.
+        deadline: The Deadline of the validation. Defaults to a new deadline
+            of MLS_VALIDATION_DEADLINE seconds.
+        use_cache: Whether to look up and store the result in the result cache.
+        lane: The admission lane of the request, see lane_for_user().
 
-def validate_email(email):
+    Returns:
+        dict: Validation result containing status and details, and a 'cached'
+            key telling whether it came from the cache.
+
+    Raises:
+        ValidationOverloaded: If the admission lane is full.
+        ValidationDeadlineExceeded: If the deadline passed without any result.
+        Exception: If no worker could provide a valid response.
+    """
+    rejected = prescreen.check(email)
+    if rejected is not None:
+        return {**rejected, "cached": False}
+
+    if deadline is None:
+        deadline = Deadline(current_app.config["MLS_VALIDATION_DEADLINE"])
+
+    if use_cache:
+        result = result_cache.get(email)
+        if result is not None:
+            result["cached"] = True
+            return result
+
+    def validate_and_cache():
+        with admission.admit(lane, timeout=deadline.remaining()):
+            result = validate_email_with_workers(email, deadline)
+        domain_cache.learn_from_result(email, result)
+        if use_cache:
+            result_cache.set(email, result)
+        return result
+
+    try:
+        result = validation_flights.do(
+            (normalize_email(email), use_cache, lane),
+            validate_and_cache,
+            timeout=deadline.remaining(),
+        )
+    except FlightTimeout:
+        raise ValidationDeadlineExceeded(
+            "The validation deadline passed while waiting for the same address."
+        )
+
+    # Every caller gets its own copy of the shared result
+    return {**result, "cached": False}
+
+
+def validate_emails(emails, max_concurrency=None, lane=FREE_LANE):
+    """Validate several email addresses concurrently.
+
+    Args:
+        emails: The normalized, unique email addresses to validate.
+        max_concurrency: Maximum number of concurrent validations. Defaults to
+            MLS_BULK_CONCURRENCY.
+        lane: The admission lane of the request.
+
+    Returns:
+        dict: The validation result of each address in the given order, or None
+            if it failed.
+    """
+    results = dict(validate_emails_as_completed(emails, max_concurrency, lane))
+    return {email: results[email] for email in emails}
+
+
+def validate_emails_as_completed(emails, max_concurrency=None, lane=FREE_LANE):
+    """Validate several email addresses concurrently, yielding each result.
+
+    Each address is validated like validate_email, including the result
+    cache, with at most max_concurrency validations in flight at a time.
+    A failed or turned away validation doesn't stop the others. Results are
+    yielded as soon as they arrive, so they don't have to be held in memory.
+    If the generator is closed early, the validations not started yet are
+    dropped.
+
+    Args:
+        emails: The normalized, unique email addresses to validate.
+        max_concurrency: Maximum number of concurrent validations. Defaults to
+            MLS_BULK_CONCURRENCY.
+        lane: The admission lane of the request.
+
+    Yields:
+        tuple: The address and its validation result, or None if it failed.
+    """
+    if max_concurrency is None:
+        max_concurrency = current_app.config["MLS_BULK_CONCURRENCY"]
+
+    app = current_app._get_current_object()
+
+    def validate_or_none(email):
+        try:
+            return email, validate_email(email, lane=lane)
+        except Exception as e:
+            print(f"Validation of an address in a bulk request failed: {e}")
+            return email, None
+
+    # A pool of its own, so that a bulk request can't starve the hedged
+    # requests of the shared validation executor
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, min(max_concurrency, len(emails))),
+        thread_name_prefix="bulk-validation",
+    )
+    try:
+        futures = [
+            executor.submit(run_in_app_context, app, validate_or_none, email)
+            for email in emails
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def validate_email_with_workers(email, deadline=None):
     """Validate an email address using available worker servers.
 
-    Distributes validation requests across workers using round-robin.
+    Tries the workers in the order given by the load balancer.
     If a worker returns an 'unknown' status, tries the next worker.
+    All the attempts share one time budget.
 
     Args:
         email: The email address to validate.
+        deadline: The Deadline of the validation. Defaults to a new deadline
+            of MLS_VALIDATION_DEADLINE seconds.
 
     Returns:
         dict: Validation result containing status and details.
 
     Raises:
+        ValidationDeadlineExceeded: If the deadline passed without any result.
         Exception: If no worker could provide a valid response.
     """
-    workers = current_app.config["MLS_WORKERS"]
-    first_worker_index = current_app.config["NEXT_WORKER"]
+    if deadline is None:
+        deadline = Deadline(current_app.config["MLS_VALIDATION_DEADLINE"])
+
+    if current_app.config["MLS_HEDGED_VALIDATION"]:
+        return validate_email_hedged(email, deadline)
+
     best_result_so_far = {}
 
     # Until we find a server that doesn't return status = unknown
-    for i, _ in enumerate(workers):
-        # len(workers) = 3, first_worker_index = 2, i = 0  =>  worker_index = 2
-        # len(workers) = 3, first_worker_index = 2, i = 1  =>  worker_index = 2
-        worker_index = (i + first_worker_index) % len(workers)
-        print(f"We are using worker #{worker_index}, which is {workers[worker_index]}")
+    for worker in worker_balancer.ranked(current_app.config["MLS_WORKERS"]):
+        # Don't start a request we have no time left for
+        if deadline.expired():
+            break
 
-        # Increment the next worker global variable
-        current_app.config["NEXT_WORKER"] = (worker_index + 1) % len(workers)
-        print(f'Next time we will use the worker #{current_app.config["NEXT_WORKER"]}')
+        print(f"We are using the worker {worker}")
 
         # Request the result from the worker
-        new_result = request_validation(email, workers[worker_index])
+        new_result = balanced_request_validation(email, worker, deadline)
 
         # If there wasn't an exception during request_validation
         # If there was, we continue looping
@@ -51,28 +310,211 @@ def validate_email(email):
                 # We can at least call this the best_result_so_far
                 best_result_so_far = new_result
 
-                # Report what it returned
-                # print(f"{workers[worker_index]} returned the result as {new_result['status']}.")
-                # print(new_result)
-
             # If the result is not unknown, it is good to return
             if new_result.get("status") != "unknown":
                 return new_result
 
     if best_result_so_far:
         return best_result_so_far
+    elif deadline.expired():
+        raise ValidationDeadlineExceeded(
+            "The validation deadline passed before any worker answered."
+        )
+    else:
+        raise Exception(
+            "We could not even get an unknown response from any of the workers."
+        )
+
+
+def validate_email_hedged(email, deadline):
+    """Validate an email address by racing the worker servers.
+
+    The first worker is asked right away. The next one is asked when the hedge
+    delay passes without a definitive answer, or as soon as a worker returns
+    'unknown' or fails. The first definitive answer is returned and the other
+    requests are abandoned. If all workers return 'unknown' or fail, the last
+    'unknown' result is returned like in the sequential mode.
+
+    Args:
+        email: The email address to validate.
+        deadline: The Deadline shared by all the worker requests.
+
+    Returns:
+        dict: Validation result containing status and details.
+
+    Raises:
+        ValidationDeadlineExceeded: If the deadline passed without any result.
+        Exception: If no worker could provide a valid response.
+    """
+    hedge_delay = current_app.config["MLS_HEDGE_DELAY"]
+    app = current_app._get_current_object()
+    ordered_workers = worker_balancer.ranked(current_app.config["MLS_WORKERS"])
+
+    best_result_so_far = {}
+    asked = []
+    in_flight = set()
+    abandoned = Event()
+
+    if not ordered_workers:
+        raise Exception("No workers are configured.")
+
+    def ask_next_worker():
+        worker = ordered_workers[len(asked)]
+        asked.append(worker)
+        in_flight.add(
+            validation_executor().submit(
+                run_in_app_context,
+                app,
+                balanced_request_validation,
+                email,
+                worker,
+                deadline,
+                abandoned,
+            )
+        )
+
+    ask_next_worker()
+
+    try:
+        while in_flight and not deadline.expired():
+            can_hedge = len(asked) < len(ordered_workers)
+            done, in_flight = wait(
+                in_flight,
+                timeout=(
+                    min(hedge_delay, deadline.remaining())
+                    if can_hedge
+                    else deadline.remaining()
+                ),
+                return_when=FIRST_COMPLETED,
+            )
+
+            # No answer within the hedge delay, ask one more worker
+            if not done:
+                if can_hedge and not deadline.expired():
+                    ask_next_worker()
+                continue
+
+            for future in done:
+                new_result = future.result()
+
+                if new_result:
+                    if "status" in new_result:
+                        best_result_so_far = new_result
+
+                    # If the result is not unknown, it is good to return
+                    if new_result.get("status") != "unknown":
+                        return new_result
+
+            # Don't wait for the hedge delay after an unknown or a failure
+            if can_hedge:
+                ask_next_worker()
+    finally:
+        # Requests not sent yet are dropped, the ones in flight are ignored
+        abandoned.set()
+        for future in in_flight:
+            future.cancel()
+
+    if best_result_so_far:
+        return best_result_so_far
+    elif deadline.expired():
+        raise ValidationDeadlineExceeded(
+            "The validation deadline passed before any worker answered."
+        )
     else:
         raise Exception(
             "We could not even get an unknown response from any of the workers."
         )
 
 
-def request_validation(email, worker):
+def run_in_app_context(app, func, *args):
+    """Call a function inside an application context.
+
+    Used to run functions that read the app configuration in executor threads.
+
+    Args:
+        app: The Flask application instance.
+        func: The function to call.
+        *args: The arguments to call the function with.
+
+    Returns:
+        The return value of the function.
+    """
+    with app.app_context():
+        return func(*args)
+
+
+def validation_executor():
+    """Get the thread pool that sends concurrent requests to the workers.
+
+    The pool is created on first use and shared by the requests of this process.
+    With the gevent worker class, its threads are greenlets.
+
+    Returns:
+        ThreadPoolExecutor: The shared executor.
+    """
+    global _validation_executor
+
+    with _validation_executor_lock:
+        if _validation_executor is None:
+            _validation_executor = ThreadPoolExecutor(
+                max_workers=current_app.config["MLS_VALIDATION_THREADS"],
+                thread_name_prefix="validation",
+            )
+        return _validation_executor
+
+
+_validation_executor = None
+_validation_executor_lock = Lock()
+
+
+def balanced_request_validation(email, worker, deadline, abandoned=None):
+    """Send a validation request to a worker and report it to the load balancer.
+
+    Nothing is sent if the deadline passed already, e.g. while the request
+    waited for a thread. A request without a response is only counted as a
+    failure of the worker if it wasn't cut short by the deadline or abandoned
+    for another worker's answer.
+
+    Args:
+        email: The email address to validate.
+        worker: The URL of the worker server.
+        deadline: The Deadline of the validation.
+        abandoned: A threading.Event set when the answer isn't needed anymore.
+
+    Returns:
+        dict: The JSON response from the worker, or None on failure.
+    """
+    if deadline.expired() or (abandoned is not None and abandoned.is_set()):
+        return None
+
+    started = worker_balancer.start(worker)
+    result = None
+    try:
+        result = request_validation(email, worker, deadline)
+    finally:
+        if result:
+            ok = True
+        elif deadline.expired() or (abandoned is not None and abandoned.is_set()):
+            # Says nothing about the health of the worker
+            ok = None
+        else:
+            ok = False
+        worker_balancer.finish(worker, started, ok=ok)
+    return result
+
+
+def request_validation(email, worker, deadline):
     """Send a validation request to a specific worker server.
 
+    The request times out when the deadline passes. The remaining time is
+    sent to the worker in the X-Deadline-Ms header so it can give up early.
+    What is known about the domain from earlier validations is sent as
+    domain_hints, which the worker may use to skip probing it again.
+
     Args:
         email: The email address to validate.
         worker: The URL of the worker server.
+        deadline: The Deadline of the validation.
 
     Returns:
         dict: The JSON response from the worker, or None on failure.
@@ -82,8 +524,24 @@ def request_validation(email, worker):
         "api_key": current_app.config["MLS_WORKER_API_KEY"],
     }
 
+    domain_hints = domain_cache.hints(domain_of(email))
+    if domain_hints:
+        data["domain_hints"] = domain_hints
+
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        return None
+
     try:
-        response = requests.post(worker, json=data)
+        response = worker_sessions.get(worker).post(
+            worker,
+            json=data,
+            headers={"X-Deadline-Ms": str(int(remaining * 1000))},
+            timeout=(
+                min(current_app.config["MLS_WORKER_CONNECT_TIMEOUT"], remaining),
+                min(current_app.config["MLS_WORKER_READ_TIMEOUT"], remaining),
+            ),
+        )
 
         if response.status_code == 200:
             # API request was successful
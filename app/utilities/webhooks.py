@@ -0,0 +1,478 @@
+"""Batch job completion webhooks for the Mail List Shield application.
+
+This module notifies users when their batch validation jobs complete or
+fail, so that they don't have to poll for the job status. A background
+dispatcher finds the newly finished jobs, and POSTs a signed notification
+with the final status of the job, and the results download link if it
+completed, to the callback URL of the job or of the account.
+Failed deliveries are retried with exponential backoff, and every
+notification keeps a log of its delivery attempts.
+
+Notifications are only sent to hosts whose addresses are all public, and
+the request connects to the address that was checked, so that callback
+URLs can't reach the internal network.
+"""
+
+from datetime import timedelta
+from ipaddress import IPv4Address, IPv6Network, ip_address
+from urllib.parse import urlparse
+import hmac
+import json
+import re
+import socket
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.utilities.helpers import naive_app_now
+
+# Event type of the notifications, sent when a job completes or fails
+JOB_COMPLETED_EVENT = "batch_job.completed"
+
+# Header carrying the signature of the notifications
+SIGNATURE_HEADER = "X-MLS-Signature"
+
+# Well-known prefix of the IPv6 addresses translated to IPv4 by NAT64
+NAT64_NETWORK = IPv6Network("64:ff9b::/96")
+
+# Domain names accepted in callback URLs, the last label can't be numeric
+HOSTNAME_PATTERN = re.compile(
+    r"(?=.{1,253}$)(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+"
+    r"[a-z](?:[a-z0-9-]{0,61}[a-z0-9])?"
+)
+
+
+def is_public_address(address):
+    """Check whether an IP address is on the public internet.
+
+    IPv6 addresses embedding an IPv4 address (IPv4-mapped, 6to4 and NAT64)
+    are checked by the embedded address too.
+
+    Args:
+        address: The ipaddress.IPv4Address or IPv6Address.
+
+    Returns:
+        bool: Whether the address is public.
+    """
+    if not address.is_global:
+        return False
+
+    if address.version == 6:
+        embedded = address.ipv4_mapped or address.sixtofour
+        if embedded is None and address in NAT64_NETWORK:
+            embedded = IPv4Address(int(address) & 0xFFFFFFFF)
+        if embedded is not None:
+            return embedded.is_global
+
+    return True
+
+
+class CallbackAddressError(Exception):
+    """Raised when a notification can't be sent to the host of a callback URL."""
+
+
+def is_valid_callback_url(url):
+    """Check whether a URL can receive webhook notifications.
+
+    Only HTTPS URLs are accepted, except in debug mode. The host must be a
+    public IP address in its canonical form, or a domain name whose last
+    label is not numeric, so that forms like 0x7f000001 or 0177.0.0.1 that
+    some resolvers read as IP addresses are rejected. The addresses a name
+    resolves to are checked when the notification is sent.
+
+    Args:
+        url: The URL given by the user.
+
+    Returns:
+        bool: Whether the URL is accepted.
+    """
+    if not isinstance(url, str) or len(url) > 2048:
+        return False
+
+    parsed = urlparse(url)
+    allowed_schemes = ["https"]
+    if current_app.config["FLASK_DEBUG"]:
+        allowed_schemes.append("http")
+
+    if parsed.scheme not in allowed_schemes or not parsed.hostname:
+        return False
+
+    try:
+        parsed.port
+    except ValueError:
+        return False
+
+    if current_app.config["FLASK_DEBUG"]:
+        return True
+
+    # Credentials in the URL could change the host seen by other parsers
+    if parsed.username is not None or parsed.password is not None:
+        return False
+
+    try:
+        address = ip_address(parsed.hostname)
+    except ValueError:
+        # Not an IP address
+        return HOSTNAME_PATTERN.fullmatch(parsed.hostname) is not None
+
+    return str(address) == parsed.hostname and is_public_address(address)
+
+
+def resolve_callback_address(url):
+    """Resolve the host of a callback URL to the address to connect to.
+
+    Every address of the host must be public, except in debug mode.
+
+    Args:
+        url: The callback URL.
+
+    Returns:
+        str: The IP address to send the notification to.
+
+    Raises:
+        CallbackAddressError: If the URL is not accepted, its host can't be
+            resolved, or it has an address that is not public.
+    """
+    if not is_valid_callback_url(url):
+        raise CallbackAddressError("The callback URL is not accepted.")
+
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    try:
+        addresses = [
+            ip_address(info[4][0])
+            for info in socket.getaddrinfo(
+                parsed.hostname, port, type=socket.SOCK_STREAM
+            )
+        ]
+    except OSError:
+        raise CallbackAddressError("The host of the callback URL can't be resolved.")
+
+    if not addresses or not (
+        current_app.config["FLASK_DEBUG"]
+        or all(is_public_address(address) for address in addresses)
+    ):
+        raise CallbackAddressError(
+            "The callback URL doesn't resolve to a public address."
+        )
+
+    return str(addresses[0])
+
+
+class PinnedAddressAdapter(HTTPAdapter):
+    """Transport adapter for URLs whose host is replaced by a checked address.
+
+    The TLS server name and the certificate are still checked against the
+    original host name.
+    """
+
+    def __init__(self, hostname):
+        """Initialize the adapter.
+
+        Args:
+            hostname: The host name of the original URL.
+        """
+        self.hostname = hostname
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Create the pool manager with the host name for TLS."""
+        kwargs["server_hostname"] = self.hostname
+        kwargs["assert_hostname"] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def post_to_address(url, address, body, headers, timeout):
+    """POST a notification to a callback URL through an address checked before.
+
+    Connecting to the checked address instead of the host name, so that a
+    second DNS lookup can't lead the request to another address.
+
+    Args:
+        url: The callback URL.
+        address: The IP address returned by resolve_callback_address().
+        body: The body of the request.
+        headers: The headers of the request.
+        timeout: Seconds to wait for the receiver.
+
+    Returns:
+        requests.Response: The response of the receiver.
+    """
+    parsed = urlparse(url)
+    host = f"[{address}]" if ":" in address else address
+    host_header = parsed.hostname
+    if parsed.port is not None:
+        host = f"{host}:{parsed.port}"
+        host_header = f"{host_header}:{parsed.port}"
+
+    with requests.Session() as session:
+        # Proxies from the environment would do their own DNS lookup
+        session.trust_env = False
+        if parsed.scheme == "https":
+            session.mount("https://", PinnedAddressAdapter(parsed.hostname))
+        return session.post(
+            parsed._replace(netloc=host).geturl(),
+            data=body,
+            headers={**headers, "Host": host_header},
+            timeout=timeout,
+            allow_redirects=False,
+        )
+
+
+def sign_payload(secret, body, timestamp=None):
+    """Sign the body of a notification.
+
+    The signature covers the timestamp, so that receivers can reject
+    replayed notifications.
+
+    Args:
+        secret: The webhook secret of the user.
+        body: The JSON body of the notification as a string.
+        timestamp: Unix time of the signature. Defaults to now.
+
+    Returns:
+        str: The signature header value, as "t=<timestamp>,v1=<hex HMAC-SHA256>".
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(
+        secret.encode("utf-8"),
+        f"{timestamp}.{body}".encode("utf-8"),
+        "sha256",
+    ).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def schedule_job_webhook(job, url):
+    """Schedule the completion notification of a job to a callback URL.
+
+    Args:
+        job: The BatchJobs object, added to the session.
+        url: The callback URL of the job.
+
+    Returns:
+        WebhookDeliveries: The scheduled notification, added to the session.
+    """
+    from app.models import WebhookDeliveries
+
+    delivery = WebhookDeliveries(job=job, user_id=job.user.id, url=url)
+    db.session.add(delivery)
+    return delivery
+
+
+def enqueue_completed_jobs():
+    """Queue the notifications of the jobs that finished since the last run.
+
+    A job is finished when it completed or failed. Notifications scheduled
+    with a job become due when the job finishes. Finished jobs of users with
+    an account-level URL get a notification, unless they finished before the
+    URL was registered.
+
+    Returns:
+        int: The number of notifications queued.
+    """
+    from app.models import BatchJobs, WebhookDeliveries, WebhookEndpoints
+
+    now = naive_app_now()
+
+    # Jobs submitted with a callback URL
+    scheduled = db.session.execute(
+        update(WebhookDeliveries)
+        .where(
+            WebhookDeliveries.status == "scheduled",
+            WebhookDeliveries.job_id.in_(
+                db.select(BatchJobs.id).where(BatchJobs.finished_condition())
+            ),
+        )
+        .values(status="pending", next_attempt_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    # Jobs of accounts with a webhook URL
+    jobs = (
+        db.session.query(BatchJobs.id, BatchJobs.user_id, WebhookEndpoints.url)
+        .join(WebhookEndpoints, WebhookEndpoints.user_id == BatchJobs.user_id)
+        .outerjoin(WebhookDeliveries, WebhookDeliveries.job_id == BatchJobs.id)
+        .filter(
+            BatchJobs.finished_condition(),
+            BatchJobs.id > WebhookEndpoints.first_job_id,
+            WebhookEndpoints.url.isnot(None),
+            WebhookDeliveries.id.is_(None),
+        )
+        .limit(current_app.config["MLS_WEBHOOK_BATCH_SIZE"])
+        .all()
+    )
+
+    queued = 0
+    for job_id, user_id, url in jobs:
+        db.session.add(
+            WebhookDeliveries(
+                job_id=job_id,
+                user_id=user_id,
+                url=url,
+                status="pending",
+                next_attempt_at=now,
+            )
+        )
+        try:
+            db.session.commit()
+            queued += 1
+        except IntegrityError:
+            # Another process queued it first
+            db.session.rollback()
+
+    return scheduled + queued
+
+
+def claim_delivery(delivery):
+    """Claim a due notification so that no other process sends it meanwhile.
+
+    The next attempt is pushed past the request timeout. Only the process
+    whose update matches the attempt time it read gets the notification.
+
+    Args:
+        delivery: The WebhookDeliveries object as read.
+
+    Returns:
+        bool: Whether this process claimed the notification.
+    """
+    from app.models import WebhookDeliveries
+
+    lease = current_app.config["MLS_WEBHOOK_TIMEOUT"] * 2
+    claimed = db.session.execute(
+        update(WebhookDeliveries)
+        .where(
+            WebhookDeliveries.id == delivery.id,
+            WebhookDeliveries.status == "pending",
+            WebhookDeliveries.next_attempt_at == delivery.next_attempt_at,
+        )
+        .values(next_attempt_at=naive_app_now() + timedelta(seconds=lease))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def send_notification(delivery):
+    """Send one attempt of a notification and log its outcome.
+
+    Args:
+        delivery: The claimed WebhookDeliveries object.
+
+    Returns:
+        bool: Whether the notification was delivered.
+    """
+    from app.models import WebhookEndpoints, WebhookDeliveryAttempts
+
+    config = current_app.config
+    endpoint = WebhookEndpoints.query.filter_by(user_id=delivery.user_id).first()
+
+    body = json.dumps(
+        {
+            "event": JOB_COMPLETED_EVENT,
+            "created": int(time.time()),
+            "job": delivery.job.to_api_dict(config["MLS_WEBHOOK_LINK_EXPIRATION"]),
+        }
+    )
+
+    delivery.attempts += 1
+    delivery.last_status_code = None
+    delivery.last_error = None
+    attempted_at = naive_app_now()
+
+    try:
+        address = resolve_callback_address(delivery.url)
+
+        # The secret is created with the callback URL, so the endpoint exists
+        response = post_to_address(
+            delivery.url,
+            address,
+            body,
+            {
+                "Content-Type": "application/json",
+                SIGNATURE_HEADER: sign_payload(endpoint.secret, body),
+            },
+            config["MLS_WEBHOOK_TIMEOUT"],
+        )
+        delivery.last_status_code = response.status_code
+        delivered = 200 <= response.status_code < 300
+        if not delivered:
+            delivery.last_error = f"Unexpected status code {response.status_code}"
+    except CallbackAddressError as e:
+        # Nothing was sent
+        delivered = False
+        delivery.last_error = str(e)
+    except Exception as e:
+        delivered = False
+        delivery.last_error = str(e)[:500]
+
+    db.session.add(
+        WebhookDeliveryAttempts(
+            delivery=delivery,
+            attempted_at=attempted_at,
+            status_code=delivery.last_status_code,
+            error=delivery.last_error,
+        )
+    )
+
+    if delivered:
+        delivery.status = "delivered"
+        delivery.delivered_at = naive_app_now()
+    elif delivery.attempts >= config["MLS_WEBHOOK_MAX_ATTEMPTS"]:
+        delivery.status = "failed"
+        print(
+            f"Webhook of job {delivery.job_id} failed after {delivery.attempts} attempts."
+        )
+    else:
+        # Exponential backoff, capped at MLS_WEBHOOK_MAX_BACKOFF seconds
+        backoff = min(
+            config["MLS_WEBHOOK_BACKOFF"] * 2 ** (delivery.attempts - 1),
+            config["MLS_WEBHOOK_MAX_BACKOFF"],
+        )
+        delivery.next_attempt_at = naive_app_now() + timedelta(seconds=backoff)
+
+    db.session.commit()
+    return delivered
+
+
+def deliver_due_webhooks():
+    """Send the notifications whose next attempt is due.
+
+    Returns:
+        int: The number of notifications delivered.
+    """
+    from app.models import WebhookDeliveries
+
+    due = (
+        WebhookDeliveries.query.filter(
+            WebhookDeliveries.status == "pending",
+            WebhookDeliveries.next_attempt_at <= naive_app_now(),
+        )
+        .order_by(WebhookDeliveries.next_attempt_at)
+        .limit(current_app.config["MLS_WEBHOOK_BATCH_SIZE"])
+        .all()
+    )
+
+    delivered = 0
+    for delivery in due:
+        if claim_delivery(delivery):
+            delivered += send_notification(delivery)
+
+    return delivered
+
+
+def dispatch_job_webhooks():
+    """Queue the notifications of newly completed jobs and send the due ones.
+
+    This runs periodically in the background of each app process.
+
+    Returns:
+        int: The number of notifications delivered.
+    """
+    enqueue_completed_jobs()
+    return deliver_due_webhooks()
@@ -0,0 +1,595 @@
+"""Validation worker load balancing for the Mail List Shield application.
+
+This module tracks the latency, error rate and in-flight requests of each
+validation worker, routes requests to the least loaded healthy workers with
+the power of two choices, and ejects failing workers with a circuit breaker.
+
+The health state is shared between the app processes on the host in a
+SQLite file by default, so that a worker ejected by one process is avoided
+by all of them, or kept in the memory of each process. If the file can't
+be used, e.g. while it is locked for too long, the balancer goes on with the
+last statistics it knows in this process. The in-flight requests are always
+counted by each process, since a process that dies can't take its requests
+off a shared count.
+"""
+
+from contextlib import contextmanager
+from threading import Lock
+import json
+import os
+import random
+import sqlite3
+import time
+
+# Circuit breaker states
+CLOSED = "closed"  # Healthy, receives traffic
+OPEN = "open"  # Ejected after consecutive failures
+HALF_OPEN = "half_open"  # Cooling down is over, one probe request at a time
+
+# Seconds added to the score of a worker whose every recent request failed
+ERROR_PENALTY = 10.0
+
+
+def _run_blocking(func, *args):
+    """Call a function that may block, without blocking the other greenlets.
+
+    With the gevent worker class, the call runs in the threadpool of the
+    gevent hub, since waiting on a SQLite lock doesn't yield to the hub.
+
+    Args:
+        func: The function to call.
+        *args: The arguments of the function.
+
+    Returns:
+        The return value of the function.
+    """
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return func(*args)
+
+    if not monkey.is_module_patched("threading"):
+        return func(*args)
+    return get_hub().threadpool.apply(func, args)
+
+
+class WorkerStats:
+    """Health and load statistics of one validation worker.
+
+    Times are wall clock times, so that they mean the same in all processes.
+
+    Attributes:
+        latency: Exponentially weighted moving average of latency in seconds,
+            or None before the first response.
+        error_rate: Exponentially weighted moving average of failures (0 to 1).
+        in_flight: Number of requests sent and not answered yet by this
+            process. It is not stored.
+        state: Circuit breaker state, one of closed, open or half_open.
+        consecutive_failures: Failures since the last success.
+        opened_at: Time the circuit was last opened.
+        probing_until: Time until which a half open worker's probe request is
+            in flight. Other requests wait for its outcome until then.
+        requests: Total number of requests sent.
+        failures: Total number of failed requests.
+    """
+
+    def __init__(self):
+        """Initialize the statistics of a worker that wasn't used yet."""
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing_until = None
+        self.requests = 0
+        self.failures = 0
+
+    @classmethod
+    def from_state(cls, state):
+        """Create the statistics from their stored state.
+
+        Args:
+            state: The dictionary returned by to_state().
+
+        Returns:
+            WorkerStats: The statistics.
+        """
+        stats = cls()
+        stats.__dict__.update(state)
+        stats.in_flight = 0
+        return stats
+
+    def to_state(self):
+        """Get the statistics to store them.
+
+        Returns:
+            dict: The attributes of the statistics, except the in-flight
+                requests of this process.
+        """
+        state = dict(self.__dict__)
+        del state["in_flight"]
+        return state
+
+    def score(self):
+        """Get the load score of the worker, lower is better.
+
+        Workers without a measured latency count as instant so they get tried.
+
+        Returns:
+            float: The expected wait in seconds given the in-flight requests,
+                plus a penalty for the recent errors.
+        """
+        latency = self.latency or 0.0
+        return latency * (self.in_flight + 1) + self.error_rate * ERROR_PENALTY
+
+    def to_dict(self):
+        """Get the statistics as a dictionary for the admin pages.
+
+        Returns:
+            dict: The statistics of the worker.
+        """
+        return {
+            "latency_ms": (
+                round(self.latency * 1000, 1) if self.latency is not None else None
+            ),
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class LocalWorkerStore:
+    """Keeps the worker statistics in the memory of this process."""
+
+    def __init__(self):
+        """Initialize an empty store."""
+        self._stats = {}
+        self._lock = Lock()
+
+    def read(self, workers):
+        """Read the statistics of workers.
+
+        Args:
+            workers: The URLs of the workers.
+
+        Returns:
+            dict: A copy of the WorkerStats of each worker.
+        """
+        with self._lock:
+            return {
+                worker: WorkerStats.from_state(
+                    self._stats.get(worker, WorkerStats()).to_state()
+                )
+                for worker in workers
+            }
+
+    @contextmanager
+    def transaction(self, workers):
+        """Read and update the statistics of workers atomically.
+
+        Args:
+            workers: The URLs of the workers.
+
+        Yields:
+            dict: The WorkerStats of each worker, changes to them are kept.
+        """
+        with self._lock:
+            yield {
+                worker: self._stats.setdefault(worker, WorkerStats())
+                for worker in workers
+            }
+
+    def clear(self):
+        """Forget the statistics of all workers."""
+        with self._lock:
+            self._stats.clear()
+
+
+class SQLiteWorkerStore:
+    """Keeps the worker statistics in a SQLite file shared by the app processes.
+
+    The file is in WAL mode without a sync on every commit, so that reads
+    don't wait for the writers and commits don't wait for the disk. Reads
+    take no lock, and each write transaction takes the database write lock,
+    so the read-modify-write of the statistics is atomic across processes.
+    Only the changed statistics are written. The statements run through
+    _run_blocking(), and raise sqlite3.Error if the file stays locked.
+    """
+
+    def __init__(self, path):
+        """Initialize the store without opening the file yet.
+
+        Args:
+            path: The path of the SQLite file.
+        """
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = Lock()
+
+    def read(self, workers):
+        """Read the statistics of workers, without a write lock.
+
+        Args:
+            workers: The URLs of the workers.
+
+        Returns:
+            dict: The WorkerStats of each worker.
+        """
+        with self._lock:
+            stored = self._select(_run_blocking(self._connect))
+
+        return {
+            worker: (
+                WorkerStats.from_state(stored[worker])
+                if worker in stored
+                else WorkerStats()
+            )
+            for worker in workers
+        }
+
+    @contextmanager
+    def transaction(self, workers):
+        """Read and update the statistics of workers atomically.
+
+        Args:
+            workers: The URLs of the workers.
+
+        Yields:
+            dict: The WorkerStats of each worker, changes to them are saved.
+        """
+        with self._lock:
+            connection = _run_blocking(self._connect)
+            _run_blocking(connection.execute, "BEGIN IMMEDIATE")
+            try:
+                stored = self._select(connection)
+                stats = {
+                    worker: (
+                        WorkerStats.from_state(stored[worker])
+                        if worker in stored
+                        else WorkerStats()
+                    )
+                    for worker in workers
+                }
+
+                yield stats
+
+                changed = [
+                    (worker, worker_stats.to_state())
+                    for worker, worker_stats in stats.items()
+                ]
+                _run_blocking(
+                    connection.executemany,
+                    "INSERT OR REPLACE INTO worker_stats (worker, state) VALUES (?, ?)",
+                    [
+                        (worker, json.dumps(state))
+                        for worker, state in changed
+                        if stored.get(worker) != state
+                    ],
+                )
+                _run_blocking(connection.execute, "COMMIT")
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+    def clear(self):
+        """Forget the statistics of all workers."""
+        with self._lock:
+            connection = _run_blocking(self._connect)
+            _run_blocking(connection.execute, "DELETE FROM worker_stats")
+
+    def _select(self, connection):
+        """Read the stored state of all workers.
+
+        Must be called with the lock held.
+
+        Args:
+            connection: The connection of this process.
+
+        Returns:
+            dict: The state of each worker by URL.
+        """
+        rows = _run_blocking(
+            lambda: connection.execute(
+                "SELECT worker, state FROM worker_stats"
+            ).fetchall()
+        )
+        return {worker: json.loads(state) for worker, state in rows}
+
+    def _connect(self):
+        """Get the connection of this process, opening it if needed.
+
+        Connections are not shared with the processes forked from this one.
+        Must be called with the lock held.
+
+        Returns:
+            sqlite3.Connection: The connection in autocommit mode.
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path,
+                timeout=1,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # The statistics can lose their last writes in a power cut
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS worker_stats "
+                "(worker TEXT PRIMARY KEY, state TEXT NOT NULL)"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+
+class WorkerBalancer:
+    """Latency and health aware load balancer for the validation workers.
+
+    The health state is kept in a SQLiteWorkerStore or a LocalWorkerStore,
+    chosen with MLS_BALANCER_STATE_BACKEND. The statistics last read from or
+    written to a shared store are mirrored in memory, and used while the
+    shared store fails. The in-flight requests of this process are counted
+    in memory.
+    """
+
+    def __init__(self):
+        """Initialize the balancer with the default settings."""
+        self.ewma_alpha = 0.2
+        self.failure_threshold = 3
+        self.open_seconds = 30
+        self.store = LocalWorkerStore()
+        self._local = self.store
+        self._in_flight = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Read the balancer settings from the application configuration.
+
+        Args:
+            app: The Flask application instance.
+        """
+        self.ewma_alpha = app.config["MLS_BALANCER_EWMA_ALPHA"]
+        self.failure_threshold = app.config["MLS_BALANCER_FAILURE_THRESHOLD"]
+        self.open_seconds = app.config["MLS_BALANCER_OPEN_SECONDS"]
+
+        self._local = LocalWorkerStore()
+        match app.config["MLS_BALANCER_STATE_BACKEND"]:
+            case "local":
+                self.store = self._local
+            case "sqlite":
+                self.store = SQLiteWorkerStore(app.config["MLS_BALANCER_STATE_PATH"])
+            case backend:
+                raise ValueError(f"Unknown worker balancer state backend {backend}.")
+
+    def ranked(self, workers):
+        """Order the available workers by preference.
+
+        The first worker is picked with the power of two choices: the less
+        loaded of two random available workers. The rest follow from the least
+        to the most loaded. Workers with an open circuit are left out, except
+        for a single probe once their cooldown is over. When no worker is
+        available at all, the one ejected the longest ago is still probed
+        rather than failing every validation until a cooldown ends.
+
+        Args:
+            workers: The URLs of the configured workers.
+
+        Returns:
+            list: The URLs of the workers to try, in order.
+        """
+        now = time.time()
+        all_stats = self._read(workers)
+
+        # Circuits whose cooldown is over are half opened, in a write
+        # transaction so that the processes agree on the state
+        cooled = [
+            worker
+            for worker, stats in all_stats.items()
+            if stats.state == OPEN and now - stats.opened_at >= self.open_seconds
+        ]
+        if cooled:
+            with self._transaction(cooled) as cooled_stats:
+                for worker, stats in cooled_stats.items():
+                    if (
+                        stats.state == OPEN
+                        and now - stats.opened_at >= self.open_seconds
+                    ):
+                        stats.state = HALF_OPEN
+                    all_stats[worker].__dict__.update(stats.to_state())
+
+        available = []
+        for worker, stats in all_stats.items():
+            # A half open worker only takes one probe request at a time
+            if stats.state == CLOSED or (
+                stats.state == HALF_OPEN
+                and (stats.probing_until is None or stats.probing_until < now)
+            ):
+                available.append(worker)
+
+        if not available and all_stats:
+            oldest = min(all_stats, key=lambda worker: all_stats[worker].opened_at or 0)
+            print(f"All the workers are ejected, probing {oldest}.")
+            return [oldest]
+
+        scores = {worker: all_stats[worker].score() for worker in available}
+        ranked = sorted(available, key=lambda w: scores[w])
+
+        # Power of two choices for the first worker
+        if len(ranked) > 2:
+            first, second = random.sample(ranked, 2)
+            if scores[second] < scores[first]:
+                first = second
+            ranked.remove(first)
+            ranked.insert(0, first)
+
+        return ranked
+
+    def start(self, worker):
+        """Record that a request is sent to a worker.
+
+        Only the probe request of a half open worker is written to the store.
+
+        Args:
+            worker: The URL of the worker.
+
+        Returns:
+            float: The start time to pass to finish().
+        """
+        with self._lock:
+            self._in_flight[worker] = self._in_flight.get(worker, 0) + 1
+        probing = self._local.read([worker])[worker].state == HALF_OPEN
+
+        # Hold off other requests until the probe's outcome is known
+        if probing:
+            with self._transaction([worker]) as all_stats:
+                stats = all_stats[worker]
+                if stats.state == HALF_OPEN:
+                    stats.probing_until = time.time() + self.open_seconds
+
+        return time.monotonic()
+
+    def finish(self, worker, started, ok):
+        """Record the outcome of a request to a worker.
+
+        Args:
+            worker: The URL of the worker.
+            started: The start time returned by start().
+            ok: Whether the worker returned a response, or None if the request
+                was cut short by the caller and says nothing about the worker.
+        """
+        latency = time.monotonic() - started
+        alpha = self.ewma_alpha
+
+        with self._lock:
+            self._in_flight[worker] = max(0, self._in_flight.get(worker, 0) - 1)
+        probing = self._local.read([worker])[worker].state == HALF_OPEN
+
+        if ok is None:
+            # Let the next request probe the worker again
+            if probing:
+                with self._transaction([worker]) as all_stats:
+                    all_stats[worker].probing_until = None
+            return
+
+        with self._transaction([worker]) as all_stats:
+            stats = all_stats[worker]
+            stats.requests += 1
+            stats.probing_until = None
+            stats.error_rate = alpha * (0 if ok else 1) + (1 - alpha) * stats.error_rate
+
+            if ok:
+                stats.latency = (
+                    latency
+                    if stats.latency is None
+                    else alpha * latency + (1 - alpha) * stats.latency
+                )
+                stats.consecutive_failures = 0
+                stats.state = CLOSED
+            else:
+                stats.failures += 1
+                stats.consecutive_failures += 1
+
+                # A failed probe or too many failures in a row eject the worker
+                if (
+                    stats.state == HALF_OPEN
+                    or stats.consecutive_failures >= self.failure_threshold
+                ):
+                    if stats.state != OPEN:
+                        print(f"Worker {worker} is ejected after failing.")
+                    stats.state = OPEN
+                    stats.opened_at = time.time()
+
+    def snapshot(self, workers):
+        """Get the statistics of the workers for the admin pages.
+
+        Args:
+            workers: The URLs of the configured workers.
+
+        Returns:
+            dict: The statistics of each worker by URL.
+        """
+        return {
+            worker: stats.to_dict() for worker, stats in self._read(workers).items()
+        }
+
+    def reset(self):
+        """Forget the statistics of all workers."""
+        try:
+            self.store.clear()
+        except sqlite3.Error as e:
+            print(f"Clearing the shared worker statistics failed: {e}")
+        self._local.clear()
+        with self._lock:
+            self._in_flight.clear()
+
+    def _read(self, workers):
+        """Read the statistics of workers with the in-flight requests of this process.
+
+        Args:
+            workers: The URLs of the workers.
+
+        Returns:
+            dict: The WorkerStats of each worker.
+        """
+        try:
+            all_stats = self.store.read(workers)
+            self._mirror(all_stats)
+        except sqlite3.Error as e:
+            print(f"Reading the shared worker statistics failed, using local ones: {e}")
+            all_stats = self._local.read(workers)
+
+        with self._lock:
+            for worker, stats in all_stats.items():
+                stats.in_flight = self._in_flight.get(worker, 0)
+        return all_stats
+
+    @contextmanager
+    def _transaction(self, workers):
+        """Update the statistics of workers in the store, or in memory if it fails.
+
+        Args:
+            workers: The URLs of the workers.
+
+        Yields:
+            dict: The WorkerStats of each worker, changes to them are kept.
+        """
+        updated = None
+        try:
+            with self.store.transaction(workers) as all_stats:
+                updated = all_stats
+                yield all_stats
+        except sqlite3.Error as e:
+            print(
+                f"Updating the shared worker statistics failed, using local ones: {e}"
+            )
+            if updated is None:
+                # Nothing was changed yet, change the local statistics
+                with self._local.transaction(workers) as all_stats:
+                    yield all_stats
+                return
+
+        # Changes whose commit failed are still kept locally
+        self._mirror(updated)
+
+    def _mirror(self, all_stats):
+        """Copy statistics from the shared store to the local ones.
+
+        Args:
+            all_stats: The WorkerStats of workers by URL.
+        """
+        if self.store is self._local:
+            return
+
+        with self._local.transaction(list(all_stats)) as local_stats:
+            for worker, stats in all_stats.items():
+                local_stats[worker].__dict__.update(stats.to_state())
+
+
+# Shared by all requests handled by this process
+worker_balancer = WorkerBalancer()
@@ -13,7 +13,10 @@ from jinja2 import TemplateNotFound
 
 from app import lm, db
 from app.models import Users, BatchJobs
-from app.utilities.validation import validate_email
+from app.utilities.validation import validate_email, ValidationDeadlineExceeded
+from app.utilities.admission import ValidationOverloaded, lane_for_user
+from app.utilities.credit_leases import credit_leases
+from app.utilities.credit_ledger import WEB_SOURCE
 from app.utilities.error_handlers import error_page
 from app.utilities.object_storage import generate_upload_link_validation_file
 
@@ -209,6 +212,8 @@ def validate():
             - 402: Insufficient credits.
             - 403: Email not confirmed.
             - 500: Server error.
+            - 503: No worker answered before the deadline, or too many
+              validations are in progress (with a Retry-After header).
     """
     # Grab the email from the request
     email = request.form.get("email")
@@ -216,8 +221,11 @@ def validate():
     # Process the validation request
     # At this point, the user is either logged in and has credits,
     # or is an anonymous user and can only do this until the limit is reached
+    # Paid tiers get priority over free accounts and anonymous demo requests
+    lane = lane_for_user(current_user)
+
     try:
-        response = validate_email(email)
+        response = validate_email(email, lane=lane)
         if response:
             # If user is logged in, use their credits
             if is_user_logged_in():
@@ -226,9 +234,7 @@ def validate():
 
                 # Deduct credits from the user
                 # We waited until here to ensure we are delivering a result before deducting a credit
-                if current_user.credits > 0:
-                    current_user.deduct_credits(1)
-                else:
+                if not credit_leases.consume(current_user, 1, WEB_SOURCE):
                     return "", 402
 
             # Return the response from the worker
@@ -236,6 +242,12 @@ def validate():
         else:
             print("Validation response from the worker is None")
             return "", 500
+    except ValidationOverloaded as e:
+        print(f"Validation request turned away: {e}")
+        return "", 503, {"Retry-After": str(e.retry_after)}
+    except ValidationDeadlineExceeded as e:
+        print(f"Validation request timed out: {e}")
+        return "", 503
     except Exception as e:
         print(f"Validation request failed: {e}")
         return "", 500
@@ -1,25 +1,50 @@
 """API views and routes for the Mail List Shield application.
 
-This module defines the REST API endpoints for email validation,
-credit balance retrieval, and API key testing.
+This module defines the REST API endpoints for single and bulk email
+validation, batch validation job submission, status and completion
+webhooks, credit balance retrieval, and API key testing.
 """
 
+import json
+
 # Flask modules
 from flask import (
     Blueprint,
+    Response,
     abort,
+    current_app,
+    g,
     jsonify,
     make_response,
     request,
+    stream_with_context,
 )
+from werkzeug.utils import secure_filename
 
 
 # App modules
-from app import csrf
-from app.models import Users, APIKeys
+from app import csrf, db
+from app.models import Users, APIKeys, BatchJobs, WebhookEndpoints
 from app.views import limiter
 from app.config import appTimezone
-from app.utilities.validation import validate_email
+from app.utilities.validation import (
+    validate_email,
+    validate_emails,
+    validate_emails_as_completed,
+    ValidationDeadlineExceeded,
+)
+from app.utilities.admission import ValidationOverloaded, lane_for_user
+from app.utilities.result_cache import normalize_email
+from app.utilities.object_storage import (
+    api_validation_file_prefix,
+    generate_upload_link_api_validation_file,
+    upload_api_validation_list,
+)
+from app.utilities.api_keys import verified_api_keys, last_used_buffer
+from app.utilities.credit_leases import credit_leases
+from app.utilities.credit_ledger import API_SOURCE
+from app.utilities.helpers import generate_webhook_secret
+from app.utilities.webhooks import is_valid_callback_url, schedule_job_webhook
 
 api_bp = Blueprint("api_bp", __name__)
 
@@ -107,6 +132,25 @@ def insufficient_credit_response():
     )
 
 
+def overloaded_response(error):
+    """Abort the request with a 503 Service Unavailable error when overloaded.
+
+    Args:
+        error: The ValidationOverloaded exception, giving the Retry-After delay.
+    """
+    response = make_response(
+        jsonify(
+            {
+                "status": "error",
+                "message": "Too many validations are in progress. Please retry after the delay in the Retry-After header.",
+            }
+        ),
+        503,
+    )
+    response.headers["Retry-After"] = str(error.retry_after)
+    abort(response)
+
+
 def validate_request_json(request):
     """Validate that the request has JSON content type and a JSON body.
 
@@ -144,33 +188,44 @@ def get_user_from_api_key(request):
     if not api_key:
         no_api_key_response()
 
-    # Fetch all active API keys from the database
-    all_keys = APIKeys.query.filter_by(is_active=True).all()
-    if not all_keys:
-        invalid_api_key_response()
-
-    # Check if the provided API key matches any stored hashed keys
-    matching_key = None
-    for key in all_keys:
-        if key.check_key(api_key):
-            matching_key = key
-            break
-
-    if not matching_key:
-        invalid_api_key_response()
-
-    # Update the last used timestamp for the API key
-    matching_key.update_last_used()
-
-    # Fetch the user associated with the matching API key
+    # Keys verified recently don't need their hash checked again
+    verified_key = verified_api_keys.get(api_key)
+    if not verified_key:
+        # Find the active API key by its prefix and check its hash
+        matching_key = APIKeys.find_by_key(api_key)
+        if not matching_key:
+            invalid_api_key_response()
+        verified_key = verified_api_keys.add(api_key, matching_key)
+
+    # Fetch the user of the key, in the same query as the key is checked to
+    # be still usable, since it may have been revoked by another process
     user = (
-        Users.query.filter_by(id=matching_key.user_id).first() if matching_key else None
+        Users.query.join(APIKeys, APIKeys.user_id == Users.id)
+        .filter(APIKeys.id == verified_key.id, *APIKeys.usable_conditions())
+        .first()
     )
     if not user:
+        verified_api_keys.forget(verified_key.id)
         invalid_api_key_response()
+
+    # Record the last used timestamp for the API key, it is saved in batches
+    last_used_buffer.touch(verified_key.id)
+
+    # The credits spent by the request are recorded with the key
+    g.api_key_id = verified_key.id
+
     return user
 
 
+def api_key_reference():
+    """Get the reference of the API key of the request for the credit ledger.
+
+    Returns:
+        str: The ID of the API key found by get_user_from_api_key().
+    """
+    return f"api_key:{g.api_key_id}"
+
+
 def successful_validation_response(result):
     """Return a standardized successful validation response.
 
@@ -256,7 +311,7 @@ def get_credit_balance():
     return {
         "status": "success",
         "message": "Credit balance retrieved successfully.",
-        "balance": user.credits,
+        "balance": user.credit_balance,
     }
 
 
@@ -279,7 +334,8 @@ def validate_single():
             - 400: Missing email key in request.
             - 402: Insufficient credits.
             - 500: Internal server error.
-            - 503: Validation service unavailable.
+            - 503: Validation service unavailable, too slow, or overloaded
+              (with a Retry-After header).
     """
 
     # Validate the request JSON
@@ -290,7 +346,7 @@ def validate_single():
     user = get_user_from_api_key(request)
 
     # Check if the user has enough credits
-    if user.credits < 1:
+    if user.credit_balance < 1:
         insufficient_credit_response()
 
     # Try to process the validation request
@@ -300,10 +356,15 @@ def validate_single():
             missing_key_in_json_response("email")
 
         # Process the validation request
-        validation_worker_response = validate_email(email)
+        validation_worker_response = validate_email(email, lane=lane_for_user(user))
         if validation_worker_response:
             # Deduct a credit from the user as we are giving them a result
-            user.deduct_credits(1)
+            # The balance may have been spent by a concurrent request meanwhile
+            if not credit_leases.consume(user, 1, API_SOURCE, api_key_reference()):
+                return {
+                    "status": "error",
+                    "message": "Insufficient credits to perform this action. Please top up your account.",
+                }, 402
 
             # Return the response from the worker
             return successful_validation_response(validation_worker_response)
@@ -314,9 +375,505 @@ def validate_single():
                 "message": "Unable to process the validation request due to an issue with our validation system.",
             }, 503  # Service Unavailable
 
+    except ValidationOverloaded as e:
+        print(f"Validation request turned away: {e}")
+        return overloaded_response(e)
+
+    except ValidationDeadlineExceeded as e:
+        print(f"Validation request timed out: {e}")
+        return {
+            "status": "error",
+            "message": "Our validation system did not respond in time. Please try again later.",
+        }, 503  # Service Unavailable
+
     except Exception as e:
         print(f"Validation request failed: {e}")
         return {
             "status": "error",
             "message": "Internal server error during email validation.",
         }, 500
+
+
+def get_emails_from_request_json(request, max_emails=None):
+    """Get the normalized, unique email addresses from a bulk request.
+
+    Args:
+        request: The Flask request object with an "emails" list in its JSON body.
+        max_emails: Maximum number of addresses. Defaults to MLS_BULK_MAX_EMAILS.
+
+    Returns:
+        list: The normalized addresses without duplicates, in their first order.
+
+    Note:
+        Aborts the request with a 400 error if the list is missing, invalid,
+        or longer than the maximum.
+    """
+    emails = request.json.get("emails", None)
+    if not emails:
+        missing_key_in_json_response("emails")
+
+    if not isinstance(emails, list) or not all(
+        isinstance(email, str) and email.strip() for email in emails
+    ):
+        abort(
+            make_response(
+                jsonify(
+                    {
+                        "status": "error",
+                        "message": "'emails' must be a list of email addresses.",
+                    }
+                ),
+                400,
+            )
+        )
+
+    # Normalize and dedupe, keeping the order of the first occurrences
+    emails = list(dict.fromkeys(normalize_email(email) for email in emails))
+
+    if max_emails is None:
+        max_emails = current_app.config["MLS_BULK_MAX_EMAILS"]
+    if len(emails) > max_emails:
+        abort(
+            make_response(
+                jsonify(
+                    {
+                        "status": "error",
+                        "message": f"Too many email addresses. Please send at most {max_emails} per request.",
+                    }
+                ),
+                400,
+            )
+        )
+
+    return emails
+
+
+def bulk_validation_entry(email, result):
+    """Build the response entry of one address of a bulk validation.
+
+    Args:
+        email: The normalized email address.
+        result: The validation result, or None if the validation failed.
+
+    Returns:
+        dict: The address with its result, or with an error message.
+    """
+    if result:
+        return {"email": email, "status": "success", "result": result}
+
+    return {
+        "email": email,
+        "status": "error",
+        "message": "Unable to validate this email address, no credit is deducted for it.",
+    }
+
+
+def stream_bulk_validation(user, emails):
+    """Stream the results of a bulk validation as newline delimited JSON.
+
+    One line is written per address as soon as its result arrives, and a
+    credit is deducted for each delivered result before its line is written.
+    The last line summarizes the request.
+
+    Args:
+        user: The Users object to charge.
+        emails: The normalized, unique email addresses to validate.
+
+    Yields:
+        str: One JSON document per line.
+    """
+    delivered = 0
+
+    try:
+        for email, result in validate_emails_as_completed(
+            emails, lane=lane_for_user(user)
+        ):
+            if result:
+                if not credit_leases.consume(user, 1, API_SOURCE, api_key_reference()):
+                    # The balance was spent by a concurrent request meanwhile
+                    yield json.dumps(
+                        {
+                            "status": "error",
+                            "message": "Insufficient credits to perform this action. Please top up your account.",
+                        }
+                    ) + "\n"
+                    return
+                delivered += 1
+            yield json.dumps(bulk_validation_entry(email, result)) + "\n"
+    except ValidationOverloaded as e:
+        print(f"Streaming bulk validation request turned away: {e}")
+        yield json.dumps(
+            {
+                "status": "error",
+                "message": f"Too many validations are in progress. Please retry after {e.retry_after} seconds.",
+            }
+        ) + "\n"
+        return
+    except Exception as e:
+        print(f"Streaming bulk validation request failed: {e}")
+        yield json.dumps(
+            {
+                "status": "error",
+                "message": "Internal server error during email validation.",
+            }
+        ) + "\n"
+        return
+
+    yield json.dumps(
+        {
+            "status": "success",
+            "message": f"{delivered} email addresses are validated and {delivered} credits are deducted from your account.",
+        }
+    ) + "\n"
+
+
+@api_bp.route("/validate-emails", methods=["POST"])
+@limiter.limit("50 per hour", methods=["POST"])
+@csrf.exempt
+def validate_bulk():
+    """The API endpoint to validate a list of email addresses.
+
+    This endpoint requires the request content-type to be application/json
+    and a JSON body with an "emails" key listing the addresses. The addresses
+    are normalized and deduplicated, then validated concurrently. One credit
+    is deducted for each address whose result is delivered.
+
+    Optionally, the request JSON can include a boolean key "stream". If set to
+    true, the response is newline delimited JSON with one line per address,
+    written as the results arrive, followed by a summary line.
+
+    Returns:
+        Response: JSON response with the result of each address or error message.
+            - 200: The addresses are processed, see each result.
+            - 400: Missing, invalid or too many email addresses.
+            - 402: Insufficient credits for all the addresses.
+            - 500: Internal server error.
+            - 503: The credits are held by other app processes for now
+              (with a Retry-After header).
+    """
+
+    # Validate the request JSON
+    validate_request_json(request)
+
+    # Find the user associated with the provided API key
+    # (Error handling is abstracted into the function)
+    user = get_user_from_api_key(request)
+
+    emails = get_emails_from_request_json(request)
+
+    # Check if the user has enough credits for every address
+    if user.credit_balance < len(emails):
+        insufficient_credit_response()
+
+    # Write the results as they arrive instead of holding them all
+    if request.json.get("stream", False) == True:
+        return Response(
+            stream_with_context(stream_bulk_validation(user, emails)),
+            mimetype="application/x-ndjson",
+        )
+
+    try:
+        results = validate_emails(emails, lane=lane_for_user(user))
+    except Exception as e:
+        print(f"Bulk validation request failed: {e}")
+        return {
+            "status": "error",
+            "message": "Internal server error during email validation.",
+        }, 500
+
+    # Deduct credits only for the results we are giving
+    delivered = sum(1 for result in results.values() if result)
+    try:
+        if delivered and not credit_leases.consume(
+            user, delivered, API_SOURCE, api_key_reference()
+        ):
+            # The balance was spent by a concurrent request meanwhile
+            insufficient_credit_response()
+    except ValidationOverloaded as e:
+        print(f"Bulk validation request turned away: {e}")
+        return overloaded_response(e)
+
+    return {
+        "status": "success",
+        "message": f"{delivered} email addresses are validated and {delivered} credits are deducted from your account.",
+        "results": [
+            bulk_validation_entry(email, result) for email, result in results.items()
+        ],
+    }
+
+
+def job_status_response(job):
+    """Build the API representation of a batch validation job.
+
+    Args:
+        job: The BatchJobs object.
+
+    Returns:
+        dict: The job uid, status, progress, and completion webhook if any.
+    """
+    response = job.to_api_dict()
+    if job.webhook_delivery:
+        response["webhook"] = job.webhook_delivery.to_api_dict()
+    return response
+
+
+def invalid_callback_url_response():
+    """Abort the request with a 400 Bad Request error for unusable webhook URLs."""
+    abort(
+        make_response(
+            jsonify(
+                {
+                    "status": "error",
+                    "message": "Invalid callback URL. Please provide a public HTTPS URL.",
+                }
+            ),
+            400,
+        )
+    )
+
+
+@api_bp.route("/jobs/upload-link", methods=["POST"])
+@limiter.limit("50 per hour", methods=["POST"])
+@csrf.exempt
+def job_upload_link():
+    """The API endpoint to get a pre-signed link to upload a batch validation file.
+
+    This endpoint requires a JSON body with a "file_name" key, and optionally
+    a "file_type" key with the MIME type of the file (defaults to text/csv).
+    After uploading the file with the returned form fields, submit the job
+    with the returned "file" key to /api/jobs.
+
+    Returns:
+        Response: JSON response with the upload form and the key of the file.
+            - 200: The upload link is generated.
+            - 400: Missing file name.
+    """
+
+    # Validate the request JSON
+    validate_request_json(request)
+
+    # Find the user associated with the provided API key
+    # (Error handling is abstracted into the function)
+    user = get_user_from_api_key(request)
+
+    file_name = secure_filename(request.json.get("file_name", None) or "")
+    if not file_name:
+        missing_key_in_json_response("file_name")
+
+    upload = json.loads(
+        generate_upload_link_api_validation_file(
+            user, request.json.get("file_type", None) or "text/csv", file_name
+        )
+    )
+
+    return {
+        "status": "success",
+        "message": "Upload the file with a POST request to the url, including the fields, then submit the job with the file key.",
+        "upload": upload["data"],
+        "file": upload["data"]["fields"]["key"],
+    }
+
+
+@api_bp.route("/jobs", methods=["POST"])
+@limiter.limit("50 per hour", methods=["POST"])
+@csrf.exempt
+def submit_job():
+    """The API endpoint to submit a batch validation job.
+
+    This endpoint requires a JSON body with either an "emails" key listing the
+    addresses, or a "file" key with the key of a file uploaded with a link
+    from /api/jobs/upload-link. For an uploaded file, "email_column" is required
+    and names the column of the addresses, and "header_row" tells whether the
+    first row is a header (defaults to true). A list of addresses is written
+    to a file with an "email" column, so "email_column" is not used for it.
+
+    The job is queued for the batch validation backend and its uid is returned
+    right away. Its progress is available at /api/jobs/<uid>. Optionally, a
+    "callback_url" key gives a URL to notify when the job completes, instead
+    of polling. The first time, the response includes the "webhook_secret"
+    that signs the notifications.
+
+    Returns:
+        Response: JSON response with the job or error message.
+            - 202: The job is queued.
+            - 400: Missing, invalid or too many email addresses, invalid file,
+                missing email column of a file, or invalid callback URL.
+            - 402: Insufficient credits.
+    """
+
+    # Validate the request JSON
+    validate_request_json(request)
+
+    # Find the user associated with the provided API key
+    # (Error handling is abstracted into the function)
+    user = get_user_from_api_key(request)
+
+    callback_url = request.json.get("callback_url", None)
+    if callback_url and not is_valid_callback_url(callback_url):
+        invalid_callback_url_response()
+
+    if request.json.get("file", None):
+        uploaded_file = request.json["file"]
+
+        # Only accept the files uploaded with this user's links
+        if not isinstance(uploaded_file, str) or not uploaded_file.startswith(
+            api_validation_file_prefix(user)
+        ):
+            abort(
+                make_response(
+                    jsonify(
+                        {
+                            "status": "error",
+                            "message": "Unknown file. Please upload it with a link from /api/jobs/upload-link.",
+                        }
+                    ),
+                    400,
+                )
+            )
+
+        # The batch backend can't tell which column of a file has the addresses
+        email_column = request.json.get("email_column", None)
+        if not isinstance(email_column, str) or not email_column.strip():
+            missing_key_in_json_response("email_column")
+
+        if user.credit_balance < 1:
+            insufficient_credit_response()
+
+        job = BatchJobs(
+            user=user,
+            source="api",
+            uploaded_file=uploaded_file,
+            original_file_name=uploaded_file.rsplit("/", 1)[-1],
+            email_column=email_column.strip(),
+            header_row=0 if request.json.get("header_row", True) == False else 1,
+        )
+    else:
+        emails = get_emails_from_request_json(
+            request, current_app.config["MLS_API_JOB_MAX_EMAILS"]
+        )
+
+        # Check if the user has enough credits for every address
+        if user.credit_balance < len(emails):
+            insufficient_credit_response()
+
+        uploaded_file = upload_api_validation_list(user, emails)
+        job = BatchJobs(
+            user=user,
+            source="api",
+            uploaded_file=uploaded_file,
+            original_file_name=uploaded_file.rsplit("/", 1)[-1],
+            email_column="email",
+            header_row=1,
+            row_count=len(emails),
+        )
+
+    db.session.add(job)
+
+    # Notify this URL when the job completes
+    response = {"status": "success", "message": "The job is queued for validation."}
+    if callback_url:
+        endpoint, created = WebhookEndpoints.for_user(user)
+        schedule_job_webhook(job, callback_url)
+
+        # Show the signing secret the first time it is used
+        if created:
+            response["webhook_secret"] = endpoint.secret
+
+    db.session.commit()
+
+    response["job"] = job_status_response(job)
+    return response, 202
+
+
+@api_bp.route("/jobs/<uid>", methods=["GET", "POST"])
+@limiter.limit("600 per hour", methods=["GET", "POST"])
+@csrf.exempt
+def job_status(uid):
+    """The API endpoint to get the status and progress of a batch validation job.
+
+    This endpoint forgives requests without their content-type
+    set to application/json, because it doesn't read your request body.
+
+    Args:
+        uid: The uid of the job returned when it was submitted.
+
+    Returns:
+        Response: JSON response with the job or error message.
+            - 200: The job is found.
+            - 404: No job of this user has this uid.
+    """
+    # Find the user associated with the provided API key
+    # (Error handling is abstracted into the function)
+    user = get_user_from_api_key(request)
+
+    # Don't tell whether the job exists if it belongs to another user
+    job = BatchJobs.query.filter_by(user_id=user.id, uid=uid).first()
+    if not job:
+        return {"status": "error", "message": "Job not found."}, 404
+
+    return {
+        "status": "success",
+        "message": "Job status retrieved successfully.",
+        "job": job_status_response(job),
+    }
+
+
+@api_bp.route("/webhook", methods=["POST"])
+@limiter.limit("50 per hour", methods=["POST"])
+@csrf.exempt
+def account_webhook():
+    """The API endpoint to set the URL notified when any batch job completes.
+
+    This endpoint requires a JSON body with a "url" key, set to null to stop
+    the account-level notifications. Jobs completed before the URL is set
+    are not notified. Set the optional "rotate_secret" key to true to replace
+    the signing secret.
+
+    Each notification is a POST request with a JSON body, signed in the
+    X-MLS-Signature header as "t=<unix time>,v1=<signature>", where the
+    signature is the hex HMAC-SHA256 of "<unix time>.<body>" with the secret.
+
+    Returns:
+        Response: JSON response with the webhook settings and signing secret.
+            - 200: The settings are saved.
+            - 400: Missing or invalid URL.
+    """
+
+    # Validate the request JSON
+    validate_request_json(request)
+
+    # Find the user associated with the provided API key
+    # (Error handling is abstracted into the function)
+    user = get_user_from_api_key(request)
+
+    if "url" not in request.json:
+        missing_key_in_json_response("url")
+
+    url = request.json["url"]
+    if url is not None and not is_valid_callback_url(url):
+        invalid_callback_url_response()
+
+    endpoint, _ = WebhookEndpoints.for_user(user)
+    if url != endpoint.url:
+        # Only the jobs completed from now on are notified
+        endpoint.first_job_id = (
+            db.session.query(db.func.max(BatchJobs.id))
+            .filter_by(user_id=user.id)
+            .scalar()
+            or 0
+        )
+    endpoint.url = url
+    if request.json.get("rotate_secret", False) == True:
+        endpoint.secret = generate_webhook_secret()
+    db.session.commit()
+
+    return {
+        "status": "success",
+        "message": (
+            "Completed batch jobs will be notified at this URL."
+            if url
+            else "Completed batch jobs will only be notified at their own callback URL."
+        ),
+        "url": endpoint.url,
+        "secret": endpoint.secret,
+    }
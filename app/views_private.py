@@ -31,8 +31,18 @@ from app.forms import ProfileDetailsForm, CreateAPIKeyForm
 from app.models import Users, Tiers, BatchJobs, APIKeys
 from app.utilities.object_storage import generate_upload_link_profile_picture
 from app.utilities.error_handlers import error_page
-from app.utilities.stripe_event_handler import handle_stripe_event
+from app.utilities.stripe_events import store_stripe_event
+from app.utilities.stripe_charges import charge_history
 from app.utilities.helpers import generate_api_key_and_hash
+from app.utilities.api_keys import verified_api_keys
+from app.utilities.worker_balancer import worker_balancer
+from app.utilities.validation import validation_flights
+from app.utilities.result_cache import result_cache
+from app.utilities.prescreen import prescreen
+from app.utilities.domain_cache import domain_cache
+from app.utilities.admission import admission
+from app.utilities.credit_leases import credit_leases
+from app.utilities.credit_ledger import credit_ledger
 
 # Instantiate the Blueprint
 private_bp = Blueprint("private_bp", __name__)
@@ -103,13 +113,13 @@ def webhook(path):
             # The endpoint where stripe sends the webhook events
             case "stripe":
                 # Verify that the incoming request is from Stripe
+                payload = request.data.decode("utf-8")
                 try:
                     event = stripe.webhook.Webhook.construct_event(
-                        request.data.decode("utf-8"),
+                        payload,
                         request.headers.get("Stripe-Signature", None),
                         current_app.config["STRIPE_WEBHOOK_SECRET"],
                     )
-                    handle_stripe_event(event)
 
                 except ValueError:
                     return error_page(400)
@@ -120,15 +130,16 @@ def webhook(path):
                     )
                     return error_page(400)
 
+                # Store the event to process it in the background, Stripe
+                # delivers it again unless we acknowledge it
+                try:
+                    store_stripe_event(event, payload)
                 except Exception as e:
-                    print(
-                        f"Unhandled error while processing Stripe webhook request: {e}"
-                    )
+                    print(f"Error while storing Stripe webhook event: {e}")
                     return error_page(500)
 
-                # Return a response to acknowledge the receipt of the event
-                finally:
-                    return jsonify("success=True"), 200
+                # Acknowledge the receipt of the event, redeliveries included
+                return jsonify("success=True"), 200
 
             # Non-existent webhook path
             case _:
@@ -214,6 +225,9 @@ def api_keys(path):
                     api_key.is_active = False
                     api_key.save()
 
+                    # Stop accepting the key from the verified keys cache
+                    verified_api_keys.forget(api_key.id)
+
                     return jsonify({"success": True}), 200
                 except Exception as e:
                     print(f"Error revoking API key: {e}")
@@ -224,8 +238,8 @@ def api_keys(path):
 
             case "create":
                 try:
-                    # Generate a new API key and its hash
-                    new_key, key_hash = generate_api_key_and_hash()
+                    # Generate a new API key, its public prefix, and its hash
+                    new_key, key_prefix, key_hash = generate_api_key_and_hash()
 
                     # Prepare expiration date
                     expires_at = form.expires_at.data if form.expires_at.data else None
@@ -233,6 +247,7 @@ def api_keys(path):
                     api_key = APIKeys(
                         user=current_user,
                         key_hash=key_hash,
+                        key_prefix=key_prefix,
                         label=request.form.get("label", None, type=str),
                         expires_at=expires_at,
                     )
@@ -482,12 +497,11 @@ def billing(path):
                 return redirect(checkout_session.url, code=303)
 
             case _:
+                # The charges are read from the cache, refreshed in the background
                 customer_id = current_user.stripe_customer_id
-                charges = None
+                charges = []
                 if customer_id != None:
-                    charges = stripe.Charge.list(
-                        customer=customer_id, status="succeeded", limit=100
-                    )
+                    charges = charge_history(customer_id)
 
                 return render_template(
                     f"private/billing/{path}.html",
@@ -643,6 +657,35 @@ def admin(path):
         except TemplateNotFound:
             return "Email template not found.", 404
 
+    # The load balancer's view of the validation workers in this process
+    if path == "workers":
+        return render_template(
+            "private/admin/workers.html",
+            path=path,
+            user=current_user,
+            workers=worker_balancer.snapshot(current_app.config["MLS_WORKERS"]),
+            flights=validation_flights.stats(),
+            result_cache=result_cache.stats(),
+            prescreen=prescreen.stats(),
+            domain_cache=domain_cache.stats(),
+            admission=admission.stats(),
+        )
+
+    # The same statistics as JSON, for monitoring tools to scrape
+    if path == "metrics":
+        return jsonify(
+            {
+                "admission": admission.stats(),
+                "validation_flights": validation_flights.stats(),
+                "result_cache": result_cache.stats(),
+                "prescreen": prescreen.stats(),
+                "domain_cache": domain_cache.stats(),
+                "api_keys": verified_api_keys.stats(),
+                "credit_leases": credit_leases.stats(),
+                "credit_ledger": credit_ledger.stats(),
+            }
+        )
+
     # Try to find the matching admin page template
     try:
         # If the path matches a template, return the template
@@ -0,0 +1 @@
+"""Benchmarks for the Mail List Shield application, run as scripts."""
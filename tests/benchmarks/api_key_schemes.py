@@ -0,0 +1,93 @@
+"""Benchmark of API key verification latency by hashing scheme.
+
+Compares checking an API key hashed with bcrypt, the scheme used before,
+with the peppered HMAC-SHA256 scheme, using the same code as the API.
+
+Run from the repository root with the app's environment variables set:
+
+    python -m tests.benchmarks.api_key_schemes [iterations]
+"""
+
+from types import SimpleNamespace
+import statistics
+import sys
+import time
+
+from app import create_app, bc
+from app.utilities.helpers import (
+    generate_api_key_and_hash,
+    API_KEY_HASH_BCRYPT,
+    API_KEY_HASH_HMAC,
+)
+
+
+def time_check(check, key_plain, iterations):
+    """Time the verification of a key.
+
+    Args:
+        check: A function that verifies a plaintext key.
+        key_plain: The plaintext API key.
+        iterations: How many times to check the key.
+
+    Returns:
+        list: The duration of each check in milliseconds.
+    """
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        assert check(key_plain)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def main(iterations=20):
+    """Print the verification latency of both schemes.
+
+    Args:
+        iterations: How many times to check the key with each scheme.
+    """
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        from app.models import APIKeys
+
+        key_plain, key_prefix, hmac_hash = generate_api_key_and_hash()
+        bcrypt_hash = bc.generate_password_hash(key_plain).decode("utf8")
+
+        # A transient key, nothing is written to the database
+        hmac_key = APIKeys(
+            user=SimpleNamespace(id=None),
+            key_hash=hmac_hash,
+            key_prefix=key_prefix,
+            hash_scheme=API_KEY_HASH_HMAC,
+        )
+
+        # APIKeys.check_key would rehash a matching bcrypt key, so we time
+        # the bcrypt comparison the old scheme ran on every request
+        results = {
+            API_KEY_HASH_BCRYPT: time_check(
+                lambda key: bc.check_password_hash(bcrypt_hash, key),
+                key_plain,
+                iterations,
+            ),
+            API_KEY_HASH_HMAC: time_check(hmac_key.check_key, key_plain, iterations),
+        }
+
+    print(f"API key verification latency over {iterations} checks (ms)")
+    print(f"{'scheme':<14}{'mean':>10}{'median':>10}{'max':>10}")
+    for scheme, durations in results.items():
+        print(
+            f"{scheme:<14}"
+            f"{statistics.mean(durations):>10.3f}"
+            f"{statistics.median(durations):>10.3f}"
+            f"{max(durations):>10.3f}"
+        )
+
+    speedup = statistics.mean(results[API_KEY_HASH_BCRYPT]) / statistics.mean(
+        results[API_KEY_HASH_HMAC]
+    )
+    print(f"HMAC is {speedup:,.0f}x faster than bcrypt.")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
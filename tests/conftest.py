@@ -4,6 +4,8 @@ This module provides shared fixtures for testing the Flask application,
 including application instance and test client setup.
 """
 
+import uuid
+
 import pytest
 
 from app import create_app, db
@@ -44,3 +46,45 @@ def client(app_instance):
     app_instance.testing = True
     with app_instance.test_client() as client:
         yield client
+
+
+@pytest.fixture
+def api_user(app_instance):
+    """Create a user with a confirmed email address for API tests.
+
+    Args:
+        app_instance: The Flask application fixture.
+
+    Yields:
+        Users: The user object.
+    """
+    with app_instance.app_context():
+        from app.models import Users
+
+        user = Users(
+            email=f"{uuid.uuid4().hex}@example.com",
+            password=None,
+            tier_id=1,
+            firstName="Test",
+            lastName="User",
+            newsletter=0,
+            member_since=None,
+            last_login=None,
+            email_confirmation_code=None,
+        )
+        user.email_confirmed = 1
+        user.save()
+
+        yield user
+
+        # Release the leases and the ledger of the user before deleting it,
+        # since SQLite reuses the IDs of deleted users
+        from app.models import CreditLeases, CreditLedger
+        from app.utilities.credit_leases import credit_leases
+
+        credit_leases.release_all()
+        CreditLeases.query.filter_by(user_id=user.id).delete()
+        CreditLedger.query.filter_by(user_id=user.id).delete()
+
+        db.session.delete(user)
+        db.session.commit()
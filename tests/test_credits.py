@@ -0,0 +1,253 @@
+"""Tests for the credit balance of user accounts."""
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+from app import db
+
+
+def test_concurrent_deductions_are_not_lost(app_instance, api_user):
+    """Test that concurrent deductions neither get lost nor overdraw the balance"""
+    from app.models import Users
+    from app.utilities.credit_leases import CreditsLeased
+
+    api_user.credits = 20
+    api_user.save()
+    user_id = api_user.id
+    pools = [lease_pool(f"process-{i}", block_size=1) for i in range(2)]
+
+    def deduct(pool):
+        with app_instance.app_context():
+            user = db.session.get(Users, user_id)
+            while True:
+                try:
+                    return pool.consume(user, 1, "web")
+                except CreditsLeased:
+                    # The other process hasn't spent its reservation yet
+                    time.sleep(0.01)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        deducted = list(executor.map(deduct, pools * 15))
+
+    assert deducted.count(True) == 20
+    assert api_user.credit_balance == 0
+
+
+def test_deduction_requires_enough_credits(app_instance, api_user):
+    """Test that a deduction larger than the balance changes nothing"""
+    api_user.credits = 5
+    api_user.save()
+    process = lease_pool("a", 100)
+
+    assert process.consume(api_user, 6, "web") is False
+    assert api_user.credit_balance == 5
+
+    assert process.consume(api_user, 5, "web") is True
+    assert api_user.credit_balance == 0
+
+    process.release_all()
+    assert api_user.add_credits(3) == 3
+    assert api_user.credit_balance == 3
+
+
+def test_ledger_entries_are_written_in_batches(app_instance, api_user):
+    """Test that concurrent credit changes are grouped and none is lost"""
+    from app.models import CreditLedger
+    from app.utilities.credit_ledger import credit_ledger
+
+    api_user.credits = 0
+    api_user.save()
+    user_id = api_user.id
+    entries = credit_ledger.stats()["entries"]
+
+    def record(i):
+        with app_instance.app_context():
+            credit_ledger.record(user_id, 2, "purchase", f"payment-{i}")
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(record, range(200)))
+
+    assert CreditLedger.query.filter_by(user_id=user_id).count() == 200
+    assert credit_ledger.balance(user_id) == 400
+    assert credit_ledger.stats()["entries"] - entries == 200
+
+
+def test_compaction_keeps_the_balance_exact(app_instance, api_user):
+    """Test that compacting the ledger moves the entries into the cached balance"""
+    from app.models import CreditLedger, Users
+    from app.utilities.credit_leases import credit_leases
+    from app.utilities.credit_ledger import CreditLedgerManager
+
+    api_user.credits = 10
+    api_user.save()
+    user_id = api_user.id
+    api_user.add_credits(50, reference="cs_test")
+    assert credit_leases.consume(api_user, 15, "api", "api_key:1")
+
+    compaction = CreditLedgerManager()
+    compaction.compaction_batch_size = 1
+    assert compaction.compact() == 1
+    assert api_user.credit_balance == 45
+
+    assert compaction.compact() == 1
+    assert compaction.compact() == 0
+    db.session.expire_all()
+    assert db.session.get(Users, user_id).credits == 45
+    assert api_user.credit_balance == 45
+
+    # The history of the changes is kept
+    entries = CreditLedger.query.filter_by(user_id=user_id).order_by(CreditLedger.id)
+    assert [(e.amount, e.source, e.reference, e.compacted) for e in entries] == [
+        (50, "purchase", "cs_test", True),
+        (-15, "api", "api_key:1", True),
+    ]
+
+
+def test_get_credit_balance_is_exact(client, api_user):
+    """Test that the balance endpoint counts the spends not compacted yet"""
+    from app.models import APIKeys
+    from app.utilities.credit_leases import credit_leases
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+    api_user.credits = 500
+    api_user.save()
+
+    assert credit_leases.consume(api_user, 7, "api")
+
+    response = client.post("/api/get-credit-balance", headers={"x-api-key": new_key})
+    assert response.status_code == 200
+    assert response.json["balance"] == 493
+
+
+def lease_pool(holder, block_size):
+    """Create a credit lease pool standing for another app process.
+
+    Args:
+        holder: The name of the process.
+        block_size: Credits reserved at a time.
+
+    Returns:
+        CreditLeasePool: The pool.
+    """
+    from app.utilities.credit_leases import CreditLeasePool
+
+    pool = CreditLeasePool()
+    pool.holder = holder
+    pool.block_size = block_size
+    return pool
+
+
+def test_leased_credits_are_spent_exactly_once(app_instance, api_user):
+    """Test that processes spending leased credits concurrently spend each once"""
+    from app.models import CreditLeases, CreditLedger, Users
+    from app.utilities.credit_leases import CreditsLeased
+
+    api_user.credits = 1000
+    api_user.save()
+    user_id = api_user.id
+    pools = [lease_pool(f"process-{i}", block_size=50) for i in range(3)]
+
+    def spend(pool):
+        spent = 0
+        with app_instance.app_context():
+            user = db.session.get(Users, user_id)
+            while True:
+                try:
+                    if not pool.consume(user, 1, "api"):
+                        return spent
+                    spent += 1
+                except CreditsLeased:
+                    # The last credits are leased by the other processes
+                    time.sleep(0.01)
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        spent = sum(executor.map(spend, pools * 4))
+
+    assert spent == 1000
+    assert api_user.credit_balance == 0
+    assert CreditLedger.query.filter_by(user_id=user_id).count() == 1000
+
+    for pool in pools:
+        pool.release_all()
+    assert CreditLeases.query.filter_by(user_id=user_id).count() == 0
+    assert api_user.credit_balance == 0
+
+
+def test_unspent_leased_credits_are_released(app_instance, api_user):
+    """Test that leases hold credits back until they are released"""
+    from datetime import timedelta
+
+    from app.models import CreditLeases
+    from app.utilities.credit_leases import CreditsLeased
+    from app.utilities.helpers import naive_app_now
+
+    api_user.credits = 150
+    api_user.save()
+    process, other_process = lease_pool("a", 100), lease_pool("b", 100)
+
+    # A reservation takes at most half of the credits that are not leased
+    assert process.consume(api_user, 1, "api")
+    assert other_process.consume(api_user, 50, "api")
+    assert {lease.holder: lease.credits for lease in CreditLeases.query} == {
+        "a": 75,
+        "b": 50,
+    }
+
+    # Spent credits leave the balance right away, and the reservations
+    # shrink as the credits that are not leased run low
+    assert other_process.consume(api_user, 1, "api")
+    assert other_process.consume(api_user, 24, "api")
+    assert api_user.credit_balance == 74
+
+    # The remaining credits are all leased by the first process, a spend
+    # beyond the balance fails, but one within it can be retried
+    with pytest.raises(CreditsLeased) as leased:
+        other_process.consume(api_user, 1, "api")
+    assert leased.value.retry_after == other_process.ttl
+    assert other_process.consume(api_user, 75, "api") is False
+
+    # The lease of a process that stopped renewing it is released by another
+    CreditLeases.query.filter_by(holder="a").update(
+        {"expires_at": naive_app_now() - timedelta(seconds=process.ttl + 1)}
+    )
+    db.session.commit()
+    assert other_process.release_abandoned() == 1
+    assert other_process.consume(api_user, 74, "api")
+
+    assert other_process.release_all() == 1
+    assert CreditLeases.query.count() == 0
+    assert api_user.credit_balance == 0
+
+
+def test_leases_leave_the_request_session_alone(app_instance, api_user):
+    """Test that reserving credits doesn't commit the changes of the request"""
+    from app.models import CreditLeases, CreditLedger
+
+    api_user.credits = 100
+    api_user.save()
+    process = lease_pool("a", 30)
+    assert api_user.firstName == "Test"
+
+    api_user.firstName = "Uncommitted"
+    assert process.consume(api_user, 10, "api")
+    db.session.rollback()
+    assert api_user.firstName == "Test"
+
+    # The spends reference the lease by its token, which is never reused
+    def lease_token():
+        return db.session.scalar(
+            db.select(CreditLeases.token).where(CreditLeases.holder == "a")
+        )
+
+    token = lease_token()
+    entry = CreditLedger.query.filter_by(user_id=api_user.id).one()
+    assert entry.lease_token == token
+
+    process.release_all()
+    assert process.consume(api_user, 10, "api")
+    assert lease_token() not in (None, token)
+    assert api_user.credit_balance == 80
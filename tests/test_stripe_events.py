@@ -0,0 +1,231 @@
+"""Tests for the background processing of the Stripe webhook events."""
+
+import hmac
+import json
+import time
+import uuid
+
+import stripe
+
+from app import db
+from app.utilities.helpers import naive_app_now
+
+
+def checkout_event(customer_id, quantity):
+    """Create the payload of a completed credit purchase event.
+
+    Args:
+        customer_id: The Stripe customer ID of the buyer.
+        quantity: The number of credits bought.
+
+    Returns:
+        str: The event in JSON, as Stripe sends it.
+    """
+    return json.dumps(
+        {
+            "id": f"evt_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": "checkout.session.completed",
+            "data": {
+                "object": {
+                    "id": f"cs_{uuid.uuid4().hex}",
+                    "object": "checkout.session",
+                    "customer": customer_id,
+                    "metadata": {"quantity": str(quantity)},
+                }
+            },
+        }
+    )
+
+
+def stripe_signature(app, payload):
+    """Sign a payload like Stripe does with the webhook secret.
+
+    Args:
+        app: The Flask application.
+        payload: The body of the webhook request.
+
+    Returns:
+        str: The Stripe-Signature header value.
+    """
+    timestamp = int(time.time())
+    signature = hmac.new(
+        app.config["STRIPE_WEBHOOK_SECRET"].encode("utf-8"),
+        f"{timestamp}.{payload}".encode("utf-8"),
+        "sha256",
+    ).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def test_stripe_events_are_acknowledged_and_processed_once(
+    app_instance, client, api_user
+):
+    """Test that events are stored, processed in the background, and deduplicated"""
+    from app.models import StripeEvents
+    from app.utilities.stripe_events import process_due_stripe_events
+
+    api_user.credits = 0
+    api_user.stripe_customer_id = f"cus_{uuid.uuid4().hex}"
+    api_user.save()
+    payload = checkout_event(api_user.stripe_customer_id, 50)
+    event_id = json.loads(payload)["id"]
+    headers = {"Stripe-Signature": stripe_signature(app_instance, payload)}
+
+    # Redeliveries are acknowledged without storing the event again
+    for _ in range(3):
+        response = client.post("/app/webhook/stripe", data=payload, headers=headers)
+        assert response.status_code == 200
+    assert StripeEvents.query.filter_by(id=event_id).count() == 1
+    assert api_user.credit_balance == 0
+
+    assert process_due_stripe_events() == 1
+    assert process_due_stripe_events() == 0
+    assert api_user.credit_balance == 50
+
+    stripe_event = db.session.get(StripeEvents, event_id)
+    assert (stripe_event.status, stripe_event.attempts) == ("processed", 1)
+
+    # Events with an invalid signature are not stored
+    response = client.post(
+        "/app/webhook/stripe",
+        data=checkout_event(api_user.stripe_customer_id, 50),
+        headers=headers,
+    )
+    assert response.status_code == 400
+
+
+def test_failed_stripe_events_are_retried(app_instance, api_user):
+    """Test that a failed event is retried later without adding credits twice"""
+    from app.models import StripeEvents
+    from app.utilities.stripe_event_handler import handle_stripe_event
+    from app.utilities.stripe_events import (
+        process_due_stripe_events,
+        store_stripe_event,
+    )
+
+    api_user.credits = 0
+    api_user.save()
+    customer_id = f"cus_{uuid.uuid4().hex}"
+    payload = checkout_event(customer_id, 20)
+    event = stripe.Event.construct_from(json.loads(payload), None)
+    assert store_stripe_event(event, payload) is True
+    assert store_stripe_event(event, payload) is False
+
+    # The customer isn't linked to a user yet
+    assert process_due_stripe_events() == 0
+    stripe_event = db.session.get(StripeEvents, event.id)
+    assert (stripe_event.status, stripe_event.attempts) == ("pending", 1)
+    assert "App user not found" in stripe_event.last_error
+    assert stripe_event.next_attempt_at > naive_app_now()
+
+    api_user.stripe_customer_id = customer_id
+    api_user.save()
+    stripe_event.next_attempt_at = naive_app_now()
+    db.session.commit()
+    assert process_due_stripe_events() == 1
+    assert api_user.credit_balance == 20
+
+    # Handling the purchase again doesn't add its credits twice
+    handle_stripe_event(event)
+    assert api_user.credit_balance == 20
+
+
+def charge_event(customer_id, amount):
+    """Create a succeeded charge event.
+
+    Args:
+        customer_id: The Stripe customer ID of the payer.
+        amount: The amount in cents.
+
+    Returns:
+        stripe.Event: The event.
+    """
+    return stripe.Event.construct_from(
+        {
+            "id": f"evt_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": "charge.succeeded",
+            "data": {
+                "object": {
+                    "id": f"ch_{uuid.uuid4().hex}",
+                    "object": "charge",
+                    "customer": customer_id,
+                    "amount": amount,
+                    "currency": "usd",
+                    "description": f"Purchase of {amount} credits",
+                    "status": "succeeded",
+                    "receipt_url": "https://pay.stripe.com/receipts/test",
+                    "created": int(time.time()),
+                }
+            },
+        },
+        None,
+    )
+
+
+def test_billing_page_renders_charges_from_the_cache(
+    app_instance, client, api_user, monkeypatch
+):
+    """Test that the billing page doesn't wait for the Stripe API"""
+    from app.models import StripeChargeHistories
+    from app.utilities import stripe_charges
+    from app.utilities.stripe_event_handler import handle_stripe_event
+
+    customer_id = f"cus_{uuid.uuid4().hex}"
+    api_user.stripe_customer_id = customer_id
+    api_user.save()
+
+    def unavailable(**kwargs):
+        raise stripe.error.APIConnectionError("Stripe is unavailable")
+
+    monkeypatch.setattr(stripe.Charge, "list", unavailable)
+    refreshes = []
+    monkeypatch.setattr(stripe_charges, "refresh_in_background", refreshes.append)
+
+    handle_stripe_event(charge_event(customer_id, 1500))
+    with client.session_transaction() as session:
+        session["_user_id"] = str(api_user.id)
+        session["_fresh"] = True
+
+    # Without any history, Stripe is asked while the page waits, and
+    # the history is refreshed in the background later if that fails
+    response = client.get("/app/billing")
+    assert response.status_code == 200
+    assert b"Purchase of 1500 credits" in response.data
+    assert refreshes == []
+    assert db.session.get(StripeChargeHistories, customer_id).refreshed_at is None
+
+    assert client.get("/app/billing").status_code == 200
+    assert refreshes == [customer_id]
+
+    # A fresh history isn't refreshed until a checkout makes it stale
+    db.session.merge(
+        StripeChargeHistories(customer_id=customer_id, refreshed_at=naive_app_now())
+    )
+    db.session.commit()
+    assert client.get("/app/billing").status_code == 200
+    assert refreshes == [customer_id]
+
+    stripe_charges.invalidate_charge_history(customer_id)
+    assert client.get("/app/billing").status_code == 200
+    assert refreshes == [customer_id, customer_id]
+
+
+def test_charge_history_is_refreshed_from_stripe(app_instance, api_user, monkeypatch):
+    """Test that a refresh replaces the cached charges with Stripe's"""
+    from app.models import StripeChargeHistories
+    from app.utilities.stripe_charges import charge_history, refresh_charge_history
+
+    customer_id = f"cus_{uuid.uuid4().hex}"
+    charge = charge_event(customer_id, 2000).data.object
+    monkeypatch.setattr(
+        stripe.Charge,
+        "list",
+        lambda **kwargs: stripe.ListObject.construct_from({"data": [charge]}, None),
+    )
+
+    assert [c.id for c in charge_history(customer_id)] == [charge["id"]]
+    assert db.session.get(StripeChargeHistories, customer_id).refreshed_at
+    assert refresh_charge_history(customer_id) == 1
+    assert [c.id for c in charge_history(customer_id)] == [charge["id"]]
+    assert db.session.get(StripeChargeHistories, customer_id).refreshed_at
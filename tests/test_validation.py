@@ -0,0 +1,675 @@
+"""Tests for the distribution of validation requests across workers."""
+
+import time
+
+import pytest
+
+from app.utilities import validation
+from app.utilities.worker_balancer import worker_balancer
+
+
+@pytest.fixture
+def fake_workers(app_instance, monkeypatch):
+    """Replace the worker requests with canned results and latencies.
+
+    Args:
+        app_instance: The Flask application fixture.
+        monkeypatch: The pytest monkeypatch fixture.
+
+    Yields:
+        dict: Maps each worker URL to a (latency_in_seconds, result) tuple.
+    """
+    workers = {}
+
+    def fake_request_validation(email, worker, deadline):
+        latency, result = workers[worker]
+        time.sleep(min(latency, deadline.remaining()))
+        return result if latency <= deadline.remaining() else None
+
+    monkeypatch.setattr(validation, "request_validation", fake_request_validation)
+
+    with app_instance.app_context():
+        worker_balancer.reset()
+        yield workers
+
+
+def set_workers(app_instance, fake_workers, responses):
+    """Configure the workers of the app and their canned responses.
+
+    Args:
+        app_instance: The Flask application fixture.
+        fake_workers: The fake_workers fixture.
+        responses: List of (latency_in_seconds, result) tuples, one per worker.
+    """
+    app_instance.config["MLS_WORKERS"] = []
+    for i, response in enumerate(responses):
+        worker = f"http://worker-{i}"
+        app_instance.config["MLS_WORKERS"].append(worker)
+        fake_workers[worker] = response
+
+
+def test_sequential_returns_best_unknown(app_instance, fake_workers):
+    """Test that an unknown result is returned when no worker is definitive"""
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(
+        app_instance,
+        fake_workers,
+        [(0, {"status": "unknown"}), (0, None)],
+    )
+
+    assert validation.validate_email_with_workers("a@example.com") == {
+        "status": "unknown"
+    }
+
+
+def test_hedged_returns_first_definitive_result(app_instance, fake_workers):
+    """Test that a slow worker is hedged by the next one"""
+    app_instance.config["MLS_HEDGED_VALIDATION"] = True
+    app_instance.config["MLS_HEDGE_DELAY"] = 0.05
+    set_workers(
+        app_instance,
+        fake_workers,
+        [(2, {"status": "invalid"}), (0, {"status": "valid"})],
+    )
+
+    start = time.monotonic()
+    assert validation.validate_email_with_workers("a@example.com") == {
+        "status": "valid"
+    }
+    assert time.monotonic() - start < 1
+
+
+def test_hedged_moves_on_after_unknown(app_instance, fake_workers):
+    """Test that an unknown result triggers the next worker without delay"""
+    app_instance.config["MLS_HEDGED_VALIDATION"] = True
+    app_instance.config["MLS_HEDGE_DELAY"] = 5
+    set_workers(
+        app_instance,
+        fake_workers,
+        [(0, {"status": "unknown"}), (0, None), (0, {"status": "unknown"})],
+    )
+
+    start = time.monotonic()
+    assert validation.validate_email_with_workers("a@example.com") == {
+        "status": "unknown"
+    }
+    assert time.monotonic() - start < 1
+
+    set_workers(app_instance, fake_workers, [(0, None)])
+    with pytest.raises(Exception):
+        validation.validate_email_with_workers("a@example.com")
+
+
+def test_failing_worker_is_ejected(app_instance, fake_workers):
+    """Test that a worker failing repeatedly stops receiving requests"""
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(app_instance, fake_workers, [(0, None)])
+
+    for _ in range(worker_balancer.failure_threshold):
+        with pytest.raises(Exception):
+            validation.validate_email_with_workers("a@example.com")
+
+    workers = worker_balancer.snapshot(app_instance.config["MLS_WORKERS"])
+    assert workers["http://worker-0"]["state"] == "open"
+    # With every circuit open, the worker ejected the longest ago is probed
+    set_workers(
+        app_instance,
+        fake_workers,
+        [(0, None), (0, None), (0, None)],
+    )
+    for worker in app_instance.config["MLS_WORKERS"][1:]:
+        for _ in range(worker_balancer.failure_threshold):
+            validation.balanced_request_validation(
+                "a@example.com", worker, validation.Deadline(1)
+            )
+    assert worker_balancer.ranked(app_instance.config["MLS_WORKERS"]) == [
+        "http://worker-0"
+    ]
+    with pytest.raises(Exception):
+        validation.validate_email_with_workers("a@example.com")
+    assert worker_balancer.ranked(app_instance.config["MLS_WORKERS"]) == [
+        "http://worker-1"
+    ]
+    fake_workers["http://worker-1"] = (0, {"status": "valid"})
+    assert validation.validate_email_with_workers("a@example.com") == {
+        "status": "valid"
+    }
+    workers = worker_balancer.snapshot(app_instance.config["MLS_WORKERS"])
+    assert workers["http://worker-1"]["state"] == "closed"
+
+    # A failing worker is tried after the healthy ones
+    set_workers(app_instance, fake_workers, [(0, None), (0, {"status": "valid"})])
+    worker_balancer.reset()
+    assert validation.validate_email_with_workers("a@example.com") == {
+        "status": "valid"
+    }
+    assert worker_balancer.ranked(app_instance.config["MLS_WORKERS"]) == [
+        "http://worker-1",
+        "http://worker-0",
+    ]
+
+
+@pytest.mark.parametrize("hedged", [False, True])
+def test_deadline_is_shared_by_all_workers(app_instance, fake_workers, hedged):
+    """Test that a validation gives up when its deadline passes"""
+    app_instance.config["MLS_HEDGED_VALIDATION"] = hedged
+    app_instance.config["MLS_HEDGE_DELAY"] = 0.05
+    set_workers(
+        app_instance,
+        fake_workers,
+        [(0.3, {"status": "valid"}), (0.3, {"status": "valid"})],
+    )
+
+    start = time.monotonic()
+    with pytest.raises(validation.ValidationDeadlineExceeded):
+        validation.validate_email_with_workers(
+            "a@example.com", validation.Deadline(0.2)
+        )
+    assert time.monotonic() - start < 0.5
+
+
+def test_deadline_does_not_count_as_worker_failure(
+    app_instance, fake_workers, monkeypatch
+):
+    """Test that requests cut short by the deadline don't eject a worker"""
+    workers = app_instance.config["MLS_WORKERS"] = ["http://worker-0"]
+    set_workers(app_instance, fake_workers, [(0.1, {"status": "valid"})])
+
+    for _ in range(worker_balancer.failure_threshold + 1):
+        assert (
+            validation.balanced_request_validation(
+                "a@example.com", workers[0], validation.Deadline(0.02)
+            )
+            is None
+        )
+
+    stats = worker_balancer.snapshot(workers)["http://worker-0"]
+    assert stats["state"] == "closed"
+    assert stats["failures"] == 0
+    assert stats["in_flight"] == 0
+
+    # Nothing is sent once the deadline passed
+    sent = []
+    monkeypatch.setattr(
+        validation, "request_validation", lambda *args: sent.append(args)
+    )
+    assert (
+        validation.balanced_request_validation(
+            "a@example.com", workers[0], validation.Deadline(0)
+        )
+        is None
+    )
+    assert sent == []
+
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_results_are_cached_by_normalized_email(
+    app_instance, fake_workers, monkeypatch, backend
+):
+    """Test that a repeated validation is answered from the result cache"""
+    from app.utilities.result_cache import result_cache
+
+    calls = []
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    app_instance.config["MLS_RESULT_CACHE_BACKEND"] = backend
+    app_instance.config["MLS_RESULT_CACHE_TTL_BY_STATUS"] = {"valid": 60, "unknown": 0}
+    result_cache.init_app(app_instance)
+    result_cache.clear()
+    set_workers(app_instance, fake_workers, [(0, {"status": "valid"})])
+
+    fake_request_validation = validation.request_validation
+
+    def counting_request_validation(email, worker, deadline):
+        calls.append(email)
+        return fake_request_validation(email, worker, deadline)
+
+    monkeypatch.setattr(validation, "request_validation", counting_request_validation)
+
+    first = validation.validate_email("A@Example.com ")
+    second = validation.validate_email("a@example.com")
+    assert first == {"status": "valid", "cached": False}
+    assert second == {"status": "valid", "cached": True}
+    assert len(calls) == 1
+    assert result_cache.stats()["hits"] == 1
+
+    # Statuses with a zero time to live are not cached
+    fake_workers["http://worker-0"] = (0, {"status": "unknown"})
+    validation.validate_email("b@example.com")
+    assert validation.validate_email("b@example.com")["cached"] is False
+    assert len(calls) == 3
+
+    result_cache.clear()
+
+
+def test_concurrent_validations_are_coalesced(app_instance, fake_workers, monkeypatch):
+    """Test that concurrent callers for one address share a worker request"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(app_instance, fake_workers, [(0.2, {"status": "valid"})])
+
+    fake_request_validation = validation.request_validation
+
+    def counting_request_validation(email, worker, deadline):
+        calls.append(email)
+        return fake_request_validation(email, worker, deadline)
+
+    monkeypatch.setattr(validation, "request_validation", counting_request_validation)
+
+    coalesced = validation.validation_flights.stats()["coalesced"]
+    emails = ["a@example.com", "A@example.com", "a@example.com ", "a@example.com"]
+    with ThreadPoolExecutor(max_workers=len(emails)) as executor:
+        results = list(
+            executor.map(
+                lambda email: validation.run_in_app_context(
+                    app_instance, validation.validate_email, email, None, False
+                ),
+                emails,
+            )
+        )
+
+    assert len(calls) == 1
+    assert results == [{"status": "valid", "cached": False}] * len(emails)
+    assert validation.validation_flights.stats()["coalesced"] == coalesced + 3
+
+    # Each caller gets its own copy
+    results[0]["status"] = "changed"
+    assert results[1]["status"] == "valid"
+
+    # A caller in another admission lane doesn't wait on the shared request
+    from app.utilities.admission import FREE_LANE, PAID_LANE
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(
+            executor.map(
+                lambda lane: validation.run_in_app_context(
+                    app_instance,
+                    validation.validate_email,
+                    "a@example.com",
+                    None,
+                    False,
+                    lane,
+                ),
+                [FREE_LANE, PAID_LANE],
+            )
+        )
+    assert len(calls) == 3
+
+
+def test_coalesced_callers_get_their_own_error():
+    """Test that each caller waiting on a failed call raises its own exception"""
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Event
+
+    from app.utilities.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    started = Event()
+    error = ValueError("The workers failed.")
+
+    def failing_call():
+        started.set()
+        time.sleep(0.1)
+        raise error
+
+    def call(_):
+        try:
+            flights.do("key", failing_call, timeout=1)
+        except ValueError as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        leader = executor.submit(call, None)
+        started.wait()
+        followers = list(executor.map(call, range(2)))
+
+    assert leader.result() is error
+    assert followers[0] is not followers[1]
+    for e in followers:
+        assert isinstance(e, ValueError) and str(e) == "The workers failed."
+        assert e.__cause__ is error
+
+
+def test_prescreen_rejects_before_the_workers(app_instance, fake_workers, monkeypatch):
+    """Test that bad syntax and domains without MX records skip the workers"""
+    from app.utilities.domain_cache import domain_cache
+    from app.utilities.prescreen import prescreen
+
+    lookups = []
+
+    def fake_lookup_mx(domain):
+        lookups.append(domain)
+        return domain != "nomx.org"
+
+    monkeypatch.setattr(prescreen, "lookup_mx", fake_lookup_mx)
+    monkeypatch.setattr(prescreen, "enabled", True)
+    prescreen.reset()
+    domain_cache.clear()
+
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(app_instance, fake_workers, [(0, {"status": "valid"})])
+
+    result = validation.validate_email("not an address")
+    assert result["status"] == "invalid"
+    assert result["is_valid_syntax"] is False
+
+    for _ in range(2):
+        result = validation.validate_email("someone@nomx.org")
+        assert result["status"] == "invalid"
+        assert result["has_mx_records"] is False
+        assert (result["domain"], result["tld"]) == ("nomx", "org")
+    assert lookups == ["nomx.org"]
+
+    assert validation.validate_email("someone@mx.org")["status"] == "valid"
+
+    stats = prescreen.stats()
+    assert stats["checks"] == 4
+    assert (stats["rejected_syntax"], stats["rejected_mx"]) == (1, 2)
+
+
+def test_domain_cache_learns_from_worker_results(
+    app_instance, fake_workers, monkeypatch
+):
+    """Test that domain fields from workers skip DNS and become worker hints"""
+    from app.utilities.domain_cache import domain_cache
+    from app.utilities.prescreen import prescreen
+
+    def failing_lookup_mx(domain):
+        raise AssertionError("The MX records are known from the worker")
+
+    monkeypatch.setattr(prescreen, "lookup_mx", failing_lookup_mx)
+    monkeypatch.setattr(prescreen, "enabled", True)
+    domain_cache.clear()
+
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(
+        app_instance,
+        fake_workers,
+        [
+            (
+                0,
+                {
+                    "status": "valid",
+                    "fqdn": "catchall.org",
+                    "has_mx_records": True,
+                    "has_catch_all": True,
+                    "is_disposable": False,
+                    "is_role": False,
+                },
+            )
+        ],
+    )
+
+    # The first address has no DNS answer yet, let it through to the worker
+    monkeypatch.setattr(prescreen, "lookup_mx", lambda domain: None)
+    validation.validate_email("a@catchall.org")
+    monkeypatch.setattr(prescreen, "lookup_mx", failing_lookup_mx)
+
+    assert domain_cache.hints("catchall.org") == {
+        "has_mx_records": True,
+        "has_catch_all": True,
+        "is_disposable": False,
+    }
+    assert "is_role" not in domain_cache.peek("catchall.org")
+
+    hits = domain_cache.stats()["hits"]
+    assert validation.validate_email("b@catchall.org")["status"] == "valid"
+    assert domain_cache.stats()["hits"] == hits + 1
+
+
+def test_domain_cache_distrusts_missing_mx_records(app_instance):
+    """Test that no MX records is only learned from DNS, and not for long"""
+    from app.utilities.domain_cache import domain_cache
+
+    domain_cache.clear()
+    domain_cache.learn_from_result(
+        "a@flaky.org",
+        {"status": "unknown", "has_mx_records": False, "has_catch_all": False},
+    )
+    assert domain_cache.peek("flaky.org") == {"has_catch_all": False}
+
+    domain_cache.learn("flaky.org", {"has_mx_records": False})
+    expires, entry = domain_cache.cache._entries["flaky.org"]
+    assert entry["has_mx_records"] is False
+    assert expires - time.monotonic() <= domain_cache.negative_ttl
+
+    domain_cache.learn("flaky.org", {"has_mx_records": True})
+    expires, _ = domain_cache.cache._entries["flaky.org"]
+    assert expires - time.monotonic() > domain_cache.negative_ttl
+
+
+def test_worker_state_is_shared_between_processes(tmp_path):
+    """Test that a worker ejected by one process is avoided by the others"""
+    from app.utilities.worker_balancer import SQLiteWorkerStore, WorkerBalancer
+
+    path = str(tmp_path / "worker-state.sqlite3")
+    workers = ["http://worker-0", "http://worker-1"]
+
+    # Two balancers with their own connections stand for two processes
+    first, second = WorkerBalancer(), WorkerBalancer()
+    first.store, second.store = SQLiteWorkerStore(path), SQLiteWorkerStore(path)
+
+    for _ in range(first.failure_threshold):
+        first.finish(workers[0], first.start(workers[0]), ok=False)
+
+    assert second.ranked(workers) == ["http://worker-1"]
+    assert second.snapshot(workers)["http://worker-0"]["state"] == "open"
+
+    # In-flight requests are counted by each process, and not stored
+    started = second.start(workers[1])
+    assert second.snapshot(workers)["http://worker-1"]["in_flight"] == 1
+    assert first.snapshot(workers)["http://worker-1"]["in_flight"] == 0
+    restarted = WorkerBalancer()
+    restarted.store = SQLiteWorkerStore(path)
+    assert restarted.snapshot(workers)["http://worker-1"]["in_flight"] == 0
+
+    second.finish(workers[1], started, ok=True)
+    assert second.snapshot(workers)["http://worker-1"]["in_flight"] == 0
+    assert first.snapshot(workers)["http://worker-1"]["requests"] == 1
+
+
+def test_locked_worker_state_falls_back_to_local(tmp_path, monkeypatch):
+    """Test that a locked state file doesn't fail the requests"""
+    import sqlite3
+
+    from app.utilities.worker_balancer import SQLiteWorkerStore, WorkerBalancer
+
+    path = str(tmp_path / "worker-state.sqlite3")
+    workers = ["http://worker-0"]
+    balancer = WorkerBalancer()
+    balancer.store = SQLiteWorkerStore(path)
+    assert balancer.ranked(workers) == workers
+
+    # Another process holds the write lock for longer than the busy timeout
+    other_process = sqlite3.connect(path, isolation_level=None)
+    other_process.execute("BEGIN IMMEDIATE")
+    balancer.finish(workers[0], balancer.start(workers[0]), ok=True)
+    other_process.execute("ROLLBACK")
+
+    def locked(workers):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(balancer.store, "read", locked)
+    assert balancer.ranked(workers) == workers
+    assert balancer.snapshot(workers)["http://worker-0"]["requests"] == 1
+
+
+def admission_controller(capacity, paid_reserved=0, queue_size=1):
+    """Create an admission controller with small lanes.
+
+    Args:
+        capacity: Maximum number of admitted requests of all lanes.
+        paid_reserved: Slots only the paid lane may use.
+        queue_size: Queue size of every lane.
+
+    Returns:
+        AdmissionController: The controller.
+    """
+    from app.utilities.admission import AdmissionController
+
+    controller = AdmissionController()
+    controller.configure(
+        capacity=capacity,
+        paid_reserved=paid_reserved,
+        weights={"paid": 3, "free": 1, "demo": 1},
+        demo_concurrency=capacity,
+        api_queue_size=queue_size,
+        demo_queue_size=queue_size,
+        queue_timeout=5.0,
+        retry_after=5,
+    )
+    return controller
+
+
+def wait_until_queued(controller, lane, count):
+    """Wait until a number of requests are queued in a lane.
+
+    Args:
+        controller: The AdmissionController.
+        lane: The name of the lane.
+        count: The number of queued requests to wait for.
+    """
+    while controller.stats()["lanes"][lane]["queued"] < count:
+        time.sleep(0.01)
+
+
+def test_admission_lane_queue_is_bounded():
+    """Test that a full lane queues a bounded number of requests and sheds the rest"""
+    from threading import Thread
+
+    controller = admission_controller(capacity=1)
+    assert controller.acquire("free", timeout=0)
+
+    # The second request waits in the queue until the first is done
+    admitted = []
+    waiter = Thread(target=lambda: admitted.append(controller.acquire("free", 5)))
+    waiter.start()
+    wait_until_queued(controller, "free", 1)
+
+    # The queue is full, so the third request is turned away right away
+    assert controller.acquire("free", timeout=5) is False
+
+    controller.release("free")
+    waiter.join()
+    assert admitted == [True]
+    controller.release("free")
+
+    # A queued request gives up after its timeout
+    assert controller.acquire("free", timeout=0)
+    assert controller.acquire("free", timeout=0.05) is False
+    controller.release("free")
+
+    assert controller.stats()["lanes"]["free"] == {
+        "weight": 1,
+        "concurrency": 1,
+        "queue_size": 1,
+        "in_flight": 0,
+        "queued": 0,
+        "max_queued": 1,
+        "admitted": 3,
+        "rejected": 2,
+    }
+
+
+def test_admission_reserves_capacity_for_paid_lane():
+    """Test that only paid callers can use the reserved slots"""
+    controller = admission_controller(capacity=2, paid_reserved=1)
+
+    assert controller.acquire("demo", timeout=0)
+    assert controller.acquire("free", timeout=0) is False
+    assert controller.acquire("paid", timeout=0)
+    assert controller.acquire("paid", timeout=0) is False
+    assert controller.stats()["in_flight"] == 2
+
+
+def test_admission_hands_freed_slots_out_by_weight():
+    """Test that freed slots go to the waiting lanes by weight, paid 3 to demo 1"""
+    from threading import Thread
+
+    controller = admission_controller(capacity=1, queue_size=10)
+    assert controller.acquire("free", timeout=0)
+
+    order = []
+    waiters = [
+        Thread(
+            target=lambda lane=lane: controller.acquire(lane, 5) and order.append(lane)
+        )
+        for lane in ["demo"] * 4 + ["paid"] * 4
+    ]
+    for waiter in waiters:
+        waiter.start()
+    wait_until_queued(controller, "demo", 4)
+    wait_until_queued(controller, "paid", 4)
+
+    # Pass the only slot on, one request at a time
+    controller.release("free")
+    for count in range(1, len(waiters) + 1):
+        while len(order) < count:
+            time.sleep(0.01)
+        controller.release(order[-1])
+    for waiter in waiters:
+        waiter.join()
+
+    assert order[:4] == ["paid", "paid", "demo", "paid"]
+    assert sorted(order) == ["demo"] * 4 + ["paid"] * 4
+
+
+def test_overloaded_lane_only_sheds_worker_requests(app_instance, fake_workers):
+    """Test that a full lane turns away worker requests but not cached results"""
+    from app.utilities.admission import ValidationOverloaded, admission
+    from app.utilities.result_cache import result_cache
+
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(app_instance, fake_workers, [(0, {"status": "valid"})])
+
+    assert validation.validate_email("a@example.com", lane="demo")["cached"] is False
+
+    demo_lane = admission.lanes["demo"]
+    demo_lane.concurrency = demo_lane.queue_size = 0
+
+    with pytest.raises(ValidationOverloaded) as overloaded:
+        validation.validate_email("b@example.com", lane="demo")
+    assert overloaded.value.retry_after == admission.retry_after
+
+    # The other lanes are separate, and cached results need no worker
+    assert validation.validate_email("b@example.com", lane="paid")["cached"] is False
+    assert validation.validate_email("a@example.com", lane="demo")["cached"] is True
+
+    assert admission.stats()["lanes"]["demo"]["rejected"] == 1
+    result_cache.clear()
+
+
+def test_coalesced_callers_are_all_shed(app_instance, fake_workers, monkeypatch):
+    """Test that callers sharing a shed validation all get a Retry-After"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from app.utilities.admission import ValidationOverloaded, admission
+
+    app_instance.config["MLS_HEDGED_VALIDATION"] = False
+    set_workers(app_instance, fake_workers, [(0, {"status": "valid"})])
+
+    def slowly_full(lane, timeout):
+        time.sleep(0.2)
+        return False
+
+    monkeypatch.setattr(admission, "acquire", slowly_full)
+
+    def validate(_):
+        try:
+            validation.run_in_app_context(
+                app_instance, validation.validate_email, "shed@example.com", None, False
+            )
+        except Exception as e:
+            return e
+
+    coalesced = validation.validation_flights.stats()["coalesced"]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        errors = list(executor.map(validate, range(3)))
+
+    assert validation.validation_flights.stats()["coalesced"] == coalesced + 2
+    assert len({id(e) for e in errors}) == 3
+    for e in errors:
+        assert isinstance(e, ValidationOverloaded)
+        assert e.retry_after == admission.retry_after
+        assert str(e) == "The free validation lane is full."
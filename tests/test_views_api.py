@@ -0,0 +1,381 @@
+"""Tests for API views including API key authentication."""
+
+import uuid
+
+from app import db, bc
+
+
+def test_api_key_prefixed_lookup(client, api_user):
+    """Test that keys in the prefixed format authenticate"""
+    from app.models import APIKeys
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+
+    assert new_key.startswith(f"mls_{key_prefix}_")
+
+    response = client.post("/api/test", headers={"x-api-key": new_key})
+    assert response.status_code == 200
+
+    response = client.post("/api/test", headers={"x-api-key": new_key[:-1] + "x"})
+    assert response.status_code == 403
+
+
+def test_api_key_legacy_lookup(client, api_user):
+    """Test that keys issued before prefixes existed keep working"""
+    from app.models import APIKeys
+
+    legacy_key = uuid.uuid4().hex + uuid.uuid4().hex
+    key_hash = bc.generate_password_hash(legacy_key).decode("utf8")
+    api_key = APIKeys(user=api_user, key_hash=key_hash, hash_scheme="bcrypt").save()
+
+    response = client.post("/api/test", headers={"x-api-key": legacy_key})
+    assert response.status_code == 200
+
+    # The prefix is recorded on first use, so the next lookup is indexed
+    # and the key is rehashed with the fast scheme
+    migrated_key = db.session.get(APIKeys, api_key.id)
+    assert migrated_key.key_prefix == legacy_key[:12]
+    assert migrated_key.hash_scheme == "hmac-sha256"
+
+    response = client.post("/api/test", headers={"x-api-key": legacy_key})
+    assert response.status_code == 200
+
+
+def test_api_key_verified_cache(client, api_user):
+    """Test that verified keys are cached until they are revoked"""
+    from app.models import APIKeys
+    from app.utilities.api_keys import verified_api_keys
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    api_key = APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+
+    response = client.post("/api/test", headers={"x-api-key": new_key})
+    assert response.status_code == 200
+
+    hits = verified_api_keys.stats()["hits"]
+    response = client.post("/api/test", headers={"x-api-key": new_key})
+    assert response.status_code == 200
+    assert verified_api_keys.stats()["hits"] == hits + 1
+
+    # A key revoked by another process is rejected despite the cache
+    client.application.config["WTF_CSRF_ENABLED"] = False
+    with client.session_transaction() as session:
+        session["_user_id"] = str(api_user.id)
+        session["_fresh"] = True
+    # The revoke is handled as by another process, whose cache is separate
+    forget = verified_api_keys.forget
+    verified_api_keys.forget = lambda key_id: None
+    try:
+        response = client.post("/app/api-keys/revoke", json={"key_id": api_key.id})
+    finally:
+        verified_api_keys.forget = forget
+    assert response.status_code == 200
+
+    response = client.post("/api/test", headers={"x-api-key": new_key})
+    assert response.status_code == 403
+
+
+def test_api_key_last_used_is_written_in_batches(client, api_user):
+    """Test that authentication buffers the last used timestamp"""
+    from app.models import APIKeys
+    from app.utilities.api_keys import last_used_buffer
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    api_key = APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+
+    response = client.post("/api/test", headers={"x-api-key": new_key})
+    assert response.status_code == 200
+    db.session.expire_all()
+    assert db.session.get(APIKeys, api_key.id).last_used is None
+
+    assert last_used_buffer.flush() >= 1
+    db.session.expire_all()
+    assert db.session.get(APIKeys, api_key.id).last_used is not None
+
+
+def test_api_key_expired(client, api_user):
+    """Test that expired keys are rejected and then deactivated"""
+    from datetime import timedelta
+
+    from app.models import APIKeys
+    from app.utilities.api_keys import deactivate_expired_keys
+    from app.utilities.helpers import generate_api_key_and_hash, naive_app_now
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    api_key = APIKeys(
+        user=api_user,
+        key_hash=key_hash,
+        key_prefix=key_prefix,
+        expires_at=naive_app_now() - timedelta(days=1),
+    ).save()
+
+    response = client.post("/api/test", headers={"x-api-key": new_key})
+    assert response.status_code == 403
+
+    assert deactivate_expired_keys() >= 1
+    db.session.expire_all()
+    assert db.session.get(APIKeys, api_key.id).is_active is False
+
+
+def test_validate_emails_bulk(client, api_user, monkeypatch):
+    """Test that bulk validation dedupes addresses and charges delivered results"""
+    from app.models import APIKeys, Users
+    from app.utilities import validation
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    def fake_request_validation(email, worker, deadline):
+        if email.startswith("fail"):
+            return None
+        return {"email": email, "status": "valid"}
+
+    monkeypatch.setattr(validation, "request_validation", fake_request_validation)
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+    api_user.credits = 10
+    api_user.save()
+
+    response = client.post(
+        "/api/validate-emails",
+        headers={"x-api-key": new_key},
+        json={
+            "emails": ["A@example.com", "a@example.com ", "b@example.com", "fail@x.com"]
+        },
+    )
+    assert response.status_code == 200
+
+    results = response.json["results"]
+    assert [r["email"] for r in results] == [
+        "a@example.com",
+        "b@example.com",
+        "fail@x.com",
+    ]
+    assert [r["status"] for r in results] == ["success", "success", "error"]
+    db.session.expire_all()
+    assert db.session.get(Users, api_user.id).credit_balance == 8
+
+    # Not enough credits for every address
+    response = client.post(
+        "/api/validate-emails",
+        headers={"x-api-key": new_key},
+        json={"emails": [f"{i}@example.com" for i in range(9)]},
+    )
+    assert response.status_code == 402
+
+    response = client.post(
+        "/api/validate-emails",
+        headers={"x-api-key": new_key},
+        json={"emails": "a@example.com"},
+    )
+    assert response.status_code == 400
+
+
+def test_validate_emails_stream(client, api_user, monkeypatch):
+    """Test that streamed bulk validation writes one line per address"""
+    import json
+
+    from app.models import APIKeys, Users
+    from app.utilities import validation
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    def fake_request_validation(email, worker, deadline):
+        if email.startswith("fail"):
+            return None
+        return {"email": email, "status": "valid"}
+
+    monkeypatch.setattr(validation, "request_validation", fake_request_validation)
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+    api_user.credits = 10
+    api_user.save()
+
+    response = client.post(
+        "/api/validate-emails",
+        headers={"x-api-key": new_key},
+        json={
+            "emails": ["a@example.com", "b@example.com", "fail@x.com"],
+            "stream": True,
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 4
+    assert {line["email"]: line["status"] for line in lines[:3]} == {
+        "a@example.com": "success",
+        "b@example.com": "success",
+        "fail@x.com": "error",
+    }
+    assert lines[-1]["status"] == "success"
+    db.session.expire_all()
+    assert db.session.get(Users, api_user.id).credit_balance == 8
+
+
+def test_submit_job_and_get_its_progress(client, api_user, monkeypatch):
+    """Test that API jobs are queued as batch jobs and report their progress"""
+    from app import views_api
+    from app.models import APIKeys, BatchJobs
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    uploads = {}
+
+    def fake_upload_api_validation_list(user, emails):
+        key = f"validation/uploaded/api-user-{user.id}/list.csv"
+        uploads[key] = emails
+        return key
+
+    monkeypatch.setattr(
+        views_api, "upload_api_validation_list", fake_upload_api_validation_list
+    )
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+    api_user.credits = 10
+    api_user.save()
+    headers = {"x-api-key": new_key}
+
+    response = client.post(
+        "/api/jobs",
+        headers=headers,
+        json={"emails": ["a@example.com", "A@example.com", "b@example.com"]},
+    )
+    assert response.status_code == 202
+    uid = response.json["job"]["uid"]
+    assert list(uploads.values()) == [["a@example.com", "b@example.com"]]
+
+    job = BatchJobs.query.filter_by(uid=uid).first()
+    assert (job.source, job.row_count, job.email_column) == ("api", 2, "email")
+
+    job.last_pick_row = 1
+    db.session.commit()
+    response = client.get(f"/api/jobs/{uid}", headers=headers)
+    assert response.status_code == 200
+    assert response.json["job"]["last_pick_row"] == 1
+    assert response.json["job"]["progress"] == 50.0
+
+    # Files must come from this user's upload links
+    response = client.post(
+        "/api/jobs",
+        headers=headers,
+        json={"file": "validation/uploaded/api-user-0/other.csv"},
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        "/api/jobs/upload-link", headers=headers, json={"file_name": "my list.csv"}
+    )
+    assert response.status_code == 200
+    uploaded_file = response.json["file"]
+    assert uploaded_file.endswith("-my_list.csv")
+
+    # The column of the addresses in a file is required
+    for email_column in [None, "", 3]:
+        response = client.post(
+            "/api/jobs",
+            headers=headers,
+            json={"file": uploaded_file, "email_column": email_column},
+        )
+        assert response.status_code == 400
+        assert "email_column" in response.json["message"]
+
+    response = client.post(
+        "/api/jobs",
+        headers=headers,
+        json={"file": uploaded_file, "email_column": "Email"},
+    )
+    assert response.status_code == 202
+    assert response.json["job"]["row_count"] is None
+
+    db.session.delete(job)
+    BatchJobs.query.filter_by(uploaded_file=uploaded_file).delete()
+    db.session.commit()
+
+    response = client.get(f"/api/jobs/{uid}", headers=headers)
+    assert response.status_code == 404
+
+
+def test_validate_email_is_shed_when_overloaded(client, api_user, monkeypatch):
+    """Test that an overloaded lane answers 503 with a Retry-After header"""
+    from app.models import APIKeys, Users
+    from app.utilities import validation
+    from app.utilities.admission import admission
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    monkeypatch.setattr(
+        validation,
+        "request_validation",
+        lambda email, worker, deadline: {"email": email, "status": "valid"},
+    )
+    # The user is on the free tier
+    monkeypatch.setattr(admission.lanes["free"], "concurrency", 0)
+    monkeypatch.setattr(admission.lanes["free"], "queue_size", 0)
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+    api_user.credits = 10
+    api_user.save()
+
+    response = client.post(
+        "/api/validate-email",
+        headers={"x-api-key": new_key},
+        json={"email": "overloaded@example.com"},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(admission.retry_after)
+
+    db.session.expire_all()
+    assert db.session.get(Users, api_user.id).credit_balance == 10
+
+
+def test_only_legacy_keys_scan_unprefixed_keys(client, api_user, monkeypatch):
+    """Test that keys in neither format are rejected without checking hashes"""
+    from app.models import APIKeys
+
+    legacy_key = uuid.uuid4().hex + uuid.uuid4().hex
+    key_hash = bc.generate_password_hash(legacy_key).decode("utf8")
+    APIKeys(user=api_user, key_hash=key_hash, hash_scheme="bcrypt").save()
+
+    def failing_check_key(self, key_plain):
+        raise AssertionError("No hash should be checked")
+
+    monkeypatch.setattr(APIKeys, "check_key", failing_check_key)
+    for key in ["not-a-key", legacy_key.upper(), legacy_key[:-1]]:
+        response = client.post("/api/test", headers={"x-api-key": key})
+        assert response.status_code == 403
+
+
+def test_schema_upgrade_adds_the_api_key_columns(app_instance, tmp_path):
+    """Test that a database from before the key prefixes gets the new columns"""
+    from sqlalchemy import create_engine, inspect, text
+
+    from app.utilities.schema import upgrade_schema
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                'CREATE TABLE "APIKeys" (id INTEGER PRIMARY KEY, user_id INTEGER '
+                "NOT NULL, key_hash VARCHAR(64) NOT NULL, label VARCHAR, created_at "
+                "DATETIME, expires_at DATETIME, last_used DATETIME, is_active BOOLEAN)"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO \"APIKeys\" (user_id, key_hash) VALUES (1, 'hash')")
+        )
+
+    added = upgrade_schema(engine, db.metadata)
+    assert {"APIKeys.key_prefix", "APIKeys.hash_scheme"} <= set(added)
+    assert upgrade_schema(engine, db.metadata) == []
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("APIKeys")}
+    assert "ix_APIKeys_key_prefix" in indexes
+    with engine.connect() as connection:
+        assert connection.execute(
+            text('SELECT key_prefix, hash_scheme FROM "APIKeys"')
+        ).one() == (None, "bcrypt")
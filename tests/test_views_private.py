@@ -15,3 +15,27 @@ def test_dashboard_unauthenticated(client):
 
     # Should have Login in the title
     assert re.search(rb"<title>.*Login.*</title>", response.data)
+
+
+def test_admin_metrics_report_the_api_key_cache(client, api_user):
+    """Test that the metrics of the admin count the lookups of API keys"""
+    from app.models import APIKeys
+    from app.utilities.api_keys import verified_api_keys
+    from app.utilities.helpers import generate_api_key_and_hash
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=api_user, key_hash=key_hash, key_prefix=key_prefix).save()
+    api_user.role = "admin"
+    api_user.save()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(api_user.id)
+        session["_fresh"] = True
+
+    before = client.get("/app/admin/metrics").json["api_keys"]
+    for _ in range(2):
+        client.post("/api/get-credit-balance", headers={"x-api-key": new_key})
+
+    after = client.get("/app/admin/metrics").json["api_keys"]
+    assert after["hits"] + after["misses"] == before["hits"] + before["misses"] + 2
+    assert after["hits"] > before["hits"]
+    assert after == verified_api_keys.stats()
@@ -0,0 +1,318 @@
+"""Tests for the completion webhooks of batch validation jobs."""
+
+import hmac
+import json
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+from app import db
+from app.utilities import webhooks
+from app.utilities.helpers import generate_api_key_and_hash
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    """Replace the webhook requests with a receiver answering canned statuses.
+
+    Args:
+        monkeypatch: The pytest monkeypatch fixture.
+
+    Yields:
+        SimpleNamespace: The received requests and the statuses to answer with.
+    """
+    received = SimpleNamespace(requests=[], statuses=[], addresses=["93.184.215.14"])
+
+    def fake_getaddrinfo(host, port, **kwargs):
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))
+            for address in received.addresses
+        ]
+
+    def fake_post(url, address, body, headers, timeout):
+        received.requests.append((url, body, headers))
+        status = received.statuses.pop(0) if received.statuses else 204
+        return SimpleNamespace(status_code=status)
+
+    monkeypatch.setattr(webhooks.socket, "getaddrinfo", fake_getaddrinfo)
+    monkeypatch.setattr(webhooks, "post_to_address", fake_post)
+    yield received
+
+
+def api_key_headers(user):
+    """Create an API key for a user.
+
+    Args:
+        user: The Users object.
+
+    Returns:
+        dict: The headers authenticating with the new key.
+    """
+    from app.models import APIKeys
+
+    new_key, key_prefix, key_hash = generate_api_key_and_hash()
+    APIKeys(user=user, key_hash=key_hash, key_prefix=key_prefix).save()
+    return {"x-api-key": new_key}
+
+
+def complete_job(job):
+    """Mark a job as completed like the batch validation backend does.
+
+    Args:
+        job: The BatchJobs object.
+    """
+    job.status = "file_completed"
+    job.results_file = f"validation/results/{job.uid}.csv"
+    db.session.commit()
+
+
+def test_job_callback_is_retried_until_delivered(
+    client, api_user, receiver, monkeypatch
+):
+    """Test that a job's callback is signed, retried, and logged"""
+    from app import views_api
+    from app.models import BatchJobs, WebhookDeliveries
+    from app.utilities.helpers import naive_app_now
+
+    monkeypatch.setattr(
+        views_api, "upload_api_validation_list", lambda user, emails: "list.csv"
+    )
+    headers = api_key_headers(api_user)
+
+    response = client.post(
+        "/api/jobs",
+        headers=headers,
+        json={"emails": ["a@example.com"], "callback_url": "https://example.com/h"},
+    )
+    assert response.status_code == 202
+    secret = response.json["webhook_secret"]
+    uid = response.json["job"]["uid"]
+    assert response.json["job"]["webhook"]["status"] == "scheduled"
+
+    # Nothing is sent before the job completes
+    assert webhooks.dispatch_job_webhooks() == 0
+    assert receiver.requests == []
+
+    job = BatchJobs.query.filter_by(uid=uid).first()
+    complete_job(job)
+
+    # The first attempt fails and is retried later
+    receiver.statuses = [500]
+    assert webhooks.dispatch_job_webhooks() == 0
+    delivery = WebhookDeliveries.query.filter_by(job_id=job.id).first()
+    assert (delivery.status, delivery.attempts) == ("pending", 1)
+    assert delivery.last_status_code == 500
+    assert delivery.next_attempt_at > naive_app_now()
+    assert webhooks.dispatch_job_webhooks() == 0
+    assert len(receiver.requests) == 1
+
+    delivery.next_attempt_at = naive_app_now()
+    db.session.commit()
+    assert webhooks.dispatch_job_webhooks() == 1
+    assert delivery.status == "delivered"
+
+    url, body, sent_headers = receiver.requests[-1]
+    assert url == "https://example.com/h"
+    assert json.loads(body)["job"]["uid"] == uid
+    assert "results_download_link" in json.loads(body)["job"]
+    timestamp, signature = [
+        part.split("=", 1)[1]
+        for part in sent_headers[webhooks.SIGNATURE_HEADER].split(",")
+    ]
+    expected = hmac.new(
+        secret.encode(), f"{timestamp}.{body}".encode(), "sha256"
+    ).hexdigest()
+    assert hmac.compare_digest(signature, expected)
+
+    response = client.get(f"/api/jobs/{uid}", headers=headers)
+    assert response.json["job"]["webhook"]["status"] == "delivered"
+
+    # Every attempt is logged
+    assert [
+        (attempt.status_code, attempt.error) for attempt in delivery.attempt_log
+    ] == [(500, "Unexpected status code 500"), (204, None)]
+
+    db.session.delete(delivery)
+    db.session.delete(job)
+    db.session.commit()
+
+
+def test_account_webhook_notifies_jobs_completed_after_it(client, api_user, receiver):
+    """Test that an account URL is notified of the jobs completed afterwards"""
+    from app.models import BatchJobs, WebhookDeliveries, WebhookEndpoints
+
+    headers = api_key_headers(api_user)
+
+    def new_job():
+        job = BatchJobs(
+            user=api_user,
+            uploaded_file="list.csv",
+            original_file_name="list.csv",
+            header_row=1,
+        )
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    old_job = new_job()
+
+    response = client.post(
+        "/api/webhook", headers=headers, json={"url": "http://127.0.0.1/hook"}
+    )
+    assert response.status_code == 200
+    assert response.json["secret"].startswith("whsec_")
+
+    response = client.post("/api/webhook", headers=headers, json={"url": "ftp://x"})
+    assert response.status_code == 400
+
+    job = new_job()
+    complete_job(old_job)
+    complete_job(job)
+
+    assert webhooks.dispatch_job_webhooks() == 1
+    assert [json.loads(body)["job"]["uid"] for _, body, _ in receiver.requests] == [
+        job.uid
+    ]
+
+    # Delivered notifications are not sent again
+    assert webhooks.dispatch_job_webhooks() == 0
+
+    WebhookDeliveries.query.filter_by(user_id=api_user.id).delete()
+    WebhookEndpoints.query.filter_by(user_id=api_user.id).delete()
+    BatchJobs.query.filter_by(user_id=api_user.id).delete()
+    db.session.commit()
+
+
+def test_failed_jobs_are_notified(client, api_user, receiver, monkeypatch):
+    """Test that jobs ending in an error notify both kinds of webhook URLs"""
+    from app import views_api
+    from app.models import BatchJobs, WebhookDeliveries, WebhookEndpoints
+
+    monkeypatch.setattr(
+        views_api, "upload_api_validation_list", lambda user, emails: "list.csv"
+    )
+    headers = api_key_headers(api_user)
+
+    response = client.post(
+        "/api/jobs",
+        headers=headers,
+        json={"emails": ["a@example.com"], "callback_url": "https://example.com/h"},
+    )
+    assert response.status_code == 202
+    job = BatchJobs.query.filter_by(uid=response.json["job"]["uid"]).first()
+
+    response = client.post(
+        "/api/webhook", headers=headers, json={"url": "https://example.com/account"}
+    )
+    assert response.status_code == 200
+    account_job = BatchJobs(
+        user=api_user,
+        uploaded_file="list.csv",
+        original_file_name="list.csv",
+        header_row=1,
+    )
+    db.session.add(account_job)
+
+    job.status = "error_invalid_file"
+    account_job.status = "error_processing"
+    db.session.commit()
+
+    assert webhooks.dispatch_job_webhooks() == 2
+    notified = {url: json.loads(body)["job"] for url, body, _ in receiver.requests}
+    assert notified["https://example.com/h"]["status"] == "error_invalid_file"
+    assert notified["https://example.com/account"]["status"] == "error_processing"
+    assert "results_download_link" not in notified["https://example.com/h"]
+
+    for delivery in WebhookDeliveries.query.filter_by(user_id=api_user.id):
+        db.session.delete(delivery)
+    WebhookEndpoints.query.filter_by(user_id=api_user.id).delete()
+    BatchJobs.query.filter_by(user_id=api_user.id).delete()
+    db.session.commit()
+
+
+def test_callback_urls_must_be_public_https(app_instance):
+    """Test that callback URLs can't target the internal network"""
+    app_instance.config["FLASK_DEBUG"] = False
+
+    with app_instance.app_context():
+        assert webhooks.is_valid_callback_url("https://example.com/hook")
+        assert not webhooks.is_valid_callback_url("http://example.com/hook")
+        assert not webhooks.is_valid_callback_url("https://localhost/hook")
+        assert not webhooks.is_valid_callback_url("https://10.0.0.1/hook")
+        assert not webhooks.is_valid_callback_url(None)
+
+        # Non-canonical forms of IP addresses and hosts with credentials
+        assert webhooks.is_valid_callback_url("https://93.184.215.14/hook")
+        for host in [
+            "0177.0.0.1",
+            "0x7f000001",
+            "2130706433",
+            "127.1",
+            "169.254.169.254",
+            "user@example.com",
+            "[::ffff:127.0.0.1]",
+            "[64:ff9b::a00:1]",
+            "[2002:a00:1::]",
+        ]:
+            assert not webhooks.is_valid_callback_url(f"https://{host}/hook"), host
+
+
+def test_callbacks_resolving_to_internal_addresses_are_not_sent(
+    client, api_user, receiver, monkeypatch
+):
+    """Test that a public name resolving to a private address gets nothing"""
+    from app import views_api
+    from app.models import BatchJobs, WebhookDeliveries
+
+    monkeypatch.setattr(
+        views_api, "upload_api_validation_list", lambda user, emails: "list.csv"
+    )
+
+    client.application.config["FLASK_DEBUG"] = False
+    receiver.addresses = ["93.184.215.14", "169.254.169.254"]
+
+    response = client.post(
+        "/api/jobs",
+        headers=api_key_headers(api_user),
+        json={"emails": ["a@example.com"], "callback_url": "https://example.com/h"},
+    )
+    assert response.status_code == 202
+    job = BatchJobs.query.filter_by(uid=response.json["job"]["uid"]).first()
+    complete_job(job)
+
+    assert webhooks.dispatch_job_webhooks() == 0
+    assert receiver.requests == []
+    delivery = WebhookDeliveries.query.filter_by(job_id=job.id).first()
+    assert delivery.last_status_code is None
+    assert delivery.last_error == (
+        "The callback URL doesn't resolve to a public address."
+    )
+
+    db.session.delete(delivery)
+    db.session.delete(job)
+    db.session.commit()
+
+
+def test_notifications_connect_to_the_checked_address(app_instance, monkeypatch):
+    """Test that the request goes to the resolved address, with the host name for TLS"""
+    sent = {}
+
+    def fake_send(self, request, **kwargs):
+        adapter = self.get_adapter(request.url)
+        sent.update(
+            url=request.url,
+            host=request.headers["Host"],
+            tls_name=adapter.poolmanager.connection_pool_kw["server_hostname"],
+        )
+        return SimpleNamespace(status_code=204)
+
+    monkeypatch.setattr(webhooks.requests.Session, "send", fake_send)
+    webhooks.post_to_address(
+        "https://example.com:8443/h?x=1", "93.184.215.14", "{}", {}, 1
+    )
+    assert sent == {
+        "url": "https://93.184.215.14:8443/h?x=1",
+        "host": "example.com:8443",
+        "tls_name": "example.com",
+    }